@@ -0,0 +1,15 @@
+"""
+Metrics shared by the VAE and MoleculeChef: kernel (MMD) estimates of the latent distributions
+and the monomer bag reconstruction accuracy.
+"""
+from metrics.accuracy import (
+    get_accuracy,
+    get_bag_accuracy,
+    get_correct_reactant_bags_batch,
+    get_correct_reactant_bags_batch_error_analysis,
+)
+from metrics.kernels import (
+    estimate_maximum_mean_discrepancy,
+    estimate_maximum_mean_discrepancy_linear,
+    estimate_maximum_mean_discrepancy_unbiased,
+)
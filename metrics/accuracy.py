@@ -0,0 +1,115 @@
+import torch
+
+PAD_IDX = torch.iinfo(torch.long).max  # sorted after all monomer indices
+
+
+def decoded_dict_to_tensor(decoded_dict: dict, device=None):
+    """
+    Decoded monomer indices {step: [b]} -> [b, max_step]
+    """
+    return torch.stack([decoded_dict[step] for step in range(len(decoded_dict))], dim=1).to(
+        device=device, dtype=torch.long
+    )
+
+
+def answer_dict_to_tensor(answer_dict: dict, device=None):
+    """
+    Answer monomer indices {bag: [monomer indices, stop_idx]} -> [b, max length] padded with PAD_IDX and lengths [b]
+    """
+    lengths = torch.tensor([len(answer_dict[key]) for key in range(len(answer_dict))], dtype=torch.long)
+    answer_idx = torch.full([len(answer_dict), int(lengths.max())], PAD_IDX, dtype=torch.long)
+    for key in range(len(answer_dict)):
+        answer_idx[key, :lengths[key]] = torch.as_tensor(answer_dict[key], dtype=torch.long)
+
+    return answer_idx.to(device), lengths.to(device)
+
+
+def sorted_unique_rows(idx):
+    """
+    Each row of idx as a sorted set: duplicates are replaced with PAD_IDX (sorted last)
+    """
+    idx_sorted = idx.sort(dim=1)[0]
+    duplicate = torch.zeros_like(idx_sorted, dtype=torch.bool)
+    duplicate[:, 1:] = idx_sorted[:, 1:] == idx_sorted[:, :-1]
+
+    return idx_sorted.masked_fill(duplicate, PAD_IDX).sort(dim=1)[0]
+
+
+def pad_rows(idx, width):
+    """
+    idx [b, length] padded with PAD_IDX to [b, width]
+    """
+    padded_idx = torch.full([idx.shape[0], width], PAD_IDX, dtype=idx.dtype, device=idx.device)
+    padded_idx[:, :idx.shape[1]] = idx
+
+    return padded_idx
+
+
+def compare_monomer_bags(decoded_idx, answer_idx, stop_idx):
+    """
+    Set comparison of decoded and answer monomer bags.
+    decoded_idx: [b, max_step]. A bag is the decoded indices up to and including the first stop_idx (all if none).
+    answer_idx: [b, max length] padded with PAD_IDX (see answer_dict_to_tensor).
+    Returns whether each bag is decoded exactly (set equality) [b] and the number of answer monomers decoded [b].
+    """
+    # indices after the first stop are not part of the bag
+    is_stop = (decoded_idx == stop_idx).long()
+    after_stop = (is_stop.cumsum(dim=1) - is_stop) > 0
+    prediction = sorted_unique_rows(decoded_idx.masked_fill(after_stop, PAD_IDX))
+    answer = sorted_unique_rows(answer_idx)
+
+    # set equality: the same sorted rows (padded to the same width)
+    width = max(prediction.shape[1], answer.shape[1])
+    correct_bag = torch.eq(pad_rows(prediction, width), pad_rows(answer, width)).all(dim=1)
+
+    # intersection: answer monomers found in the sorted prediction
+    position = torch.searchsorted(prediction, answer).clamp(max=prediction.shape[1] - 1)
+    found = (prediction.gather(dim=1, index=position) == answer) & (answer != PAD_IDX)
+
+    return correct_bag, found.sum(dim=1)
+
+
+def get_bag_accuracy(decoded_idx, answer_idx, answer_length, stop_idx):
+    """
+    Element accuracy (answer monomers decoded / answer length, %) and bag accuracy (bags decoded exactly, %).
+    decoded_idx: [b, max_step] (see decoded_dict_to_tensor). answer_idx: [b, max length] padded with PAD_IDX or
+    stop_idx (e.g. an answer array of molecule_chef.module.utils.get_answer_array) and answer_length [b].
+    """
+    decoded_idx = torch.as_tensor(decoded_idx).long()
+    answer_idx = torch.as_tensor(answer_idx, device=decoded_idx.device).long()
+    correct_bag, element_count = compare_monomer_bags(decoded_idx, answer_idx, stop_idx=stop_idx)
+
+    element_accuracy = float(element_count.sum()) / float(torch.as_tensor(answer_length).sum()) * 100
+    bag_accuracy = float(correct_bag.sum()) / decoded_idx.shape[0] * 100
+
+    return element_accuracy, bag_accuracy
+
+
+def get_accuracy(decoded_dict: dict, answer_dict: dict, dtype=None, device=None):
+    """
+    Element and bag accuracy (see get_bag_accuracy) of answer_dict {bag: [monomer indices, stop_idx]}.
+    dtype and device are not used (the comparison runs on the device of the decoded indices).
+    """
+    decoded_idx = decoded_dict_to_tensor(decoded_dict)
+    answer_idx, lengths = answer_dict_to_tensor(answer_dict, device=decoded_idx.device)
+
+    return get_bag_accuracy(decoded_idx, answer_idx, lengths, stop_idx=answer_dict[0][-1])
+
+
+def get_correct_reactant_bags_batch(decoded_dict: dict, answer_dict: dict, dtype=None, device=None):
+    """
+    Number of bags decoded exactly
+    """
+    return get_correct_reactant_bags_batch_error_analysis(decoded_dict, answer_dict)[0]
+
+
+def get_correct_reactant_bags_batch_error_analysis(decoded_dict: dict, answer_dict: dict, dtype=None, device=None):
+    """
+    Number of bags decoded exactly and their indices
+    """
+    decoded_idx = decoded_dict_to_tensor(decoded_dict)
+    answer_idx, _ = answer_dict_to_tensor(answer_dict, device=decoded_idx.device)
+    correct_bag, _ = compare_monomer_bags(decoded_idx, answer_idx, stop_idx=answer_dict[0][-1])
+    right_idx = correct_bag.nonzero().flatten().tolist()
+
+    return len(right_idx), right_idx
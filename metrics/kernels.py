@@ -0,0 +1,140 @@
+import torch
+
+
+def _inverse_multiquadratics_kernel_sum(x, y, c, chunk_size):
+    """
+    Sum of c / (c + |x_i - y_j|^2) over all pairs, computed over row chunks of x ([chunk_size, len(y)] at a time)
+    """
+    y_squared_norm = y.pow(2).sum(dim=1).unsqueeze(0)
+    kernel_sum = torch.zeros(size=(), dtype=x.dtype, device=x.device)
+    for x_chunk in x.split(chunk_size):
+        squared_distance = x_chunk.pow(2).sum(dim=1, keepdim=True) + y_squared_norm - 2 * torch.mm(x_chunk, y.t())
+        kernel_sum = kernel_sum + torch.sum(c / (c + squared_distance))
+
+    return kernel_sum
+
+
+def estimate_maximum_mean_discrepancy(posterior_z_samples: torch.Tensor, chunk_size=None):
+    """
+    MMD between the posterior samples and samples of the standard Gaussian prior with the inverse multi-quadratics
+    kernel (V-statistic, diagonal terms included). Refer to Sec.4 of Wasserstein Auto-Encoders by Tolstikhin et al.
+    https://stats.stackexchange.com/questions/276497/maximum-mean-discrepancy-distance-distribution
+    chunk_size: evaluate the kernels over [chunk_size, b] blocks instead of [b, b] matrices (very large batches,
+    e.g. the whole test set). None -> one block.
+    """
+    # set dtype and device
+    dtype = posterior_z_samples.dtype
+    device = posterior_z_samples.device
+
+    # set dimension and number of samples
+    latent_dimension = posterior_z_samples.shape[1]
+    number_of_samples = posterior_z_samples.shape[0]
+
+    # get prior samples
+    prior_z_samples = torch.randn(size=(number_of_samples, latent_dimension), device=device, dtype=dtype)
+
+    # calculate Maximum Mean Discrepancy with inverse multi-quadratics kernel
+    # set value of c - refer to Sec.4 of Wasserstein paper
+    c = 2 * latent_dimension * (1.0**2)
+
+    if chunk_size is not None and chunk_size < number_of_samples:
+        number_of_pairs = number_of_samples ** 2
+        kernel_pp = _inverse_multiquadratics_kernel_sum(prior_z_samples, prior_z_samples, c, chunk_size)
+        kernel_qq = _inverse_multiquadratics_kernel_sum(posterior_z_samples, posterior_z_samples, c, chunk_size)
+        kernel_pq = _inverse_multiquadratics_kernel_sum(prior_z_samples, posterior_z_samples, c, chunk_size)
+        return (kernel_pp + kernel_qq - 2 * kernel_pq) / number_of_pairs
+
+    # calculate pp term (p means prior)
+    pp = torch.mm(prior_z_samples, prior_z_samples.t())
+    pp_diag = pp.diag().unsqueeze(0).expand_as(pp)
+
+    # calculate qq term (q means posterior)
+    qq = torch.mm(posterior_z_samples, posterior_z_samples.t())
+    qq_diag = qq.diag().unsqueeze(0).expand_as(qq)
+
+    # calculate pq term (q means posterior)
+    pq = torch.mm(prior_z_samples, posterior_z_samples.t())
+
+    # calculate kernel
+    kernel_pp = torch.mean(c / (c + pp_diag + pp_diag.t() - 2 * pp))
+    kernel_qq = torch.mean(c / (c + qq_diag + qq_diag.t() - 2 * qq))
+    kernel_pq = torch.mean(c / (c + qq_diag + pp_diag.t() - 2 * pq))
+
+    # estimate mmd
+    mmd = kernel_pp + kernel_qq - 2*kernel_pq
+
+    return mmd
+
+
+def estimate_maximum_mean_discrepancy_unbiased(posterior_z_samples: torch.Tensor, chunk_size=None):
+    """
+    Unbiased MMD (U-statistic, diagonal terms of the pp and qq kernels excluded) with the inverse multi-quadratics
+    kernel. Detailed explanation is in: https://www.kaggle.com/onurtunali/maximum-mean-discrepancy
+    MMD is a symmetric distance between samples from two different probability distributions,
+    i.e. MMD(P, Q) = MMD(Q, P)
+    """
+    # set dtype and device
+    dtype = posterior_z_samples.dtype
+    device = posterior_z_samples.device
+
+    # set dimension and number of samples
+    latent_dimension = posterior_z_samples.shape[1]
+    number_of_samples = posterior_z_samples.shape[0]
+    if chunk_size is None:
+        chunk_size = number_of_samples
+
+    # get prior samples
+    prior_z_samples = torch.randn(size=(number_of_samples, latent_dimension), device=device, dtype=dtype)
+
+    # set value of c - refer to Sec.4 of Wasserstein paper
+    c = 2 * latent_dimension * (1.0**2)
+
+    # the diagonal kernel values are c / c = 1
+    number_of_off_diagonal_pairs = number_of_samples * (number_of_samples - 1)
+    kernel_pp = _inverse_multiquadratics_kernel_sum(prior_z_samples, prior_z_samples, c, chunk_size)
+    kernel_pp = (kernel_pp - number_of_samples) / number_of_off_diagonal_pairs
+    kernel_qq = _inverse_multiquadratics_kernel_sum(posterior_z_samples, posterior_z_samples, c, chunk_size)
+    kernel_qq = (kernel_qq - number_of_samples) / number_of_off_diagonal_pairs
+    kernel_pq = _inverse_multiquadratics_kernel_sum(prior_z_samples, posterior_z_samples, c, chunk_size)
+    kernel_pq = kernel_pq / number_of_samples**2
+
+    mmd = kernel_pp + kernel_qq - 2 * kernel_pq
+
+    return mmd
+
+
+def estimate_maximum_mean_discrepancy_linear(posterior_z_samples: torch.Tensor):
+    """
+    Linear-time unbiased MMD estimate (Gretton et al., 2012, Lemma 14) with the inverse multi-quadratics kernel.
+    Kernels are evaluated on disjoint pairs of samples instead of the [b, b] matrices of
+    estimate_maximum_mean_discrepancy, so time and memory are O(b) - at a higher variance (b / 2 terms).
+    The expectation is the squared MMD (the quadratic estimate also includes the diagonal terms).
+    """
+    # set dtype and device
+    dtype = posterior_z_samples.dtype
+    device = posterior_z_samples.device
+
+    # set dimension and number of samples
+    latent_dimension = posterior_z_samples.shape[1]
+    number_of_pairs = posterior_z_samples.shape[0] // 2  # an odd last sample is not used
+    if number_of_pairs == 0:
+        return torch.zeros(size=(), dtype=dtype, device=device)
+
+    # get prior samples
+    prior_z_samples = torch.randn(size=(2 * number_of_pairs, latent_dimension), device=device, dtype=dtype)
+
+    # calculate Maximum Mean Discrepancy with inverse multi-quadratics kernel
+    # set value of c - refer to Sec.4 of Wasserstein paper
+    c = 2 * latent_dimension * (1.0**2)
+
+    def kernel(x, y):
+        return c / (c + (x - y).pow(2).sum(dim=-1))
+
+    # pairs (x_2i-1, x_2i): first and second half of the samples
+    p_1, p_2 = prior_z_samples[:number_of_pairs], prior_z_samples[number_of_pairs:]
+    q_1, q_2 = posterior_z_samples[:number_of_pairs], posterior_z_samples[number_of_pairs: 2 * number_of_pairs]
+
+    # estimate mmd
+    mmd = torch.mean(kernel(p_1, p_2) + kernel(q_1, q_2) - kernel(p_1, q_2) - kernel(p_2, q_1))
+
+    return mmd
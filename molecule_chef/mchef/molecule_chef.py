@@ -9,8 +9,7 @@ import torch
 import torch.nn as nn
 
 from abc import ABC
-from collections import OrderedDict
-from copy import deepcopy
+from functools import partial
 from tqdm import tqdm
 from pathlib import Path
 
@@ -19,8 +18,11 @@ from torch.optim.lr_scheduler import ExponentialLR
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import r2_score
 
+from metrics.accuracy import get_bag_accuracy, decoded_dict_to_tensor
+from metrics.kernels import estimate_maximum_mean_discrepancy, estimate_maximum_mean_discrepancy_linear
 from molecule_chef.mchef.base import BaseMoleculeChef
-from molecule_chef.module.utils import TorchDetails, get_accuracy, estimate_maximum_mean_discrepancy
+from molecule_chef.module.utils import TorchDetails, get_monomer_to_idx, get_answer_array, \
+    get_monomer_bags_graph_embedding_tensor
 from molecule_chef.module.encoder import Encoder
 from molecule_chef.module.decoder import Decoder
 
@@ -75,22 +77,22 @@ class MoleculeChef(BaseMoleculeChef):
         self.teacher_forcing_reconstruction_loss = list()
 
         # batch dependent attributes
-        self.monomer_bags_graph_embedding_dict = OrderedDict()
         self.all_monomers_graph_embedding_tensor = None
         self.monomer_bags_graph_embedding_tensor = None
 
     @staticmethod
-    def get_answer_dict(monomer_bags, unique_monomer_sets):
-        # get answer dictionary
-        answer_dict = dict()
-        for idx_of_bag in range(len(monomer_bags)):
-            idx_list = list()
-            for monomer in monomer_bags[idx_of_bag]:
-                idx = np.where(unique_monomer_sets == monomer)[0].item()  # np.where returns nd.arr tuple
-                idx_list.append(idx)
-            idx_list.append(len(unique_monomer_sets))
-            answer_dict[idx_of_bag] = deepcopy(idx_list)
-        return answer_dict
+    def get_answer_dict(monomer_bags, unique_monomer_sets, monomer_to_idx=None):
+        """
+        {bag: [monomer indices, stop_idx]}. monomer_to_idx: get_monomer_to_idx(unique_monomer_sets), built once when
+        called for many batches.
+        """
+        if monomer_to_idx is None:
+            monomer_to_idx = get_monomer_to_idx(unique_monomer_sets)
+        stop_idx = len(unique_monomer_sets)
+        return {
+            idx_of_bag: [monomer_to_idx[monomer] for monomer in monomer_bag] + [stop_idx]
+            for idx_of_bag, monomer_bag in enumerate(monomer_bags)
+        }
 
     def get_graph_embeddings_all_monomers(self, graph_adj_list):
         # get graph embeddings
@@ -100,40 +102,46 @@ class MoleculeChef(BaseMoleculeChef):
             (graph_embedding_tensor, self.mchef_module.stop_embedding.unsqueeze(0)), dim=0
         )
 
-    def get_graph_embeddings_monomer_bags_dict(self, monomer_bags_idx, answer_dict):
-        # get monomer bags embeddings
-        for idx_of_bag in monomer_bags_idx:
-            self.monomer_bags_graph_embedding_dict[idx_of_bag] = 0  # initialize
-            for monomer_idx in answer_dict[idx_of_bag][:-1]:  # exclude stop embeddings
-                self.monomer_bags_graph_embedding_dict[idx_of_bag] += self.all_monomers_graph_embedding_tensor[
-                    monomer_idx]
-                
-                # memory
-                # tensor = self.all_monomers_graph_embedding_tensor[monomer_idx].to(self.device)
-                # self.monomer_bags_graph_embedding_dict[idx_of_bag] += tensor
-
-    def get_graph_embeddings_monomer_bags_tensor(self):
-        temp = list(self.monomer_bags_graph_embedding_dict.values())[0].view(1, -1)
-        for key in list(self.monomer_bags_graph_embedding_dict.keys())[1:]:
-            result = torch.cat(
-                [temp, self.monomer_bags_graph_embedding_dict[key].view(1, -1)], dim=0
-            )
-            temp = result
-        self.monomer_bags_graph_embedding_tensor = temp
+    def get_graph_embeddings_monomer_bags_tensor(self, monomer_bags_idx_tensor):
+        # get monomer bags embeddings (the stop index pads the bags and is excluded)
+        self.monomer_bags_graph_embedding_tensor = get_monomer_bags_graph_embedding_tensor(
+            self.all_monomers_graph_embedding_tensor, monomer_bags_idx_tensor
+        )
 
     def train(self,
               train_monomer_bags: list or tuple or np.ndarray, test_monomer_bags: list or tuple or np.ndarray,
               train_property_data: list or tuple or np.ndarray, test_property_data: list or tuple or np.ndarray,
               unique_mols, unique_monomer_sets, num_epochs, batch_size: int, save_directory: str, lr=0.001,
-              weight_decay=1e-4, mmd_weight=10.0):
+              weight_decay=1e-4, mmd_weight=10.0, mixed_precision=False, mmd_estimator='quadratic'):
+        """
+        mixed_precision: run the forward passes under bfloat16 autocast (e.g. CPUs with AVX-512 BF16 / AMX);
+        losses, the MMD and the graph embedding sums are computed in data_type. No loss scaling is needed for bfloat16.
+        mmd_estimator: 'quadratic' (estimate_maximum_mean_discrepancy, [b, b] kernel matrices) or 'linear'
+        (estimate_maximum_mean_discrepancy_linear, O(b) for large batches) for the training divergence loss.
+        The test divergence loss is always the quadratic estimate (comparable between runs).
+        """
+        if mmd_estimator not in ('quadratic', 'linear'):
+            raise ValueError(f'mmd_estimator must be quadratic or linear: {mmd_estimator}')
+        estimate_train_divergence = estimate_maximum_mean_discrepancy_linear if mmd_estimator == 'linear' else \
+            estimate_maximum_mean_discrepancy
+        autocast = partial(torch.autocast, device_type=torch.device(self.device).type, dtype=torch.bfloat16,
+                           enabled=mixed_precision)
 
         # get graph data
         graph_adj_list = self.get_atomic_feature_vectors_and_adjacency_list(unique_mols)
         # self.get_graph_embeddings_all_monomers(graph_adj_list=graph_adj_list)  # memory issue
 
-        # get answer dict
-        train_answer_dict = self.get_answer_dict(train_monomer_bags, unique_monomer_sets)
-        test_answer_dict = self.get_answer_dict(test_monomer_bags, unique_monomer_sets)
+        # get answer arrays (monomer indices padded with the stop index - also the bags of the graph embeddings)
+        monomer_to_idx = get_monomer_to_idx(unique_monomer_sets)
+        stop_embedding_idx = len(unique_monomer_sets)
+        train_answer_idx, train_answer_length = [
+            torch.from_numpy(array).to(device=self.device, dtype=torch.long)
+            for array in get_answer_array(train_monomer_bags, monomer_to_idx)
+        ]
+        test_answer_idx, test_answer_length = [
+            torch.from_numpy(array).to(device=self.device, dtype=torch.long)
+            for array in get_answer_array(test_monomer_bags, monomer_to_idx)
+        ]
 
         # scale
         self.scaler.fit(train_property_data)
@@ -161,7 +169,7 @@ class MoleculeChef(BaseMoleculeChef):
             train_reconstruction_loss = torch.zeros(size=(1,), dtype=self.dtype, device=self.device)
             train_divergence_loss = torch.zeros(size=(1,), dtype=self.dtype, device=self.device)
             tqdm.write("===== EPOCH %d =====" % (epoch + 1))
-            train_monomer_bags_idx = np.random.permutation(range(len(train_answer_dict)))  # shuffle monomer bags
+            train_monomer_bags_idx = np.random.permutation(range(len(train_monomer_bags)))  # shuffle monomer bags
             start = time.time()  # start time
 
             # train mode
@@ -179,22 +187,21 @@ class MoleculeChef(BaseMoleculeChef):
                     if batch_idx == num_batches_train - 1:
                         stop_idx = len(train_monomer_bags)
                     batch_monomer_bags_idx = train_monomer_bags_idx[start_idx: stop_idx]
+                    batch_monomer_bags_idx_tensor = torch.as_tensor(batch_monomer_bags_idx, device=self.device)
+                    batch_answer_idx = train_answer_idx[batch_monomer_bags_idx_tensor]
+                    batch_answer_length = train_answer_length[batch_monomer_bags_idx_tensor]
 
-                    # clear monomer bags graph embeddings dictionary
-                    self.monomer_bags_graph_embedding_dict.clear()
-
-                    # get answer dict and graph embeddings
-                    self.get_graph_embeddings_all_monomers(graph_adj_list=graph_adj_list)
-                    self.get_graph_embeddings_monomer_bags_dict(
-                        monomer_bags_idx=batch_monomer_bags_idx, answer_dict=train_answer_dict)
-                    self.get_graph_embeddings_monomer_bags_tensor()
+                    with autocast():
+                        # get answer dict and graph embeddings
+                        self.get_graph_embeddings_all_monomers(graph_adj_list=graph_adj_list)
+                        self.get_graph_embeddings_monomer_bags_tensor(batch_answer_idx)
 
-                    # encode
-                    z_samples, mus, log_vars = self.mchef_module.encoder(self.monomer_bags_graph_embedding_tensor)
+                        # encode
+                        z_samples, mus, log_vars = self.mchef_module.encoder(self.monomer_bags_graph_embedding_tensor)
 
                     # get maximum mean discrepancy loss
-                    divergence_loss = estimate_maximum_mean_discrepancy(
-                        posterior_z_samples=z_samples
+                    divergence_loss = estimate_train_divergence(
+                        posterior_z_samples=z_samples.to(self.dtype)
                     )
                     weighted_divergence_loss = mmd_weight * divergence_loss
 
@@ -202,7 +209,9 @@ class MoleculeChef(BaseMoleculeChef):
                     batch_train_property_tensor = torch.tensor(
                         scaled_train_property[batch_monomer_bags_idx], dtype=self.dtype, device=self.device
                     )
-                    prediction = self.mchef_module.property_network(z_samples)
+                    with autocast():
+                        prediction = self.mchef_module.property_network(z_samples)
+                    prediction = prediction.to(self.dtype)
                     criteria = nn.MSELoss(reduction='none')
 
                     # property_loss = 50.0 * criteria(input=prediction, target=batch_train_property_tensor)
@@ -215,10 +224,11 @@ class MoleculeChef(BaseMoleculeChef):
                     )
 
                     # decode (training - teacher forcing)
-                    reconstruction_loss, decoded_idx = self.mchef_module.decoder(
-                        z_samples=z_samples, all_monomer_tensors=self.all_monomers_graph_embedding_tensor,
-                        answer_dict=train_answer_dict, monomer_bag_idx=batch_monomer_bags_idx, teacher_forcing=True
-                    )
+                    with autocast():
+                        reconstruction_loss, decoded_idx = self.mchef_module.decoder(
+                            z_samples=z_samples, all_monomer_tensors=self.all_monomers_graph_embedding_tensor,
+                            answer_idx=batch_answer_idx, answer_length=batch_answer_length, teacher_forcing=True
+                        )
 
                     # back propagate
                     self.optimizer.zero_grad()
@@ -250,28 +260,25 @@ class MoleculeChef(BaseMoleculeChef):
                 # change mode
                 self.mchef_module.eval()
 
-                # clear answer dict and graph embeddings
-                self.monomer_bags_graph_embedding_dict.clear()
-
-                # get answer dict and graph embeddings
-                self.get_graph_embeddings_all_monomers(graph_adj_list=graph_adj_list)
-                self.get_graph_embeddings_monomer_bags_dict(
-                    monomer_bags_idx=range(len(test_monomer_bags)), answer_dict=test_answer_dict
-                )
-                self.get_graph_embeddings_monomer_bags_tensor()
+                with autocast():
+                    # get answer dict and graph embeddings
+                    self.get_graph_embeddings_all_monomers(graph_adj_list=graph_adj_list)
+                    self.get_graph_embeddings_monomer_bags_tensor(test_answer_idx)
 
-                # encode
-                z_samples, mus, log_vars = self.mchef_module.encoder(self.monomer_bags_graph_embedding_tensor)
+                    # encode
+                    z_samples, mus, log_vars = self.mchef_module.encoder(self.monomer_bags_graph_embedding_tensor)
 
                 # get maximum mean discrepancy loss
                 divergence_loss = estimate_maximum_mean_discrepancy(
-                    posterior_z_samples=z_samples
+                    posterior_z_samples=z_samples.to(self.dtype), chunk_size=4096  # the whole test set
                 )
 
                 # get property loss
                 criteria = nn.MSELoss(reduction='none')
                 test_property_tensor = torch.tensor(scaled_test_property, dtype=self.dtype, device=self.device)
-                prediction = self.mchef_module.property_network(z_samples)
+                with autocast():
+                    prediction = self.mchef_module.property_network(z_samples)
+                prediction = prediction.to(self.dtype)
                 # property_loss = 50. * criteria(input=prediction, target=test_property_tensor)
                 property_loss = criteria(input=prediction, target=test_property_tensor)
 
@@ -281,18 +288,19 @@ class MoleculeChef(BaseMoleculeChef):
                     dim=0
                 )
 
-                # decode (no teacher forcing)
-                reconstruction_loss, decoded_dict = self.mchef_module.decoder(
-                    z_samples=z_samples, all_monomer_tensors=self.all_monomers_graph_embedding_tensor,
-                    answer_dict=test_answer_dict, monomer_bag_idx=range(len(test_monomer_bags)),
-                    teacher_forcing=False
-                )
-                # decode (teacher forcing)
-                teacher_forcing_reconstruction_loss, _ = self.mchef_module.decoder(
-                    z_samples=z_samples, all_monomer_tensors=self.all_monomers_graph_embedding_tensor,
-                    answer_dict=test_answer_dict, monomer_bag_idx=range(len(test_monomer_bags)),
-                    teacher_forcing=True
-                )
+                with autocast():
+                    # decode (no teacher forcing)
+                    reconstruction_loss, decoded_dict = self.mchef_module.decoder(
+                        z_samples=z_samples, all_monomer_tensors=self.all_monomers_graph_embedding_tensor,
+                        answer_idx=test_answer_idx, answer_length=test_answer_length,
+                        teacher_forcing=False
+                    )
+                    # decode (teacher forcing)
+                    teacher_forcing_reconstruction_loss, _ = self.mchef_module.decoder(
+                        z_samples=z_samples, all_monomer_tensors=self.all_monomers_graph_embedding_tensor,
+                        answer_idx=test_answer_idx, answer_length=test_answer_length,
+                        teacher_forcing=True
+                    )
 
                 # loss append
                 self.divergence_loss.append(float(divergence_loss))
@@ -301,9 +309,9 @@ class MoleculeChef(BaseMoleculeChef):
                 self.property_loss.append(float(property_loss))
 
                 # get loss and accuracy
-                element_accuracy, bag_accuracy = get_accuracy(
-                    decoded_dict=decoded_dict, answer_dict=test_answer_dict, device=self.device,
-                    dtype=self.dtype
+                element_accuracy, bag_accuracy = get_bag_accuracy(
+                    decoded_idx=decoded_dict_to_tensor(decoded_dict), answer_idx=test_answer_idx,
+                    answer_length=test_answer_length, stop_idx=stop_embedding_idx
                 )
                 tqdm.write("Divergence loss is %.3f" % divergence_loss)
                 tqdm.write("Train Divergence loss is %.3f" % self.train_divergence_loss[-1])
@@ -329,15 +337,9 @@ class MoleculeChef(BaseMoleculeChef):
             # eval mode
             self.mchef_module.eval()
 
-            # clear answer dict and graph embeddings
-            self.monomer_bags_graph_embedding_dict.clear()
-
             # get answer dict and graph embeddings - train tensor values
             self.get_graph_embeddings_all_monomers(graph_adj_list=graph_adj_list)
-            self.get_graph_embeddings_monomer_bags_dict(
-                monomer_bags_idx=range(len(train_monomer_bags)), answer_dict=train_answer_dict
-            )
-            self.get_graph_embeddings_monomer_bags_tensor()
+            self.get_graph_embeddings_monomer_bags_tensor(train_answer_idx)
 
             # encode
             z_samples, mus, log_vars = self.mchef_module.encoder(self.monomer_bags_graph_embedding_tensor)
@@ -348,11 +350,7 @@ class MoleculeChef(BaseMoleculeChef):
             # train_prediction = self.mchef_module.property_network(z_samples).cpu().numpy()
 
             # get answer dict and graph embeddings - test tensor values
-            self.monomer_bags_graph_embedding_dict.clear()
-            self.get_graph_embeddings_monomer_bags_dict(
-                monomer_bags_idx=range(len(test_monomer_bags)), answer_dict=test_answer_dict
-            )
-            self.get_graph_embeddings_monomer_bags_tensor()
+            self.get_graph_embeddings_monomer_bags_tensor(test_answer_idx)
 
             # encode
             z_samples, mus, log_vars = self.mchef_module.encoder(self.monomer_bags_graph_embedding_tensor)
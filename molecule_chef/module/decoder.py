@@ -1,5 +1,4 @@
 from abc import ABC
-from copy import deepcopy
 from typing import List
 
 import torch
@@ -8,7 +7,7 @@ import torch.nn.functional as f
 
 from torch.distributions.gumbel import Gumbel
 
-from molecule_chef.module.utils import FullyConnectedNeuralNetwork
+from molecule_chef.module.utils import FullyConnectedNeuralNetwork, answer_dict_to_array
 
 
 class Decoder(nn.Module, ABC):
@@ -44,8 +43,19 @@ class Decoder(nn.Module, ABC):
             bias=True
         )
 
-    def forward(self, z_samples, all_monomer_tensors, answer_dict, monomer_bag_idx, teacher_forcing=True,
-                generate=False):
+    def forward(self, z_samples, all_monomer_tensors, answer_dict=None, monomer_bag_idx=None, teacher_forcing=True,
+                generate=False, answer_idx=None, answer_length=None):
+        """
+        The answers of the batch are either answer_dict with the bag indices monomer_bag_idx, or the rows of the batch
+        of the answer array (see get_answer_array): answer_idx [b, max length] padded with the stop index and
+        answer_length [b] (stop included). Not used with generate=True.
+        """
+        if not generate:
+            if answer_idx is None:
+                answer_idx, answer_length = answer_dict_to_array(answer_dict, monomer_bag_idx=monomer_bag_idx)
+            answer_idx = torch.as_tensor(answer_idx, device=self.torch_details.device).long()
+            answer_length = torch.as_tensor(answer_length, device=self.torch_details.device).long()
+
         # initial hidden shape: [b, graph_embedding_dim]
         hidden = self.linear_projection_z_to_hidden(z_samples)
 
@@ -53,12 +63,8 @@ class Decoder(nn.Module, ABC):
         message = torch.zeros(
             size=hidden.shape, dtype=self.torch_details.data_type, device=self.torch_details.device
         )
-        # updated massage shape: [b, graph_embedding_dim]
-        updated_message = torch.zeros(
-            size=hidden.shape, dtype=self.torch_details.data_type, device=self.torch_details.device
-        )
-        # change hidden shape
-        hidden_in = hidden.unsqueeze(0).repeat(self.number_of_layers, 1, 1)  # [2, b, graph_embedding (out_size)]
+        # change hidden shape (same dtype as the message under autocast)
+        hidden_in = hidden.unsqueeze(0).repeat(self.number_of_layers, 1, 1).to(message.dtype)  # [2, b, graph_embedding (out_size)]
 
         # transpose
         all_monomer_tensors_transposed = all_monomer_tensors.transpose(dim0=0, dim1=1)
@@ -75,13 +81,12 @@ class Decoder(nn.Module, ABC):
         # stop_embedding_idx = all_monomer_tensors.shape[0] - 1  # idx = length - 1
 
         # get length tensor
-        length = torch.zeros(size=(z_samples.shape[0],), dtype=torch.long, device=self.torch_details.device)
         if not generate:
-            for idx, bag_idx in enumerate(monomer_bag_idx):
-                length[idx] = len(answer_dict[bag_idx])
+            length = answer_length
         else:
-            for idx, bag_idx in enumerate(monomer_bag_idx):
-                length[idx] = self.max_steps
+            length = torch.full(
+                size=(z_samples.shape[0],), fill_value=self.max_steps, dtype=torch.long, device=self.torch_details.device
+            )
 
         # run RNN - calculate hidden tensors
         for step in range(self.max_steps):
@@ -109,31 +114,24 @@ class Decoder(nn.Module, ABC):
             decoded_idx[step] = torch.argmax(dot_product, dim=-1).detach()
 
             # construct target and update message
-            target = torch.zeros(
-                size=(dot_product.shape[0],), dtype=torch.long, device=self.torch_details.device
-            )
             if not generate:
-                for idx, bag_idx in enumerate(monomer_bag_idx):
-                    idx_step = step
-                    # if step is larger than the length of the bag, take it to HALT
-                    if idx_step >= len(answer_dict[bag_idx]):
-                        idx_step = len(answer_dict[bag_idx]) - 1
-                    target[idx] = deepcopy(answer_dict[bag_idx][idx_step])
-
-                    if teacher_forcing:  # train (teacher forcing)
-                        # update message vector (teacher forcing)
-                        updated_message[idx] = all_monomer_tensors[answer_dict[bag_idx][idx_step]].clone()
-                    else:  # test (not teacher forcing)
-                        updated_message[idx] = all_monomer_tensors[decoded_idx[step][idx]].clone()
+                # if step is larger than the length of the bag, take it to HALT (the answers are padded with HALT)
+                target = answer_idx[:, min(step, answer_idx.shape[1] - 1)]
             else:
-                for idx, bag_idx in enumerate(monomer_bag_idx):
-                    updated_message[idx] = all_monomer_tensors[decoded_idx[step][idx]].clone()
+                target = torch.zeros(
+                    size=(dot_product.shape[0],), dtype=torch.long, device=self.torch_details.device
+                )
+
+            if not generate and teacher_forcing:  # train (teacher forcing)
+                message_idx = target
+            else:  # test (not teacher forcing) and generation
+                message_idx = decoded_idx[step]
 
             # change message
-            message = updated_message.clone()
+            message = all_monomer_tensors[message_idx].to(self.torch_details.data_type)
 
-            # calculate cross entropy loss
-            recon_loss_step = criterion(dot_product, target)[~stop_flag]
+            # calculate cross entropy loss (in data_type under autocast)
+            recon_loss_step = criterion(dot_product.to(recon_loss.dtype), target)[~stop_flag]
             if len(recon_loss_step) == 0:  # if there is no components in recon_loss_step
                 recon_loss_step = 0
             else:
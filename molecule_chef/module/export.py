@@ -0,0 +1,99 @@
+import copy
+import json
+from typing import Tuple
+
+import torch
+from torch import nn, Tensor
+from torch.nn import functional as f
+
+METADATA_FILE = 'metadata.json'
+
+
+class MoleculeChefInference(nn.Module):
+    def __init__(self, encoder, decoder, all_monomers_graph_embedding_tensor):
+        """
+        Inference graph of a trained MoleculeChef for TorchScript: the encoder and the decoder mapping (traced),
+        the decoder GRU and the graph embeddings of all monomers (stop embedding last) as a buffer.
+        The graph neural network is not needed at inference (the monomer embeddings are fixed after training).
+        The encoder and decoder are copied, so the training mode of the given modules is left as it is.
+        """
+        super(MoleculeChefInference, self).__init__()
+        encoder, decoder = copy.deepcopy(encoder).eval(), copy.deepcopy(decoder).eval()
+        all_monomer_tensors = all_monomers_graph_embedding_tensor.detach().clone()
+        example_input = all_monomer_tensors[:2]
+
+        with torch.no_grad():
+            self.encoder = torch.jit.trace(encoder, example_input, check_trace=False)  # reparameterization samples
+            self.gru_neural_net = torch.jit.trace(decoder.gru_neural_net, example_input)
+        self.linear_projection_z_to_hidden = decoder.linear_projection_z_to_hidden
+        self.gru = decoder.gru
+        self.register_buffer('all_monomer_tensors', all_monomer_tensors)
+
+        self.number_of_layers = decoder.number_of_layers
+        self.max_steps = decoder.max_steps
+        self.stop_idx = all_monomer_tensors.shape[0] - 1
+
+    @torch.jit.export
+    def encode_bags(self, bag_idx) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Returns z, mu and log_var of monomer bags. bag_idx: [b, max bag size] monomer indices padded with stop_idx
+        """
+        bag_embeddings = f.embedding_bag(bag_idx, self.all_monomer_tensors, mode='sum', padding_idx=self.stop_idx)
+        return self.encoder(bag_embeddings)
+
+    @torch.jit.export
+    def decode_step(self, message, hidden) -> Tuple[Tensor, Tensor]:
+        """
+        One decoder step: message [b, graph_embedding], hidden [layers, b, graph_embedding].
+        Returns the scores over all monomers (stop last) [b, total_num] and the next hidden.
+        """
+        output, hidden = self.gru(message.unsqueeze(0), hidden)
+        output_mapped = self.gru_neural_net(output.squeeze(0))
+        return torch.matmul(output_mapped, self.all_monomer_tensors.t()), hidden
+
+    def forward(self, z):
+        """
+        Decoded monomer indices [b, max_steps] of latent vectors z [b, latent] (see Decoder with generate=True).
+        Indices after the first stop_idx are not part of the bag.
+        """
+        hidden = self.linear_projection_z_to_hidden(z)
+        message = torch.zeros_like(hidden)
+        hidden = hidden.unsqueeze(0).repeat(self.number_of_layers, 1, 1)
+
+        decoded_idx = torch.empty([z.shape[0], self.max_steps], dtype=torch.long, device=z.device)
+        for step in range(self.max_steps):
+            dot_product, hidden = self.decode_step(message, hidden)
+            decoded_idx[:, step] = dot_product.argmax(dim=-1)
+            message = self.all_monomer_tensors[decoded_idx[:, step]]
+
+        return decoded_idx
+
+
+def export_molecule_chef(file_path, encoder, decoder, all_monomers_graph_embedding_tensor, unique_monomer_sets=None):
+    """
+    Save the scripted MoleculeChefInference with its metadata (stop index, max steps and monomers) to file_path.
+    """
+    inference_module = torch.jit.script(
+        MoleculeChefInference(encoder, decoder, all_monomers_graph_embedding_tensor).eval()
+    )
+    metadata = {
+        'stop_idx': inference_module.stop_idx,
+        'max_steps': inference_module.max_steps,
+        'unique_monomer_sets': None if unique_monomer_sets is None else list(unique_monomer_sets),
+    }
+    torch.jit.save(inference_module, file_path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+
+    return inference_module
+
+
+def load_molecule_chef(file_path, map_location=None):
+    """
+    Load an exported MoleculeChef (no graph neural network or parameter dicts). Returns the scripted module and metadata.
+        z, mu, log_var = module.encode_bags(bag_idx)
+        decoded_idx = module(z)  # generation
+    """
+    extra_files = {METADATA_FILE: ''}
+    inference_module = torch.jit.load(file_path, map_location=map_location, _extra_files=extra_files)
+    inference_module.eval()
+
+    return inference_module, json.loads(extra_files[METADATA_FILE])
@@ -127,7 +127,8 @@ class GGNNSparse(GGNNBase):
                 projected_feats = projection(hidden)  # [total number of atoms, h_layer_size]
                 #Todo: potentially wasteful doing this projection on all nodes (ie many may not
                 # be connected by all kinds of edge)
-                message.index_add_(0, adj_list[0], projected_feats.index_select(0, adj_list[1]))
+                # accumulate in data_type (projections are in lower precision under autocast)
+                message.index_add_(0, adj_list[0], projected_feats.index_select(0, adj_list[1]).to(message.dtype))
 
             hidden = self.GRU_hidden(message, hidden)
 
@@ -165,6 +166,6 @@ class GraphFeaturesStackIndexAdd(nn.Module):
         graph_sums = torch.zeros(
             num_graphs, gated_vals.shape[1], device=self.torch_details.device, dtype=self.torch_details.data_type
         )  # [g, j]
-        graph_sums.index_add_(0, node_to_graph_id, gated_vals)
+        graph_sums.index_add_(0, node_to_graph_id, gated_vals.to(graph_sums.dtype))
 
         return graph_sums
@@ -9,15 +9,23 @@ import torch.nn.functional as f
 from abc import ABC
 from pathlib import Path
 from rdkit import Chem
-from torch.distributions.multivariate_normal import MultivariateNormal
 from typing import List
 
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 
+from metrics.accuracy import get_accuracy, get_correct_reactant_bags_batch, \
+    get_correct_reactant_bags_batch_error_analysis
+from metrics.kernels import estimate_maximum_mean_discrepancy, estimate_maximum_mean_discrepancy_linear, \
+    estimate_maximum_mean_discrepancy_unbiased
+
+get_accuracy_check = get_accuracy
+get_maximum_mean_discrepancy = estimate_maximum_mean_discrepancy_unbiased
+
 
 TORCH_FLT = torch.float32
 NP_LONG = np.int64
+NP_ANSWER = np.int32  # answer arrays of monomer bags
 
 
 class TorchDetails(object):
@@ -121,14 +129,150 @@ class PropertyNetworkPredictionModule(nn.Module):
         self.property_network_module = nn.ModuleList(property_network_list)
 
     def forward(self, latent_points):
-        prediction = torch.zeros(size=(latent_points.shape[0], 1),
-                                 device=latent_points.device, dtype=latent_points.dtype)
+        prediction_list = [property_network(latent_points) for property_network in self.property_network_module]
 
-        for property_idx in range(self.property_dim):
-            prediction_tensor = self.property_network_module[property_idx](latent_points)
-            prediction = torch.cat([prediction, prediction_tensor], dim=-1)
+        return torch.cat(prediction_list, dim=-1)
 
-        return prediction[:, 1:]
+
+class FusedPropertyNetworkPredictionModule(nn.Module):
+    def __init__(self, latent_dim, property_dim, property_network_hidden_dim_list, dtype, device, weights=(0.5, 0.5)):
+        """
+        PropertyNetworkPredictionModule with all property networks evaluated together. Networks of the same depth
+        are stacked into one FusedFullyConnectedNeuralNetwork (one matmul per layer).
+        State dicts of PropertyNetworkPredictionModule are converted when loaded.
+        """
+        super(FusedPropertyNetworkPredictionModule, self).__init__()
+        if len(property_network_hidden_dim_list) != property_dim:
+            raise ValueError('Insert the property network structure corresponding to the property dimension')
+        if len(weights) != property_dim:
+            raise ValueError('Insert the weights corresponding to the property dimension')
+        if property_dim < 1:
+            raise ValueError("There is no property target")
+
+        self.latent_dim = latent_dim
+        self.property_dim = property_dim
+        self.dtype = dtype
+        self.device = device
+
+        weights = torch.tensor(weights, dtype=dtype, device=device)
+        self.normalized_weights_tensor = f.normalize(weights, p=1.0, dim=0)
+
+        # group property networks by depth
+        depth_to_property_idx = dict()
+        for property_idx, dim_list in enumerate(property_network_hidden_dim_list):
+            depth_to_property_idx.setdefault(len(dim_list), []).append(property_idx)
+        self.group_property_idx = list(depth_to_property_idx.values())
+
+        self.property_network_groups = nn.ModuleList([
+            FusedFullyConnectedNeuralNetwork(
+                input_dim=latent_dim,
+                output_dim=1,
+                hidden_sizes_list=[property_network_hidden_dim_list[property_idx] for property_idx in property_idx_list]
+            ) for property_idx_list in self.group_property_idx
+        ])
+
+        # column of each property in the concatenated group outputs
+        group_order = [property_idx for property_idx_list in self.group_property_idx for property_idx in property_idx_list]
+        self.output_order = torch.argsort(torch.tensor(group_order)).tolist()
+
+        self._register_load_state_dict_pre_hook(self._convert_unfused_state_dict)
+
+    def forward(self, latent_points):
+        if len(self.property_network_groups) == 1:
+            return self.property_network_groups[0](latent_points)
+
+        prediction = torch.cat([network(latent_points) for network in self.property_network_groups], dim=-1)
+        return prediction[:, self.output_order]
+
+    def _convert_unfused_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                    error_msgs):
+        unfused_prefix = prefix + 'property_network_module.'
+        if not any(key.startswith(unfused_prefix) for key in state_dict):
+            return
+
+        for group_idx, property_idx_list in enumerate(self.group_property_idx):
+            head_state_dict_list = list()
+            for property_idx in property_idx_list:
+                head_prefix = f'{unfused_prefix}{property_idx}.'
+                head_state_dict_list.append({
+                    key[len(head_prefix):]: state_dict.pop(key) for key in list(state_dict) if key.startswith(head_prefix)
+                })
+            group_state_dict = self.property_network_groups[group_idx].fuse_state_dicts(head_state_dict_list)
+            for key, value in group_state_dict.items():
+                state_dict[f'{prefix}property_network_groups.{group_idx}.{key}'] = value
+
+
+class FusedFullyConnectedNeuralNetwork(nn.Module, ABC):
+    def __init__(self, input_dim: int, output_dim: int, hidden_sizes_list: List[List[int]]):
+        """
+        A stack of FullyConnectedNeuralNetwork of the same depth evaluated as one network: the first layer
+        concatenates the weights of all networks and the following layers are block-diagonal (masked) matmuls.
+        """
+        super(FusedFullyConnectedNeuralNetwork, self).__init__()
+        if len({len(hidden_sizes) for hidden_sizes in hidden_sizes_list}) != 1:
+            raise ValueError('Fused networks should have the same number of hidden layers')
+
+        self.num_networks = len(hidden_sizes_list)
+        self.layer_sizes_list = [[input_dim] + hidden_sizes + [output_dim] for hidden_sizes in hidden_sizes_list]
+        num_layers = len(self.layer_sizes_list[0]) - 1
+
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for layer_num in range(num_layers):
+            # same initialization as nn.Linear of each network
+            linear_list = [nn.Linear(layer_sizes[layer_num], layer_sizes[layer_num + 1])
+                           for layer_sizes in self.layer_sizes_list]
+            weight, bias = self._fuse_linear([(linear.weight.detach(), linear.bias.detach()) for linear in linear_list],
+                                             layer_num)
+            self.weights.append(nn.Parameter(weight))
+            self.biases.append(nn.Parameter(bias))
+            if layer_num > 0:
+                weight_mask = torch.block_diag(
+                    *[torch.ones(linear.in_features, linear.out_features) for linear in linear_list]
+                )
+                self.register_buffer(f'weight_mask_{layer_num}', weight_mask, persistent=False)
+
+    @staticmethod
+    def _fuse_linear(weight_bias_list, layer_num):
+        """
+        Fused weight [in, out] and bias [out] from nn.Linear weights [out, in] and biases of each network.
+        """
+        if layer_num == 0:  # shared input
+            weight = torch.cat([weight.t() for weight, _ in weight_bias_list], dim=1)
+        else:
+            weight = torch.block_diag(*[weight.t() for weight, _ in weight_bias_list])
+        bias = torch.cat([bias for _, bias in weight_bias_list])
+
+        return weight, bias
+
+    def forward(self, input_tensor: torch.Tensor):
+        hidden_tensor = input_tensor
+        num_layers = len(self.weights)
+        for layer_num in range(num_layers):
+            weight = self.weights[layer_num]
+            if layer_num > 0:
+                weight = weight * getattr(self, f'weight_mask_{layer_num}')
+            hidden_tensor = torch.addmm(self.biases[layer_num], hidden_tensor, weight)
+            if layer_num < num_layers - 1:
+                hidden_tensor = f.relu(hidden_tensor)
+
+        # [b, networks * output_dim]
+        return hidden_tensor
+
+    def fuse_state_dicts(self, state_dict_list):
+        """
+        Fused state dict from the state dicts of FullyConnectedNeuralNetwork (one per network).
+        """
+        fused_state_dict = dict()
+        for layer_num in range(len(self.weights)):
+            weight, bias = self._fuse_linear(
+                [(state_dict[f'linear_layers.{layer_num}.weight'], state_dict[f'linear_layers.{layer_num}.bias'])
+                 for state_dict in state_dict_list], layer_num
+            )
+            fused_state_dict[f'weights.{layer_num}'] = weight
+            fused_state_dict[f'biases.{layer_num}'] = bias
+
+        return fused_state_dict
 
 
 def construct_graph_dictionary(mol_list, ggnn, embedding_dim, torch_details):
@@ -158,238 +302,72 @@ def save_model(model, save_directory: str, name: str):
     torch.save(model, os.path.join(save_directory, name))
 
 
-def get_accuracy(decoded_dict: dict, answer_dict: dict, dtype, device):
-    max_step = len(decoded_dict)
-    decoded_result = torch.empty(size=(max_step, decoded_dict[0].shape[0]), dtype=dtype, device=device).cpu().numpy()
-    stop_embedding_idx = answer_dict[0][-1]
-    # get decoded results
-    for step in range(max_step):
-        decoded_result[step, :] = decoded_dict[step].clone().cpu().numpy()
-    decoded_result = np.transpose(decoded_result)
-
-    # count correctly encoded monomer bags
-    bag_count = 0
-    element_count = 0
-    total_element = 0
-    for key in range(len(answer_dict)):
-        length = len(answer_dict[key])
-        answer = set(answer_dict[key])
-        stop_bool = decoded_result[key] == stop_embedding_idx
-
-        # find stop index
-        stop_idx = max_step - 1
-        for idx, value in enumerate(stop_bool):
-            if value:
-                stop_idx = idx
-                break
-        prediction = set(decoded_result[key][:stop_idx + 1])
-
-        # count
-        bag_count += int(answer == prediction)
-        element_count += len(answer.intersection(prediction))
-        total_element += length
-
-    # get accuracy
-    element_accuracy = element_count / total_element * 100
-    bag_accuracy = bag_count / decoded_result.shape[0] * 100
-
-    return element_accuracy, bag_accuracy
-
-
-def get_correct_reactant_bags_batch(decoded_dict: dict, answer_dict: dict, dtype, device):
-    max_step = len(decoded_dict)
-    decoded_result = torch.empty(size=(max_step, decoded_dict[0].shape[0]), dtype=dtype, device=device).cpu().numpy()
-    stop_embedding_idx = answer_dict[0][-1]
-    # get decoded results
-    for step in range(max_step):
-        decoded_result[step, :] = decoded_dict[step].clone().cpu().numpy()
-    decoded_result = np.transpose(decoded_result)
-
-    # count correctly encoded monomer bags
-    bag_count = 0
-    for key in range(len(answer_dict)):
-        answer = set(answer_dict[key])
-        stop_bool = decoded_result[key] == stop_embedding_idx
-
-        # find stop index
-        stop_idx = max_step - 1
-        for idx, value in enumerate(stop_bool):
-            if value:
-                stop_idx = idx
-                break
-        prediction = set(decoded_result[key][:stop_idx + 1])
-
-        # count
-        bag_count += int(answer == prediction)
-
-    return bag_count
-
-
-def get_correct_reactant_bags_batch_error_analysis(decoded_dict: dict, answer_dict: dict, dtype, device):
-    max_step = len(decoded_dict)
-    decoded_result = torch.empty(size=(max_step, decoded_dict[0].shape[0]), dtype=dtype, device=device).cpu().numpy()
-    stop_embedding_idx = answer_dict[0][-1]
-    # get decoded results
-    for step in range(max_step):
-        decoded_result[step, :] = decoded_dict[step].clone().cpu().numpy()
-    decoded_result = np.transpose(decoded_result)
-
-    # right bags
-    right_idx = []
-
-    # count correctly encoded monomer bags
-    bag_count = 0
-    for key in range(len(answer_dict)):
-        answer = set(answer_dict[key])
-        stop_bool = decoded_result[key] == stop_embedding_idx
-
-        # find stop index
-        stop_idx = max_step - 1
-        for idx, value in enumerate(stop_bool):
-            if value:
-                stop_idx = idx
-                break
-        prediction = set(decoded_result[key][:stop_idx + 1])
-
-        # count
-        bag_count += int(answer == prediction)
-
-        if answer == prediction:
-            # append
-            right_idx.append(key)
-
-    return bag_count, right_idx
-
-
-def get_accuracy_check(decoded_dict: dict, answer_dict: dict, dtype, device):
-    max_step = len(decoded_dict)
-    decoded_result = torch.empty(size=(max_step, decoded_dict[0].shape[0]), dtype=dtype, device=device).cpu().numpy()
-    stop_embedding_idx = answer_dict[0][-1]
-    # get decoded results
-    for step in range(max_step):
-        decoded_result[step, :] = decoded_dict[step].clone().cpu().numpy()
-    decoded_result = np.transpose(decoded_result)
-
-    # count correctly encoded monomer bags
-    bag_count = 0
-    element_count = 0
-    total_element = 0
-    for key in range(len(answer_dict)):
-        length = len(answer_dict[key])
-        answer = set(answer_dict[key])
-        stop_bool = decoded_result[key] == stop_embedding_idx
-
-        # find stop index
-        stop_idx = max_step - 1
-        for idx, value in enumerate(stop_bool):
-            if value:
-                stop_idx = idx
-                break
-        prediction = set(decoded_result[key][:stop_idx + 1])
-
-        # count
-        bag_count += int(answer == prediction)
-        element_count += len(answer.intersection(prediction))
-        total_element += length
-
-    # get accuracy
-    element_accuracy = element_count / total_element * 100
-    bag_accuracy = bag_count / decoded_result.shape[0] * 100
-
-    return element_accuracy, bag_accuracy
-
-
-def get_maximum_mean_discrepancy(posterior_z_samples: torch.Tensor):
+def get_monomer_to_idx(unique_monomer_sets):
     """
-    Detailed explanation is in: https://www.kaggle.com/onurtunali/maximum-mean-discrepancy
-    Prior distribution is assumed to be a multi-variate Gaussian
-    MMD is a symmetric distance between samples from two different probability distributions,
-    i.e. MMD(P, Q) = MMD(Q, P)
-    Also refer to Wasserstein Auto-Encoders by Tolstikhin et al (2017).
+    SMILES -> index in unique_monomer_sets (the stop index is len(unique_monomer_sets))
     """
-    # set dtype and device
-    dtype = posterior_z_samples.dtype
-    device = posterior_z_samples.device
-
-    # set dimension and number of samples
-    latent_dimension = posterior_z_samples.shape[1]
-    number_of_samples = posterior_z_samples.shape[0]
-
-    # get prior samples
-    gaussian_sampler = MultivariateNormal(
-        loc=torch.zeros(latent_dimension, dtype=dtype, device=device),
-        covariance_matrix=torch.eye(n=latent_dimension, dtype=dtype, device=device)
-    )
-    prior_z_samples = gaussian_sampler.sample(sample_shape=(number_of_samples,))
-
-    # calculate Maximum Mean Discrepancy with inverse multi-quadratics kernel
-    # set value of c - refer to Sec.4 of Wasserstein paper
-    c = 2 * latent_dimension * (1.0**2)
-
-    # calculate pp term (p means prior)
-    pp = torch.mm(prior_z_samples, prior_z_samples.t())
-    pp_diag = pp.diag().unsqueeze(0).expand_as(pp)
-    kernel_pp = c / (c + pp_diag + pp_diag.t() - 2 * pp)
-    kernel_pp = (torch.sum(kernel_pp) - number_of_samples) / (number_of_samples * (number_of_samples - 1))
+    return {monomer: idx for idx, monomer in enumerate(unique_monomer_sets)}
 
-    # calculate qq term (q means posterior)
-    qq = torch.mm(posterior_z_samples, posterior_z_samples.t())
-    qq_diag = qq.diag().unsqueeze(0).expand_as(qq)
-    kernel_qq = c / (c + qq_diag + qq_diag.t() - 2 * qq)
-    kernel_qq = (torch.sum(kernel_qq) - number_of_samples) / (number_of_samples * (number_of_samples - 1))
 
-    # calculate pq term
-    pq = pp_diag.t() - torch.mm(prior_z_samples, posterior_z_samples.t()) \
-        - torch.mm(posterior_z_samples, prior_z_samples.t()) + qq_diag
-    kernel_pq = -2 * torch.sum(c / (c + pq)) / number_of_samples**2
-
-    mmd = kernel_pp + kernel_qq + kernel_pq
-
-    return mmd
+def get_answer_array(monomer_bags, monomer_to_idx: dict):
+    """
+    Answer monomer indices of monomer_bags (SMILES) as an int32 array [num_bags, max bag size + 1] padded with the stop
+    index len(monomer_to_idx), and the answer lengths (stop included) [num_bags].
+    Each row is the answer dict entry [monomer indices, stop_idx] (see MoleculeChef.get_answer_dict).
+    """
+    stop_idx = len(monomer_to_idx)
+    bag_sizes = np.fromiter((len(monomer_bag) for monomer_bag in monomer_bags), dtype=NP_LONG, count=len(monomer_bags))
+    monomer_idx = np.fromiter(
+        (monomer_to_idx[monomer] for monomer_bag in monomer_bags for monomer in monomer_bag), dtype=NP_ANSWER,
+        count=int(bag_sizes.sum())
+    )
 
+    # scatter the monomer indices of each bag to the start of its row
+    answer_array = np.full([len(monomer_bags), int(bag_sizes.max(initial=0)) + 1], stop_idx, dtype=NP_ANSWER)
+    row_idx = np.repeat(np.arange(len(monomer_bags)), bag_sizes)
+    column_idx = np.arange(monomer_idx.shape[0]) - np.repeat(np.cumsum(bag_sizes) - bag_sizes, bag_sizes)
+    answer_array[row_idx, column_idx] = monomer_idx
 
-def estimate_maximum_mean_discrepancy(posterior_z_samples: torch.Tensor):
-    # https://stats.stackexchange.com/questions/276497/maximum-mean-discrepancy-distance-distribution
-    # set dtype and device
-    dtype = posterior_z_samples.dtype
-    device = posterior_z_samples.device
+    return answer_array, (bag_sizes + 1).astype(NP_ANSWER)
 
-    # set dimension and number of samples
-    latent_dimension = posterior_z_samples.shape[1]
-    number_of_samples = posterior_z_samples.shape[0]
 
-    # get prior samples
-    prior_z_samples = torch.randn(size=(number_of_samples, latent_dimension), device=device, dtype=dtype)
-    # gaussian_sampler = MultivariateNormal(
-    #     loc=torch.zeros(latent_dimension, dtype=dtype, device=device),
-    #     covariance_matrix=torch.eye(n=latent_dimension, dtype=dtype, device=device)
-    # )
-    # prior_z_samples = gaussian_sampler.sample(sample_shape=(number_of_samples,))
+def answer_dict_to_array(answer_dict: dict, monomer_bag_idx=None):
+    """
+    Answer array and lengths (see get_answer_array) of the bags monomer_bag_idx (default: all) of answer_dict
+    {bag: [monomer indices, stop_idx]}
+    """
+    if monomer_bag_idx is None:
+        monomer_bag_idx = range(len(answer_dict))
+    answers = [answer_dict[idx_of_bag] for idx_of_bag in monomer_bag_idx]
+    answer_length = np.array([len(answer) for answer in answers], dtype=NP_ANSWER)
 
-    # calculate Maximum Mean Discrepancy with inverse multi-quadratics kernel
-    # set value of c - refer to Sec.4 of Wasserstein paper
-    c = 2 * latent_dimension * (1.0**2)
+    stop_idx = answers[0][-1]
+    answer_array = np.full([len(answers), int(answer_length.max())], stop_idx, dtype=NP_ANSWER)
+    for idx, answer in enumerate(answers):
+        answer_array[idx, :len(answer)] = answer
 
-    # calculate pp term (p means prior)
-    pp = torch.mm(prior_z_samples, prior_z_samples.t())
-    pp_diag = pp.diag().unsqueeze(0).expand_as(pp)
+    return answer_array, answer_length
 
-    # calculate qq term (q means posterior)
-    qq = torch.mm(posterior_z_samples, posterior_z_samples.t())
-    qq_diag = qq.diag().unsqueeze(0).expand_as(qq)
 
-    # calculate pq term (q means posterior)
-    pq = torch.mm(prior_z_samples, posterior_z_samples.t())
+def get_monomer_bags_idx_tensor(answer_dict: dict, device=None):
+    """
+    Monomer indices of the bags in answer_dict {bag: [monomer indices, stop_idx]} as one tensor [num_bags, max length],
+    padded with stop_idx. Built once per dataset; index the rows of a batch.
+    """
+    answer_array, _ = answer_dict_to_array(answer_dict)
 
-    # calculate kernel
-    kernel_pp = torch.mean(c / (c + pp_diag + pp_diag.t() - 2 * pp))
-    kernel_qq = torch.mean(c / (c + qq_diag + qq_diag.t() - 2 * qq))
-    kernel_pq = torch.mean(c / (c + qq_diag + pp_diag.t() - 2 * pq))
+    return torch.from_numpy(answer_array).to(device=device, dtype=torch.long)
 
-    # estimate mmd
-    mmd = kernel_pp + kernel_qq - 2*kernel_pq
 
-    return mmd
+def get_monomer_bags_graph_embedding_tensor(all_monomers_graph_embedding_tensor, monomer_bags_idx_tensor):
+    """
+    Sum of the monomer graph embeddings of each bag [b, graph_embedding]. The stop embedding (last) pads
+    monomer_bags_idx_tensor [b, max length] and is not summed (no gradient either).
+    """
+    return f.embedding_bag(
+        input=monomer_bags_idx_tensor, weight=all_monomers_graph_embedding_tensor, mode='sum',
+        padding_idx=all_monomers_graph_embedding_tensor.shape[0] - 1
+    )
 
 
 def preprocess_df(file):
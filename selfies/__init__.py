@@ -35,15 +35,22 @@ __version__ = "2.0.0"
 __all__ = [
     "encoder",
     "decoder",
+    "batch_encoder",
+    "batch_decoder",
     "get_preset_constraints",
     "get_semantic_robust_alphabet",
     "get_semantic_constraints",
     "set_semantic_constraints",
+    "warm_symbol_caches",
     "len_selfies",
     "split_selfies",
+    "tokenize_selfies",
+    "SymbolTable",
     "get_alphabet_from_selfies",
     "selfies_to_encoding",
     "batch_selfies_to_flat_hot",
+    "batch_selfies_to_label_array",
+    "batch_selfies_to_hot_array",
     "encoding_to_selfies",
     "batch_flat_hot_to_selfies",
     "EncoderError",
@@ -59,14 +66,20 @@ from .bond_constraints import (
 from .decoder import decoder
 from .encoder import encoder
 from .exceptions import DecoderError, EncoderError
+from .grammar_rules import warm_symbol_caches
+from .utils.batch_utils import batch_decoder, batch_encoder
 from .utils.encoding_utils import (
     batch_flat_hot_to_selfies,
     batch_selfies_to_flat_hot,
+    batch_selfies_to_hot_array,
+    batch_selfies_to_label_array,
     encoding_to_selfies,
     selfies_to_encoding
 )
 from .utils.selfies_utils import (
+    SymbolTable,
     get_alphabet_from_selfies,
     len_selfies,
-    split_selfies
+    split_selfies,
+    tokenize_selfies
 )
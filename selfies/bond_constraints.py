@@ -2,7 +2,7 @@ import functools
 from itertools import product
 from typing import Dict, Set, Union
 
-from selfies.constants import ELEMENTS, INDEX_ALPHABET
+from selfies.constants import ASTERISK, ELEMENTS, INDEX_ALPHABET
 
 _DEFAULT_CONSTRAINTS = {
     "H": 1, "F": 1, "Cl": 1, "Br": 1, "I": 1,
@@ -122,7 +122,7 @@ def set_semantic_constraints(
 
             # error checking for keys
             j = max(key.find("+"), key.find("-"))
-            if key == "?":
+            if key == "?" or key in ASTERISK:
                 valid = True
             elif j == -1:
                 valid = (key in ELEMENTS)
@@ -147,6 +147,11 @@ def set_semantic_constraints(
     get_semantic_robust_alphabet.cache_clear()
     get_bonding_capacity.cache_clear()
 
+    # decoded strings depend on the constraints (imported here to avoid
+    # a circular import)
+    from selfies.decoder import _decode_memoized
+    _decode_memoized.cache_clear()
+
 
 @functools.lru_cache()
 def get_semantic_robust_alphabet() -> Set[str]:
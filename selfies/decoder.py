@@ -1,4 +1,5 @@
 import warnings
+from functools import lru_cache
 from typing import List, Union, Tuple
 
 from selfies.compatibility import modernize_symbol
@@ -13,7 +14,7 @@ from selfies.grammar_rules import (
     process_ring_symbol
 )
 from selfies.mol_graph import MolecularGraph, Attribution
-from selfies.utils.selfies_utils import split_selfies
+from selfies.utils.selfies_utils import split_selfies, tokenize_selfies
 from selfies.utils.smiles_utils import mol_to_smiles
 
 
@@ -40,6 +41,11 @@ def decoder(
     :return: a SMILES string derived from the input SELFIES string.
     :raises DecoderError: if the input SELFIES string is malformed.
 
+    .. note::
+        When both ``compatible`` and ``attribute`` are ``False``, decoded
+        strings are memoized, and the memo is cleared whenever the
+        semantic constraints are changed.
+
     :Example:
 
     >>> import selfies as sf
@@ -51,7 +57,18 @@ def decoder(
         msg = "\nselfies.decoder() may behave differently than in previous " \
               "major releases. We recommend using SELFIES that are up to date."
         warnings.warn(msg, stacklevel=2)
+    elif not attribute:
+        return _decode_memoized(selfies)
+
+    return _decode(selfies, compatible, attribute)
+
+
+@lru_cache(maxsize=2 ** 16)
+def _decode_memoized(selfies):
+    return _decode(selfies, compatible=False, attribute=False)
 
+
+def _decode(selfies, compatible, attribute):
     mol = MolecularGraph(attributable=attribute)
 
     rings = []
@@ -74,14 +91,17 @@ def decoder(
 
 
 def _tokenize_selfies(selfies, compatible):
-    if isinstance(selfies, str):
-        symbol_iter = split_selfies(selfies)
-    elif isinstance(selfies, list):
-        symbol_iter = selfies
-    else:
+    if not isinstance(selfies, (str, list)):
         raise ValueError()  # should not happen
 
     try:
+        if isinstance(selfies, list):
+            symbol_iter = selfies
+        elif compatible:
+            symbol_iter = split_selfies(selfies)
+        else:
+            symbol_iter = tokenize_selfies(selfies)
+
         for symbol in symbol_iter:
             if symbol == "[nop]":
                 continue
@@ -167,23 +187,20 @@ def _derive_mol_from_symbols(
             if bond_order == 0:
                 if state == 0:
                     o = mol.add_atom(atom, True)
-                    mol.add_attribution(
-                        o,  attribute_stack +
-                        [Attribution(index + attribution_index, symbol)]
-                        if attribute_stack is not None else None)
+                    if attribute_stack is not None:
+                        mol.add_attribution(o, attribute_stack + [
+                            Attribution(index + attribution_index, symbol)])
             else:
                 o = mol.add_atom(atom)
-                mol.add_attribution(
-                    o, attribute_stack +
-                    [Attribution(index + attribution_index, symbol)]
-                    if attribute_stack is not None else None)
+                if attribute_stack is not None:
+                    mol.add_attribution(o, attribute_stack + [
+                        Attribution(index + attribution_index, symbol)])
                 src, dst = prev_atom.index, atom.index
                 o = mol.add_bond(src=src, dst=dst,
                                  order=bond_order, stereo=stereo)
-                mol.add_attribution(
-                    o, attribute_stack +
-                    [Attribution(index + attribution_index, symbol)]
-                    if attribute_stack is not None else None)
+                if attribute_stack is not None:
+                    mol.add_attribution(o, attribute_stack + [
+                        Attribution(index + attribution_index, symbol)])
             prev_atom = atom
 
         if next_state is None:
@@ -1,7 +1,7 @@
 import functools
 import itertools
 import re
-from typing import Any, List, Optional, Tuple
+from typing import Any, Iterable, List, Optional, Tuple
 
 from selfies.constants import (
     ELEMENTS,
@@ -18,10 +18,9 @@ def process_atom_symbol(symbol: str) -> Optional[Tuple[Any, Atom]]:
     try:
         output = _PROCESS_ATOM_CACHE[symbol]
     except KeyError:
-        output = _process_atom_selfies_no_cache(symbol)
-        if output is None:
-            return None
-        _PROCESS_ATOM_CACHE[symbol] = output
+        output = _process_atom_symbol_lazy(symbol)
+    if output is None:
+        return None  # invalid symbols are cached too
 
     bond_info, atom_fac = output
     atom = atom_fac()
@@ -44,6 +43,30 @@ def process_ring_symbol(symbol: str) -> Optional[Tuple[int, int, Any]]:
         return None
 
 
+def warm_symbol_caches(alphabet: Iterable[str]) -> None:
+    """Pre-populates the symbol caches that :func:`selfies.decoder` uses
+    with the symbols of an alphabet (e.g. the alphabet of a dataset).
+
+    Pre-populated symbols stay cached. Other atom symbols are cached
+    lazily on their first occurrence, keeping a bounded number of the most
+    recently used symbols. Branch and ring symbols are always fully cached.
+
+    :param alphabet: an iterable of SELFIES symbols.
+    :return: ``None``.
+
+    :Example:
+
+    >>> import selfies as sf
+    >>> sf.warm_symbol_caches(["[C]", "[/*]", "[Branch1]", "[nop]"])
+    """
+
+    for symbol in alphabet:
+        if symbol in _PROCESS_BRANCH_CACHE or symbol in _PROCESS_RING_CACHE:
+            continue
+        if symbol not in _PROCESS_ATOM_CACHE:
+            _PROCESS_ATOM_CACHE[symbol] = _process_atom_selfies_no_cache(symbol)
+
+
 def next_atom_state(
         bond_order: int, bond_cap: int, state: int
 ) -> Tuple[int, Optional[int]]:
@@ -177,6 +200,12 @@ def _process_atom_selfies_no_cache(symbol):
     return smiles_to_bond(bond_char), atom_fac
 
 
+@functools.lru_cache(maxsize=4096)
+def _process_atom_symbol_lazy(symbol):
+    # symbols outside _PROCESS_ATOM_CACHE (invalid symbols are cached as None)
+    return _process_atom_selfies_no_cache(symbol)
+
+
 def _build_atom_cache():
     cache = dict()
     common_symbols = [
@@ -185,7 +214,8 @@ def _build_atom_cache():
         "[=C]", "[=N+1]", "[=N-1]", "[=N]", "[=O+1]", "[=O]", "[=P+1]",
         "[=P-1]", "[=P]", "[=S+1]", "[=S-1]", "[=S]", "[Br]", "[C+1]", "[C-1]",
         "[C]", "[Cl]", "[F]", "[H]", "[I]", "[N+1]", "[N-1]", "[N]", "[O+1]",
-        "[O-1]", "[O]", "[P+1]", "[P-1]", "[P]", "[S+1]", "[S-1]", "[S]", "[*]"
+        "[O-1]", "[O]", "[P+1]", "[P-1]", "[P]", "[S+1]", "[S-1]", "[S]", "[*]",
+        "[/*]", "[\\*]", "[=*]", "[#*]"
     ]
 
     for symbol in common_symbols:
@@ -222,6 +252,8 @@ def _build_ring_cache():
     return cache
 
 
+# common symbols and symbols of warm_symbol_caches (not bounded); other
+# atom symbols are cached by _process_atom_symbol_lazy (LRU)
 _PROCESS_ATOM_CACHE = _build_atom_cache()
 
 _PROCESS_BRANCH_CACHE = _build_branch_cache()
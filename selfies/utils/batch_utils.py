@@ -0,0 +1,160 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+
+from selfies.bond_constraints import (
+    get_semantic_constraints,
+    set_semantic_constraints
+)
+from selfies.decoder import decoder
+from selfies.encoder import encoder
+from selfies.exceptions import DecoderError, EncoderError
+
+BatchResult = Union[
+    List[Optional[str]],
+    Tuple[List[Optional[str]], List[Tuple[int, Exception]]]
+]
+
+
+def batch_encoder(
+        smiles_iter: Iterable[str],
+        strict: bool = True,
+        n_jobs: Optional[int] = 1,
+        chunk_size: int = 1000,
+        return_errors: bool = False
+) -> BatchResult:
+    """Translates an iterable of SMILES strings into SELFIES strings.
+
+    Each SMILES string is translated with :func:`selfies.encoder`. The input
+    is split into chunks of ``chunk_size`` strings, which are translated
+    in a pool of ``n_jobs`` worker processes. An error raised by a single
+    SMILES string does not abort the batch; instead, the corresponding
+    output is ``None``. The order of the input is preserved.
+
+    :param smiles_iter: an iterable of SMILES strings to be translated.
+    :param strict: passed to :func:`selfies.encoder`. Defaults to ``True``.
+    :param n_jobs: the number of worker processes. If ``None``, then
+        all available CPUs are used. If ``1``, then the strings are
+        translated in the calling process. Defaults to ``1``.
+    :param chunk_size: the number of strings sent to a worker at a time.
+        Defaults to ``1000``.
+    :param return_errors: if ``True``, then a tuple of the outputs and a list
+        of ``(index, error)`` pairs of the failed inputs is returned.
+        Defaults to ``False``.
+    :return: a list of SELFIES strings (``None`` for inputs that failed to
+        be translated), and optionally the list of errors.
+
+    :Example:
+
+    >>> import selfies as sf
+    >>> sf.batch_encoder(["C=CF", "C1"])
+    ['[C][=C][F]', None]
+    """
+
+    return _run_batch(_encode_chunk, list(smiles_iter), (strict,),
+                      n_jobs, chunk_size, return_errors)
+
+
+def batch_decoder(
+        selfies_iter: Iterable[str],
+        compatible: bool = False,
+        n_jobs: Optional[int] = 1,
+        chunk_size: int = 1000,
+        return_errors: bool = False
+) -> BatchResult:
+    """Translates an iterable of SELFIES strings into SMILES strings.
+
+    Each SELFIES string is translated with :func:`selfies.decoder`.
+    Chunking, error capture and ordering follow
+    :func:`selfies.batch_encoder`.
+
+    :param selfies_iter: an iterable of SELFIES strings to be translated.
+    :param compatible: passed to :func:`selfies.decoder`.
+        Defaults to ``False``.
+    :param n_jobs: the number of worker processes. If ``None``, then
+        all available CPUs are used. If ``1``, then the strings are
+        translated in the calling process. Defaults to ``1``.
+    :param chunk_size: the number of strings sent to a worker at a time.
+        Defaults to ``1000``.
+    :param return_errors: if ``True``, then a tuple of the outputs and a list
+        of ``(index, error)`` pairs of the failed inputs is returned.
+        Defaults to ``False``.
+    :return: a list of SMILES strings (``None`` for inputs that failed to
+        be translated), and optionally the list of errors.
+
+    :Example:
+
+    >>> import selfies as sf
+    >>> sf.batch_decoder(["[C][=C][F]", "[C][Xx]"])
+    ['C=CF', None]
+    """
+
+    return _run_batch(_decode_chunk, list(selfies_iter), (compatible,),
+                      n_jobs, chunk_size, return_errors)
+
+
+def _encode_chunk(chunk, strict):
+    outputs = []
+    for smiles in chunk:
+        try:
+            outputs.append((encoder(smiles, strict=strict), None))
+        except EncoderError as err:
+            outputs.append((None, err))
+        except Exception as err:  # e.g. a non-string entry
+            outputs.append((None, EncoderError(
+                "{}: {}\n\tSMILES: {}".format(type(err).__name__, err, smiles)
+            )))
+    return outputs
+
+
+def _decode_chunk(chunk, compatible):
+    outputs = []
+    for selfies in chunk:
+        try:
+            outputs.append((decoder(selfies, compatible=compatible), None))
+        except DecoderError as err:
+            outputs.append((None, err))
+        except Exception as err:  # e.g. a non-string entry
+            outputs.append((None, DecoderError(
+                "{}: {}\n\tSELFIES: {}".format(type(err).__name__, err, selfies)
+            )))
+    return outputs
+
+
+def _run_batch(
+        chunk_fn: Callable, items: List[Any], args: Tuple,
+        n_jobs: Optional[int], chunk_size: int, return_errors: bool
+) -> BatchResult:
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs < 1:
+        raise ValueError("n_jobs must be a positive integer or None")
+
+    chunks = [items[i: i + chunk_size]
+              for i in range(0, len(items), chunk_size)]
+    n_jobs = min(n_jobs, len(chunks))
+
+    if n_jobs <= 1:
+        chunk_outputs = [chunk_fn(chunk, *args) for chunk in chunks]
+    else:
+        # workers must see the semantic constraints of the calling process
+        with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=set_semantic_constraints,
+                initargs=(get_semantic_constraints(),)
+        ) as executor:
+            chunk_outputs = list(executor.map(
+                chunk_fn, chunks, *[[a] * len(chunks) for a in args]
+            ))
+
+    results = []
+    errors = []
+    for chunk in chunk_outputs:
+        for output, err in chunk:
+            if err is not None:
+                errors.append((len(results), err))
+            results.append(output)
+
+    return (results, errors) if return_errors else results
@@ -1,6 +1,6 @@
-from typing import Dict, List, Tuple, Union
+from typing import Any, Dict, List, Tuple, Union
 
-from selfies.utils.selfies_utils import len_selfies, split_selfies
+from selfies.utils.selfies_utils import tokenize_selfies
 
 
 def selfies_to_encoding(
@@ -42,13 +42,13 @@ def selfies_to_encoding(
     if enc_type not in ("label", "one_hot", "both"):
         raise ValueError("enc_type must be in ('label', 'one_hot', 'both')")
 
-    # pad with [nop]
-    if pad_to_len > len_selfies(selfies):
-        selfies += "[nop]" * (pad_to_len - len_selfies(selfies))
-
     # integer encode
-    char_list = split_selfies(selfies)
-    integer_encoded = [vocab_stoi[char] for char in char_list]
+    integer_encoded = [vocab_stoi[char] for char in tokenize_selfies(selfies)]
+
+    # pad with [nop]
+    if pad_to_len > len(integer_encoded):
+        integer_encoded += \
+            [vocab_stoi["[nop]"]] * (pad_to_len - len(integer_encoded))
 
     if enc_type == "label":
         return integer_encoded
@@ -194,3 +194,136 @@ def batch_flat_hot_to_selfies(
         selfies_list.append(selfies)
 
     return selfies_list
+
+
+def batch_selfies_to_label_array(
+        selfies_batch: List[str],
+        vocab_stoi: Dict[str, int],
+        pad_to_len: int = -1,
+        dtype: Any = None,
+        out: Any = None,
+        return_lengths: bool = False
+) -> Any:
+    """Converts a list of SELFIES strings into a 2D NumPy array of
+    label (integer) encodings.
+
+    Each SELFIES string is tokenized once, and all symbols of the batch are
+    mapped to their indices and scattered into a single array of shape
+    ``(N, L)``, where ``N`` is the number of SELFIES strings and ``L`` is
+    the larger of ``pad_to_len`` and the longest symbol length in the batch.
+    Shorter SELFIES strings are padded with ``[nop]``.
+
+    :param selfies_batch: the list of SELFIES strings to be encoded.
+    :param vocab_stoi: a dictionary that maps SELFIES symbols to indices.
+        If any SELFIES string is padded, then the special padding symbol
+        ``[nop]`` must also be a key in this dictionary.
+    :param pad_to_len: the length that each SELFIES string in the input list
+        is padded to. Defaults to ``-1``.
+    :param dtype: the NumPy dtype of the output. Defaults to ``int32``.
+    :param out: an optional array of shape ``(N, L)`` that the encodings
+        are written into, so that a buffer can be reused across batches.
+    :param return_lengths: if ``True``, then a tuple of the encodings and
+        the symbol lengths of the (unpadded) SELFIES strings is returned.
+        Defaults to ``False``.
+    :return: the label encodings of the input list.
+
+    :Example:
+
+    >>> import selfies as sf
+    >>> batch = ["[C]", "[C][F]"]
+    >>> vocab_stoi = {"[nop]": 0, "[C]": 1, "[F]": 2}
+    >>> sf.batch_selfies_to_label_array(batch, vocab_stoi).tolist()
+    [[1, 0], [1, 2]]
+    """
+
+    import numpy as np
+
+    symbols_batch = [tokenize_selfies(s) for s in selfies_batch]
+    lengths = np.fromiter(map(len, symbols_batch), dtype=np.int64,
+                          count=len(symbols_batch))
+    max_len = max(pad_to_len, int(lengths.max(initial=0)))
+    shape = (len(symbols_batch), max_len)
+
+    if out is None:
+        out = np.empty(shape, dtype=np.int32 if dtype is None else dtype)
+    elif out.shape != shape:
+        raise ValueError("out has shape {}, but {} is required"
+                         .format(out.shape, shape))
+
+    if (lengths < max_len).any():
+        out[...] = vocab_stoi["[nop]"]
+
+    # scatter all symbols of the batch at once
+    flat_labels = np.fromiter(
+        (vocab_stoi[symbol] for symbols in symbols_batch for symbol in symbols),
+        dtype=np.int64, count=int(lengths.sum())
+    )
+    rows = np.repeat(np.arange(shape[0]), lengths)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cols = np.arange(flat_labels.shape[0]) - offsets
+    out[rows, cols] = flat_labels
+
+    return (out, lengths) if return_lengths else out
+
+
+def batch_selfies_to_hot_array(
+        selfies_batch: List[str],
+        vocab_stoi: Dict[str, int],
+        pad_to_len: int = -1,
+        flatten: bool = False,
+        dtype: Any = None,
+        out: Any = None
+) -> Any:
+    """Converts a list of SELFIES strings into a NumPy array of
+    one-hot encodings.
+
+    The label encodings are computed with
+    :func:`selfies.batch_selfies_to_label_array` and scattered into an array
+    of shape ``(N, L, len(vocab_stoi))`` by fancy indexing. If ``flatten``
+    is ``True``, then an array of shape ``(N, L * len(vocab_stoi))`` is
+    returned instead, like :func:`selfies.batch_selfies_to_flat_hot`.
+
+    :param selfies_batch: the list of SELFIES strings to be encoded.
+    :param vocab_stoi: a dictionary that maps SELFIES symbols to indices,
+        which must be non-negative and contiguous, starting from 0.
+    :param pad_to_len: the length that each SELFIES string in the input list
+        is padded to. Defaults to ``-1``.
+    :param flatten: if ``True``, then the one-hot encoding of each SELFIES
+        string is flattened. Defaults to ``False``.
+    :param dtype: the NumPy dtype of the output. Defaults to ``uint8``.
+    :param out: an optional array of the output shape that the encodings
+        are written into, so that a buffer can be reused across batches.
+    :return: the one-hot encodings of the input list.
+
+    :Example:
+
+    >>> import selfies as sf
+    >>> batch = ["[C]", "[C][C]"]
+    >>> vocab_stoi = {"[nop]": 0, "[C]": 1}
+    >>> sf.batch_selfies_to_hot_array(batch, vocab_stoi, 2, flatten=True)
+    array([[0, 1, 1, 0],
+           [0, 1, 0, 1]], dtype=uint8)
+    """
+
+    import numpy as np
+
+    labels = batch_selfies_to_label_array(selfies_batch, vocab_stoi,
+                                          pad_to_len, dtype=np.int64)
+    n, max_len = labels.shape
+    shape = (n, max_len, len(vocab_stoi))
+
+    if out is None:
+        out = np.zeros(shape, dtype=np.uint8 if dtype is None else dtype)
+    else:
+        expected = (n, max_len * len(vocab_stoi)) if flatten else shape
+        if out.shape != expected:
+            raise ValueError("out has shape {}, but {} is required"
+                             .format(out.shape, expected))
+        out[...] = 0
+
+    one_hot = out.reshape(shape)  # a view of out
+    one_hot[np.arange(n)[:, None], np.arange(max_len)[None, :], labels] = 1
+
+    if flatten:
+        return one_hot.reshape(n, -1)
+    return one_hot
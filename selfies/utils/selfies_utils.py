@@ -1,4 +1,13 @@
-from typing import Iterable, Iterator, Set
+import re
+import sys
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+# a well-formed SELFIES string is a sequence of bracketed symbols, each
+# optionally followed by a dot; for such strings, the matches of _SYMBOL_RE
+# are exactly the symbols yielded by split_selfies
+_WELL_FORMED_RE = re.compile(r"(?:\[[^\]]*\]\.?)*")
+_SYMBOL_RE = re.compile(r"\[[^\]]*\]|\.")
 
 
 def len_selfies(selfies: str) -> int:
@@ -46,6 +55,151 @@ def split_selfies(selfies: str) -> Iterator[str]:
             left_idx += 1
 
 
+@lru_cache(maxsize=2 ** 16)
+def tokenize_selfies(selfies: str) -> Tuple[str, ...]:
+    """Tokenizes a SELFIES string into a tuple of its individual symbols.
+
+    Unlike :func:`selfies.split_selfies`, the SELFIES string is tokenized in
+    a single pass with a precompiled regular expression, and the symbols are
+    interned (see :func:`sys.intern`). The results are memoized, so that
+    tokenizing the same SELFIES string again is a cache lookup. Strings that
+    are not well-formed are tokenized with :func:`selfies.split_selfies`.
+
+    :param selfies: a SELFIES string.
+    :return: the symbols of the SELFIES string, with order preserved.
+
+    :Example:
+
+    >>> import selfies as sf
+    >>> sf.tokenize_selfies("[C][=C][F].[C]")
+    ('[C]', '[=C]', '[F]', '.', '[C]')
+    """
+
+    if _WELL_FORMED_RE.fullmatch(selfies):
+        symbols = _SYMBOL_RE.findall(selfies)
+    else:
+        symbols = split_selfies(selfies)
+    return tuple(map(sys.intern, symbols))
+
+
+class SymbolTable:
+    """An interned mapping between SELFIES symbols and contiguous indices,
+    starting from 0.
+
+    :param symbols: an iterable of SELFIES symbols, which are assigned
+        indices in order of first appearance. Defaults to an empty table.
+
+    :Example:
+
+    >>> import selfies as sf
+    >>> table = sf.SymbolTable(["[nop]", "[C]"])
+    >>> table.encode("[C][F]", grow=True)
+    ([1, 2], 2)
+    >>> table.encode("[C]", pad_to_len=3)
+    ([1, 0, 0], 1)
+    >>> table.itos
+    ['[nop]', '[C]', '[F]']
+    """
+
+    def __init__(self, symbols: Iterable[str] = ()):
+        self._stoi = dict()
+        self._itos = list()
+        for symbol in symbols:
+            self.add(symbol)
+
+    @classmethod
+    def from_selfies(cls, selfies_iter: Iterable[str]) -> "SymbolTable":
+        """Builds a symbol table from the symbols of an iterable of
+        SELFIES strings, in order of first appearance.
+
+        :param selfies_iter: an iterable of SELFIES strings.
+        :return: the symbol table.
+        """
+
+        table = cls()
+        for selfies in selfies_iter:
+            table.update(tokenize_selfies(selfies))
+        return table
+
+    @property
+    def stoi(self) -> Dict[str, int]:
+        """The dictionary that maps symbols to indices."""
+        return self._stoi
+
+    @property
+    def itos(self) -> List[str]:
+        """The list of symbols, ordered by index."""
+        return self._itos
+
+    def __len__(self) -> int:
+        return len(self._itos)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._stoi
+
+    def __getitem__(self, symbol: str) -> int:
+        return self._stoi[symbol]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._itos)
+
+    def add(self, symbol: str) -> int:
+        """Adds a symbol to the table, if it is not already present.
+
+        :param symbol: a SELFIES symbol.
+        :return: the index of the symbol.
+        """
+
+        idx = self._stoi.get(symbol)
+        if idx is None:
+            symbol = sys.intern(symbol)
+            idx = len(self._itos)
+            self._stoi[symbol] = idx
+            self._itos.append(symbol)
+        return idx
+
+    def update(self, symbols: Iterable[str]) -> None:
+        """Adds each symbol of an iterable to the table.
+
+        :param symbols: an iterable of SELFIES symbols.
+        :return: ``None``.
+        """
+
+        stoi = self._stoi
+        for symbol in symbols:
+            if symbol not in stoi:
+                self.add(symbol)
+
+    def encode(
+            self,
+            selfies: str,
+            pad_to_len: int = -1,
+            grow: bool = False
+    ) -> Tuple[List[int], int]:
+        """Label encodes a SELFIES string, tokenizing it only once.
+
+        :param selfies: the SELFIES string to be encoded.
+        :param pad_to_len: the length that the encoding is padded to with
+            the index of ``[nop]``, which must then be in the table.
+            Defaults to ``-1``.
+        :param grow: if ``True``, then symbols that are not in the table
+            are added to it. Otherwise, a ``KeyError`` is raised for such
+            symbols. Defaults to ``False``.
+        :return: a tuple of the label encoding and the symbol length of the
+            (unpadded) SELFIES string.
+        """
+
+        symbols = tokenize_selfies(selfies)
+        if grow:
+            self.update(symbols)
+        stoi = self._stoi
+        ids = [stoi[symbol] for symbol in symbols]
+        length = len(ids)
+        if pad_to_len > length:
+            ids.extend([stoi["[nop]"]] * (pad_to_len - length))
+        return ids, length
+
+
 def get_alphabet_from_selfies(selfies_iter: Iterable[str]) -> Set[str]:
     """Constructs an alphabet from an iterable of SELFIES strings.
 
@@ -66,7 +220,6 @@ def get_alphabet_from_selfies(selfies_iter: Iterable[str]) -> Set[str]:
 
     alphabet = set()
     for s in selfies_iter:
-        for symbol in split_selfies(s):
-            alphabet.add(symbol)
+        alphabet.update(tokenize_selfies(s))
     alphabet.discard(".")
     return alphabet
@@ -420,6 +420,9 @@ def mol_to_smiles(
     """
     assert mol.is_kekulized()
 
+    if not attribute:
+        return _mol_to_smiles_no_attribution(mol)
+
     fragments = []
     attribution_maps = []
     attribution_index = 0
@@ -436,6 +439,43 @@ def mol_to_smiles(
     return result if attribute else result[0]
 
 
+def _mol_to_smiles_no_attribution(mol):
+    fragments = []
+    ring_log = dict()
+    for root in mol.get_roots():
+        derived = []
+        _derive_smiles_from_fragment_no_attribution(
+            derived, mol, root, ring_log)
+        fragments.append("".join(derived))
+    return ".".join(fragments)
+
+
+def _derive_smiles_from_fragment_no_attribution(derived, mol, root, ring_log):
+    # same traversal as _derive_smiles_from_fragment, without building
+    # an AttributionMap for every token
+    derived.append(atom_to_smiles(mol.get_atom(root)))
+
+    out_bonds = mol.get_out_dirbonds(root)
+    for i, bond in enumerate(out_bonds):
+        if bond.ring_bond:
+            derived.append(bond_to_smiles(bond))
+            ends = (min(bond.src, bond.dst), max(bond.src, bond.dst))
+            rnum = ring_log.setdefault(ends, len(ring_log) + 1)
+            if rnum >= 10:
+                derived.append("%")
+            derived.append(str(rnum))
+
+        else:
+            branch = i < len(out_bonds) - 1
+            if branch:
+                derived.append("(")
+            derived.append(bond_to_smiles(bond))
+            _derive_smiles_from_fragment_no_attribution(
+                derived, mol, bond.dst, ring_log)
+            if branch:
+                derived.append(")")
+
+
 def _derive_smiles_from_fragment(
         derived,
         mol,
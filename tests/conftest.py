@@ -0,0 +1,6 @@
+import sys
+
+from pathlib import Path
+
+# import the packages of the repository (vae, molecule_chef, metrics, selfies) without installing them
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,120 @@
+import pytest
+import torch
+
+from metrics.accuracy import PAD_IDX, compare_monomer_bags, get_bag_accuracy, get_accuracy, \
+    get_correct_reactant_bags_batch_error_analysis
+from metrics.kernels import estimate_maximum_mean_discrepancy, estimate_maximum_mean_discrepancy_unbiased
+
+STOP_IDX = 9
+
+
+def set_accuracy(decoded_idx, answer_list, stop_idx):
+    # set semantics of the old loop: a decoded bag is the indices up to and including the first stop (all if none)
+    correct_bag, element_count = [], []
+    for decoded, answer in zip(decoded_idx.tolist(), answer_list):
+        stop_step = decoded.index(stop_idx) if stop_idx in decoded else len(decoded) - 1
+        prediction = set(decoded[:stop_step + 1])
+        correct_bag.append(prediction == set(answer))
+        element_count.append(len(prediction & set(answer)))
+    element_accuracy = sum(element_count) / sum(len(answer) for answer in answer_list) * 100
+    bag_accuracy = sum(correct_bag) / len(answer_list) * 100
+    return correct_bag, element_count, element_accuracy, bag_accuracy
+
+
+def padded_answer(answer_list, pad_idx):
+    answer_idx = torch.full([len(answer_list), max(len(answer) for answer in answer_list)], pad_idx, dtype=torch.long)
+    for row, answer in enumerate(answer_list):
+        answer_idx[row, :len(answer)] = torch.tensor(answer)
+    return answer_idx, torch.tensor([len(answer) for answer in answer_list])
+
+
+def random_bags(generator, batch_size, max_step):
+    # few monomers so that duplicates, missing stops and exact bags are frequent
+    decoded_idx = torch.randint(STOP_IDX + 1, size=(batch_size, max_step), generator=generator)
+    decoded_idx[torch.rand(batch_size, max_step, generator=generator) < 0.3] = STOP_IDX
+    answer_list = list()
+    for row in range(batch_size):
+        if row % 3 == 0:  # copy the decoded bag (correct or with duplicates)
+            decoded = decoded_idx[row].tolist()
+            answer = decoded[:decoded.index(STOP_IDX)] if STOP_IDX in decoded else decoded
+        else:
+            answer = torch.randint(STOP_IDX, size=(int(torch.randint(1, 4, (1,), generator=generator)),),
+                                   generator=generator).tolist()
+        answer_list.append(answer + [STOP_IDX])
+    return decoded_idx, answer_list
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_compare_monomer_bags_matches_sets(seed):
+    generator = torch.Generator().manual_seed(seed)
+    decoded_idx, answer_list = random_bags(generator, batch_size=64, max_step=1 + seed)
+    correct_bag, element_count, element_accuracy, bag_accuracy = set_accuracy(decoded_idx, answer_list, STOP_IDX)
+
+    for pad_idx in [PAD_IDX, STOP_IDX]:  # answer arrays are padded with PAD_IDX or the stop index
+        answer_idx, answer_length = padded_answer(answer_list, pad_idx)
+        result = compare_monomer_bags(decoded_idx, answer_idx, stop_idx=STOP_IDX)
+        assert result[0].tolist() == correct_bag
+        assert result[1].tolist() == element_count
+        assert get_bag_accuracy(decoded_idx, answer_idx, answer_length, stop_idx=STOP_IDX) == \
+               pytest.approx((element_accuracy, bag_accuracy))
+
+
+@pytest.mark.parametrize('decoded, answer, correct, count', [
+    ([3, 3, 4, STOP_IDX, 5], [3, 4, STOP_IDX], True, 3),  # duplicates in the decoded bag
+    ([3, 4, 4], [3, 4, STOP_IDX], False, 2),  # no stop token
+    ([3, 4, 4], [3, 4], True, 2),  # no stop token in the answer either
+    ([STOP_IDX, 3, 4], [3, 4, STOP_IDX], False, 1),  # stop at step 0
+    ([STOP_IDX, 3, 4], [STOP_IDX], True, 1),
+    ([4, 3, STOP_IDX, STOP_IDX], [3, 4, STOP_IDX], True, 3),
+])
+def test_compare_monomer_bags_edge_cases(decoded, answer, correct, count):
+    decoded_idx = torch.tensor([decoded])
+    for pad_idx in [PAD_IDX, STOP_IDX]:
+        answer_idx, _ = padded_answer([answer, [STOP_IDX]], pad_idx)
+        correct_bag, element_count = compare_monomer_bags(decoded_idx, answer_idx[:1], stop_idx=STOP_IDX)
+        assert (correct_bag.item(), element_count.item()) == (correct, count)
+
+
+def test_get_accuracy_of_dicts():
+    generator = torch.Generator().manual_seed(0)
+    decoded_idx, answer_list = random_bags(generator, batch_size=32, max_step=6)
+    correct_bag, _, element_accuracy, bag_accuracy = set_accuracy(decoded_idx, answer_list, STOP_IDX)
+    decoded_dict = {step: decoded_idx[:, step] for step in range(decoded_idx.shape[1])}
+    answer_dict = dict(enumerate(answer_list))
+
+    assert get_accuracy(decoded_dict, answer_dict) == pytest.approx((element_accuracy, bag_accuracy))
+    right_idx = [row for row, correct in enumerate(correct_bag) if correct]
+    assert get_correct_reactant_bags_batch_error_analysis(decoded_dict, answer_dict) == (len(right_idx), right_idx)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 32, 100])
+def test_chunked_mmd_matches_unchunked(chunk_size):
+    posterior_z_samples = torch.randn(50, 16, dtype=torch.float64)
+    torch.manual_seed(0)
+    expected = estimate_maximum_mean_discrepancy(posterior_z_samples)
+    torch.manual_seed(0)
+    mmd = estimate_maximum_mean_discrepancy(posterior_z_samples, chunk_size=chunk_size)
+    assert torch.allclose(mmd, expected, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('chunk_size', [None, 7])
+def test_unbiased_mmd_matches_u_statistic(chunk_size):
+    number_of_samples, latent_dimension = 40, 8
+    posterior_z_samples = torch.randn(number_of_samples, latent_dimension, dtype=torch.float64) + 0.3
+    torch.manual_seed(0)
+    mmd = estimate_maximum_mean_discrepancy_unbiased(posterior_z_samples, chunk_size=chunk_size)
+
+    # the same prior samples
+    torch.manual_seed(0)
+    prior_z_samples = torch.randn(number_of_samples, latent_dimension, dtype=torch.float64)
+    c = 2 * latent_dimension
+
+    def kernel_sum(x, y, exclude_diagonal):
+        return sum(c / (c + float((x[i] - y[j]).pow(2).sum())) for i in range(len(x)) for j in range(len(y))
+                   if not (exclude_diagonal and i == j))
+
+    number_of_off_diagonal_pairs = number_of_samples * (number_of_samples - 1)
+    expected = kernel_sum(prior_z_samples, prior_z_samples, True) / number_of_off_diagonal_pairs + \
+        kernel_sum(posterior_z_samples, posterior_z_samples, True) / number_of_off_diagonal_pairs - \
+        2 * kernel_sum(prior_z_samples, posterior_z_samples, False) / number_of_samples ** 2
+    assert float(mmd) == pytest.approx(expected, rel=1e-9, abs=1e-12)
@@ -0,0 +1,114 @@
+import pytest
+import torch
+
+from vae.training_optuna import first_step_index, get_sequence_length, get_nop_tensor
+
+NOP_IDX = 0
+ASTERISK_IDX = 1
+ALPHABET = 5
+
+
+def old_sequence_length(data_batch, nop_idx):
+    # per-sequence .nonzero() loop of train_model before the vectorization
+    length_tensor = torch.zeros_like(data_batch[:, 0, 0])
+    for idx in range(data_batch.shape[0]):
+        boolean = (data_batch[idx, :, nop_idx] == 1.0).nonzero()
+        if boolean.shape[0] != 0:
+            length = (data_batch[idx, :, nop_idx] == 1.0).nonzero()[0][0].item()
+        else:
+            length = data_batch.shape[1]
+        length_tensor[idx] = length
+    return length_tensor
+
+
+def old_nop_tensor(x_hat_indices, nop_idx, asterisk_idx, dtype):
+    # per-step .nonzero() / .item() loop of train_model before the vectorization
+    nop_tensor = -torch.ones(x_hat_indices.shape[0], dtype=dtype)
+    asterisk_tensor = -torch.ones(x_hat_indices.shape[0], dtype=dtype)
+    for seq_index in range(x_hat_indices.shape[1]):
+        # find 'nop' idx
+        boolean_tensor = x_hat_indices[:, seq_index] == nop_idx
+        nonzero_tensor = boolean_tensor.nonzero()
+        for nonzero_num in range(nonzero_tensor.shape[0]):
+            nonzero_idx = nonzero_tensor[nonzero_num][0].item()
+            # store
+            if nop_tensor[nonzero_idx] < 0:
+                nop_tensor[nonzero_idx] = seq_index
+
+        # find 'asterisk' idx
+        boolean_tensor = x_hat_indices[:, seq_index] == asterisk_idx
+        nonzero_tensor = boolean_tensor.nonzero()
+        for nonzero_num in range(nonzero_tensor.shape[0]):
+            nonzero_idx = nonzero_tensor[nonzero_num][0].item()
+            # store
+            if asterisk_tensor[nonzero_idx] < 0:
+                asterisk_tensor[nonzero_idx] = 0.0  # generated one asterisk
+
+            elif asterisk_tensor[nonzero_idx] == 0:
+                asterisk_tensor[nonzero_idx] = seq_index  # generated two asterisks other than the initiator
+
+    # change value of asterisk tensor: 0 -> -1
+    asterisk_tensor[asterisk_tensor == 0.0] = -1.0
+
+    # update nop tensor
+    updated_nop_tensor = -torch.ones(x_hat_indices.shape[0], dtype=dtype)
+    for idx in range(asterisk_tensor.shape[0]):
+        if nop_tensor[idx] == -1.0 and asterisk_tensor[idx] == -1.0:
+            continue
+        elif nop_tensor[idx] < 0 < asterisk_tensor[idx]:
+            updated_nop_tensor[idx] = asterisk_tensor[idx]
+        elif nop_tensor[idx] > 0 > asterisk_tensor[idx]:
+            updated_nop_tensor[idx] = nop_tensor[idx]
+        elif nop_tensor[idx] >= asterisk_tensor[idx]:
+            updated_nop_tensor[idx] = asterisk_tensor[idx]
+        else:
+            updated_nop_tensor[idx] = nop_tensor[idx]
+    return updated_nop_tensor
+
+
+def random_indices(generator, batch_size, length):
+    # few symbols so that nops and asterisks are frequent
+    return torch.randint(ALPHABET, size=(batch_size, length), generator=generator)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_get_nop_tensor_matches_loop(seed):
+    generator = torch.Generator().manual_seed(seed)
+    x_hat_indices = random_indices(generator, batch_size=64, length=1 + seed % 12)
+    expected = old_nop_tensor(x_hat_indices, NOP_IDX, ASTERISK_IDX, torch.float32)
+    assert torch.equal(get_nop_tensor(x_hat_indices, NOP_IDX, ASTERISK_IDX, torch.float32), expected)
+
+
+@pytest.mark.parametrize('sequence, expected', [
+    ([0, 2, 3, 0, 4], -1),  # nop at step 0 (no second asterisk)
+    ([0, 1, 2, 1, 4], 0),  # nop at step 0 and a second asterisk
+    ([2, 3, 4, 0, 2], 3),  # no asterisk
+    ([1, 2, 3, 4, 2], -1),  # a single asterisk
+    ([1, 2, 0, 3, 1], 2),  # asterisk after the first nop
+    ([1, 2, 1, 0, 3], 2),  # second asterisk before the first nop
+    ([0, 0, 0, 0, 0], -1),  # all nop
+    ([2, 3, 4, 2, 3], -1),  # no nop and no asterisk
+])
+def test_get_nop_tensor_edge_cases(sequence, expected):
+    x_hat_indices = torch.tensor([sequence])
+    nop_tensor = get_nop_tensor(x_hat_indices, NOP_IDX, ASTERISK_IDX, torch.float32)
+    assert torch.equal(nop_tensor, old_nop_tensor(x_hat_indices, NOP_IDX, ASTERISK_IDX, torch.float32))
+    assert nop_tensor.item() == expected
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_get_sequence_length_matches_loop(seed):
+    generator = torch.Generator().manual_seed(seed)
+    label_batch = random_indices(generator, batch_size=64, length=1 + seed)
+    label_batch[0] = NOP_IDX  # all nop
+    label_batch[1] = 2  # no nop
+    one_hot_batch = torch.nn.functional.one_hot(label_batch, ALPHABET).float()
+    expected = old_sequence_length(one_hot_batch, NOP_IDX).long()
+    assert torch.equal(get_sequence_length(one_hot_batch, NOP_IDX), expected)
+    assert torch.equal(get_sequence_length(label_batch, NOP_IDX), expected)
+
+
+def test_first_step_index():
+    mask = torch.tensor([[False, True, True], [False, False, False], [True, False, True]])
+    assert first_step_index(mask).tolist() == [1, -1, 0]
+    assert first_step_index(torch.zeros(2, 0, dtype=torch.bool)).tolist() == [-1, -1]
@@ -0,0 +1,116 @@
+import sys
+import time
+from copy import deepcopy
+
+import torch
+import torch.nn.functional as f
+
+sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
+from vae.encoder.torch import CNNEncoder
+from vae.decoder.torch import Decoder
+from vae.property_predictor.torch import PropertyNetworkPredictionModule
+from vae.training_optuna import compute_elbo, estimate_maximum_mean_discrepancy, get_nop_tensor
+
+
+def build_models(num_classes, max_length, latent_dim):
+    torch.manual_seed(0)
+    encoder = CNNEncoder(in_channels=num_classes, feature_dim=max_length, convolution_channel_dim=[64, 64],
+                         kernel_size=[7, 7], layer_1d=512, layer_2d=256, latent_dimension=latent_dim)
+    decoder = Decoder(input_size=num_classes, num_layers=2, hidden_size=latent_dim, out_dimension=num_classes,
+                      bidirectional=True)
+    property_predictor = PropertyNetworkPredictionModule(
+        latent_dim=latent_dim, property_dim=2, property_network_hidden_dim_list=[[64, 16], [64, 16]],
+        dtype=torch.float32, device='cpu'
+    )
+    return encoder, decoder, property_predictor
+
+
+def train_step(models, optimizer, data_batch, y_batch, nop_idx, asterisk_idx, mixed_precision):
+    """
+    One training step of train_model (teacher forcing); returns the losses.
+    """
+    encoder, decoder, property_predictor = models
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=mixed_precision):
+        latent_points, mus, log_vars = encoder(data_batch.transpose(dim0=1, dim1=2))
+        predicted_property = property_predictor(latent_points)
+        out_one_hot, _ = decoder.forward_teacher_forced(inputs=data_batch, z=latent_points)
+
+    out_one_hot = out_one_hot.float()
+    latent_points, mus, log_vars = latent_points.float(), mus.float(), log_vars.float()
+    nop_tensor = get_nop_tensor(out_one_hot.argmax(dim=-1), nop_idx, asterisk_idx, torch.float32)
+    reconstruction_loss, _ = compute_elbo(data_batch, out_one_hot, nop_tensor, mus, log_vars, 0.0)
+    divergence_loss = estimate_maximum_mean_discrepancy(latent_points)
+    property_loss = f.mse_loss(predicted_property.float(), y_batch)
+
+    optimizer.zero_grad()
+    (reconstruction_loss + 10.0 * divergence_loss + property_loss).backward()
+    optimizer.step()
+
+    return [reconstruction_loss.item(), divergence_loss.item(), property_loss.item()]
+
+
+def run(models, data, y, batch_size, nop_idx, asterisk_idx, mixed_precision, seed=1):
+    parameters = [parameter for model in models for parameter in model.parameters()]
+    optimizer = torch.optim.Adam(parameters, lr=1e-4)
+    for model in models:
+        model.train()
+
+    torch.manual_seed(seed)
+    loss_list = []
+    start = time.perf_counter()
+    for batch_start in range(0, data.shape[0], batch_size):
+        loss_list.append(train_step(
+            models, optimizer, data[batch_start: batch_start + batch_size], y[batch_start: batch_start + batch_size],
+            nop_idx, asterisk_idx, mixed_precision
+        ))
+    return time.perf_counter() - start, loss_list
+
+
+if __name__ == '__main__':
+    num_samples = 2048
+    max_length = 80
+    num_classes = 40
+    latent_dim = 64
+    batch_size = 128
+    nop_idx, asterisk_idx = 0, 1
+
+    torch.manual_seed(42)
+    lengths = torch.randint(10, max_length, size=(num_samples,))
+    labels = torch.randint(2, num_classes, size=(num_samples, max_length))
+    labels[torch.arange(max_length).unsqueeze(0) >= lengths.unsqueeze(1)] = nop_idx
+    data = f.one_hot(labels, num_classes=num_classes).to(torch.float32)
+    y = torch.randn(num_samples, 2)
+
+    models = build_models(num_classes, max_length, latent_dim)
+    print(f'{num_samples} sequences of length {max_length}, batch size {batch_size}, '
+          f'threads {torch.get_num_threads()}', flush=True)
+
+    # warm up (one epoch on copies)
+    for mixed_precision in [False, True]:
+        run(deepcopy(models), data[:2 * batch_size], y[:2 * batch_size], batch_size, nop_idx, asterisk_idx,
+            mixed_precision)
+
+    fp32_time, fp32_loss = run(deepcopy(models), data, y, batch_size, nop_idx, asterisk_idx, mixed_precision=False)
+    bf16_time, bf16_loss = run(deepcopy(models), data, y, batch_size, nop_idx, asterisk_idx, mixed_precision=True)
+
+    print(f'float32 : {fp32_time:.2f} s per epoch', flush=True)
+    print(f'bfloat16: {bf16_time:.2f} s per epoch ({fp32_time / bf16_time:.2f}x)', flush=True)
+    for loss_idx, loss_name in enumerate(['reconstruction', 'divergence', 'property']):
+        fp32_mean = sum(loss[loss_idx] for loss in fp32_loss) / len(fp32_loss)
+        bf16_mean = sum(loss[loss_idx] for loss in bf16_loss) / len(bf16_loss)
+        print(f'{loss_name:>14} loss: float32 {fp32_mean:.5f}, bfloat16 {bf16_mean:.5f} '
+              f'(relative difference {abs(bf16_mean - fp32_mean) / abs(fp32_mean):.2e})', flush=True)
+
+    # inference: agreement of the decoded symbols
+    with torch.no_grad():
+        encoder, decoder, _ = models
+        encoder.eval()
+        decoder.eval()
+        _, mus, _ = encoder(data[:512].transpose(dim0=1, dim1=2))
+        fp32_indices = decoder.generate(mus, max_length, nop_idx, asterisk_idx)
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+            _, bf16_mus, _ = encoder(data[:512].transpose(dim0=1, dim1=2))
+            bf16_indices = decoder.generate(bf16_mus, max_length, nop_idx, asterisk_idx)
+    print(f'latent mean max abs difference {(bf16_mus.float() - mus).abs().max():.2e}, '
+          f'identical generated sequences {100 * (fp32_indices == bf16_indices).all(dim=1).float().mean():.1f}%',
+          flush=True)
@@ -0,0 +1,55 @@
+import sys
+import time
+
+import torch
+
+sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
+from metrics.kernels import estimate_maximum_mean_discrepancy, estimate_maximum_mean_discrepancy_linear
+
+
+def sample_estimates(estimator, posterior_shift, batch_size, latent_dim, num_draws):
+    """
+    MMD estimates of num_draws batches of shifted Gaussian posterior samples (shift 0: posterior equal to the prior).
+    """
+    estimates = torch.empty(num_draws)
+    start = time.perf_counter()
+    for draw in range(num_draws):
+        posterior_z_samples = torch.randn(batch_size, latent_dim) + posterior_shift
+        estimates[draw] = estimator(posterior_z_samples)
+    return time.perf_counter() - start, estimates
+
+
+def time_backward(estimator, batch_size, latent_dim, num_iterations):
+    """
+    Forward and backward time of the estimator (training step)
+    """
+    posterior_z_samples = torch.randn(batch_size, latent_dim, requires_grad=True)
+    start = time.perf_counter()
+    for _ in range(num_iterations):
+        posterior_z_samples.grad = None
+        estimator(posterior_z_samples).backward()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    latent_dim = 256
+    num_draws = 200
+    num_iterations = 20
+    estimators = {
+        'quadratic': estimate_maximum_mean_discrepancy,
+        'linear': estimate_maximum_mean_discrepancy_linear,
+    }
+
+    torch.manual_seed(42)
+    print(f'latent dimension {latent_dim}, {num_draws} draws, threads {torch.get_num_threads()}', flush=True)
+    for batch_size in [32, 256, 2048]:
+        for posterior_shift in [0.0, 0.5]:
+            for name, estimator in estimators.items():
+                _, estimates = sample_estimates(estimator, posterior_shift, batch_size, latent_dim, num_draws)
+                print(f'batch size {batch_size:>5}, shift {posterior_shift}: {name:>9} mean {estimates.mean():.3e}, '
+                      f'std {estimates.std():.3e}', flush=True)
+
+        quadratic_time = time_backward(estimate_maximum_mean_discrepancy, batch_size, latent_dim, num_iterations)
+        linear_time = time_backward(estimate_maximum_mean_discrepancy_linear, batch_size, latent_dim, num_iterations)
+        print(f'batch size {batch_size:>5}: quadratic {quadratic_time:.3f} s, linear {linear_time:.3f} s '
+              f'({quadratic_time / linear_time:.1f}x) for {num_iterations} forward and backward passes', flush=True)
@@ -0,0 +1,47 @@
+import sys
+import time
+
+import torch
+
+sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
+from vae.property_predictor.torch import PropertyNetworkPredictionModule, FusedPropertyNetworkPredictionModule
+
+
+def time_latent_gradients(property_network, latent_points, num_iterations):
+    """
+    Gradients of the predicted properties w.r.t. the latent points (latent space optimization).
+    """
+    latent_points = latent_points.clone().requires_grad_(True)
+    for _ in range(50):  # warm up
+        latent_points.grad = None
+        property_network(latent_points).sum().backward()
+
+    start = time.perf_counter()
+    for _ in range(num_iterations):
+        latent_points.grad = None
+        property_network(latent_points).sum().backward()
+    return time.perf_counter() - start, latent_points.grad
+
+
+if __name__ == '__main__':
+    latent_dim = 64
+    property_network_hidden_dim_list = [[64, 16], [64, 16]]
+    num_iterations = 2000
+
+    torch.manual_seed(42)
+    network_kwargs = dict(latent_dim=latent_dim, property_dim=len(property_network_hidden_dim_list),
+                          property_network_hidden_dim_list=property_network_hidden_dim_list,
+                          dtype=torch.float32, device='cpu')
+    property_network = PropertyNetworkPredictionModule(**network_kwargs).eval()
+    fused_property_network = FusedPropertyNetworkPredictionModule(**network_kwargs)
+    fused_property_network.load_state_dict(property_network.state_dict())  # converted to the fused layout
+    fused_property_network.eval()
+
+    for batch_size in [1, 64, 1024]:
+        latent_points = torch.randn(batch_size, latent_dim)
+        unfused_time, unfused_grad = time_latent_gradients(property_network, latent_points, num_iterations)
+        fused_time, fused_grad = time_latent_gradients(fused_property_network, latent_points, num_iterations)
+        assert torch.allclose(unfused_grad, fused_grad, atol=1e-6), 'gradients differ'
+
+        print(f'batch size {batch_size:>5}: unfused {unfused_time:.3f} s, fused {fused_time:.3f} s '
+              f'({unfused_time / fused_time:.2f}x) for {num_iterations} gradients', flush=True)
@@ -0,0 +1,212 @@
+import sys
+import time
+import random
+
+sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
+import selfies as sf
+from selfies.compatibility import modernize_symbol
+from selfies.decoder import _decode, _decode_memoized, _form_rings_bilocally, _raise_decoder_error, \
+    _read_index_from_selfies
+from selfies.exceptions import DecoderError
+from selfies.grammar_rules import next_atom_state, next_branch_state, next_ring_state, process_atom_symbol, \
+    process_branch_symbol, process_ring_symbol
+from selfies.mol_graph import MolecularGraph, Attribution
+from selfies.utils.selfies_utils import split_selfies
+from selfies.utils.smiles_utils import mol_to_smiles
+
+
+# baseline: the decoder before the streamlined path (selfies.decoder.decoder with attribute=False).
+# _tokenize_selfies and _derive_mol_from_symbols are verbatim copies of the previous version.
+def decode_baseline(selfies):
+    mol = MolecularGraph(attributable=False)
+
+    rings = []
+    attribution_index = 0
+    for s in selfies.split("."):
+        n = _derive_mol_from_symbols_baseline(
+            symbol_iter=enumerate(_tokenize_selfies_baseline(s, False)),
+            mol=mol,
+            selfies=selfies,
+            max_derive=float("inf"),
+            init_state=0,
+            root_atom=None,
+            rings=rings,
+            attribute_stack=None,
+            attribution_index=attribution_index
+        )
+        attribution_index += n
+    _form_rings_bilocally(mol, rings)
+    # the previous mol_to_smiles built the attribution maps also without attribution
+    return mol_to_smiles(mol, attribute=True)[0]
+
+
+def _tokenize_selfies_baseline(selfies, compatible):
+    if isinstance(selfies, str):
+        symbol_iter = split_selfies(selfies)
+    elif isinstance(selfies, list):
+        symbol_iter = selfies
+    else:
+        raise ValueError()  # should not happen
+
+    try:
+        for symbol in symbol_iter:
+            if symbol == "[nop]":
+                continue
+            if compatible:
+                symbol = modernize_symbol(symbol)
+            yield symbol
+    except ValueError as err:
+        raise DecoderError(str(err)) from None
+
+
+def _derive_mol_from_symbols_baseline(
+        symbol_iter, mol, selfies, max_derive,
+        init_state, root_atom, rings, attribute_stack, attribution_index
+):
+    n_derived = 0
+    state = init_state
+    prev_atom = root_atom
+
+    while (state is not None) and (n_derived < max_derive):
+
+        try:  # retrieve next symbol
+            index, symbol = next(symbol_iter)
+            n_derived += 1
+        except StopIteration:
+            break
+
+        # Case 1: Branch symbol (e.g. [Branch1])
+        if "ch" == symbol[-4:-2]:
+
+            output = process_branch_symbol(symbol)
+            if output is None:
+                _raise_decoder_error(selfies, symbol)
+            btype, n = output
+
+            if state <= 1:
+                next_state = state
+            else:
+                binit_state, next_state = next_branch_state(btype, state)
+
+                Q = _read_index_from_selfies(symbol_iter, n_symbols=n)
+                n_derived += n + _derive_mol_from_symbols_baseline(
+                    symbol_iter, mol, selfies, (Q + 1),
+                    init_state=binit_state, root_atom=prev_atom, rings=rings,
+                    attribute_stack=attribute_stack +
+                    [Attribution(index + attribution_index, symbol)
+                     ] if attribute_stack is not None else None,
+                    attribution_index=attribution_index
+                )
+
+        # Case 2: Ring symbol (e.g. [Ring2])
+        elif "ng" == symbol[-4:-2]:
+
+            output = process_ring_symbol(symbol)
+            if output is None:
+                _raise_decoder_error(selfies, symbol)
+            ring_type, n, stereo = output
+
+            if state == 0:
+                next_state = state
+            else:
+                ring_order, next_state = next_ring_state(ring_type, state)
+                bond_info = (ring_order, stereo)
+
+                Q = _read_index_from_selfies(symbol_iter, n_symbols=n)
+                n_derived += n
+                lidx = max(0, prev_atom.index - (Q + 1))
+                rings.append((mol.get_atom(lidx), prev_atom, bond_info))
+
+        # Case 3: [epsilon]
+        elif "eps" in symbol:
+            next_state = 0 if (state == 0) else None
+
+        # Case 4: regular symbol (e.g. [N], [=C], [F])
+        else:
+
+            output = process_atom_symbol(symbol)
+            if output is None:
+                _raise_decoder_error(selfies, symbol)
+            (bond_order, stereo), atom = output
+            cap = atom.bonding_capacity
+
+            bond_order, next_state = next_atom_state(bond_order, cap, state)
+            if bond_order == 0:
+                if state == 0:
+                    o = mol.add_atom(atom, True)
+                    mol.add_attribution(
+                        o,  attribute_stack +
+                        [Attribution(index + attribution_index, symbol)]
+                        if attribute_stack is not None else None)
+            else:
+                o = mol.add_atom(atom)
+                mol.add_attribution(
+                    o, attribute_stack +
+                    [Attribution(index + attribution_index, symbol)]
+                    if attribute_stack is not None else None)
+                src, dst = prev_atom.index, atom.index
+                o = mol.add_bond(src=src, dst=dst,
+                                 order=bond_order, stereo=stereo)
+                mol.add_attribution(
+                    o, attribute_stack +
+                    [Attribution(index + attribution_index, symbol)]
+                    if attribute_stack is not None else None)
+            prev_atom = atom
+
+        if next_state is None:
+            break
+        state = next_state
+
+    while n_derived < max_derive:  # consume remaining tokens
+        try:
+            next(symbol_iter)
+            n_derived += 1
+        except StopIteration:
+            break
+
+    return n_derived
+
+
+def random_selfies(alphabet, num_molecules, max_length, num_unique, seed=42):
+    """
+    Random SELFIES strings drawn from a pool of num_unique strings.
+    Generated samples repeat (e.g. prior generation, evaluation every epoch), which the memo exploits.
+    """
+    rng = random.Random(seed)
+    pool = [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, max_length))) for _ in range(num_unique)]
+    return [rng.choice(pool) for _ in range(num_molecules)]
+
+
+def time_decoding(decode_fn, selfies_list):
+    start = time.perf_counter()
+    smiles_list = [decode_fn(selfies) for selfies in selfies_list]
+    return time.perf_counter() - start, smiles_list
+
+
+if __name__ == '__main__':
+    num_molecules = 50000
+    num_unique = 10000
+    max_length = 40
+
+    alphabet = sorted(sf.get_semantic_robust_alphabet()) + ['[*]', '[nop]']
+    selfies_list = random_selfies(alphabet, num_molecules, max_length, num_unique)
+
+    # baseline: the previous decoder (attribute=False)
+    baseline_time, baseline_smiles = time_decoding(decode_baseline, selfies_list)
+
+    # streamlined path without memoization
+    fast_time, fast_smiles = time_decoding(lambda s: _decode(s, compatible=False, attribute=False), selfies_list)
+
+    # streamlined path with memoization (cold memo, then warm memo)
+    _decode_memoized.cache_clear()
+    cold_time, cold_smiles = time_decoding(sf.decoder, selfies_list)
+    warm_time, warm_smiles = time_decoding(sf.decoder, selfies_list)
+
+    assert baseline_smiles == fast_smiles == cold_smiles == warm_smiles, 'decoded SMILES differ'
+
+    print(f'{num_molecules} SELFIES ({num_unique} unique, up to {max_length} symbols)', flush=True)
+    print(f'baseline           : {baseline_time:.3f} s', flush=True)
+    print(f'streamlined        : {fast_time:.3f} s ({baseline_time / fast_time:.2f}x)', flush=True)
+    print(f'memoized (cold)    : {cold_time:.3f} s ({baseline_time / cold_time:.2f}x)', flush=True)
+    print(f'memoized (warm)    : {warm_time:.3f} s ({baseline_time / warm_time:.2f}x)', flush=True)
+    print(_decode_memoized.cache_info(), flush=True)
@@ -0,0 +1,88 @@
+import sys
+import time
+
+import torch
+import torch.nn.functional as f
+
+sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
+from vae.decoder.torch import Decoder
+from vae.utils.sampler import LengthBucketBatchSampler
+
+
+def random_batches(num_samples, batch_size):
+    return list(torch.randperm(num_samples).split(batch_size))
+
+
+def bucket_batches(lengths, batch_size):
+    return [torch.tensor(batch_idx) for batch_idx in LengthBucketBatchSampler(lengths, batch_size=batch_size)]
+
+
+def teacher_forcing_step_by_step(decoder, data_batch, z, rnn_max_length):
+    hidden = decoder.init_hidden(z)
+    out_one_hot = torch.zeros_like(data_batch)
+    x_input = torch.zeros_like(data_batch[:, 0, :].unsqueeze(0))
+    for seq_index in range(rnn_max_length):
+        out_one_hot_line, hidden = decoder(x=x_input, hidden=hidden)
+        out_one_hot[:, seq_index, :] = out_one_hot_line[0]
+        x_input = data_batch[:, seq_index, :].unsqueeze(0)
+    return out_one_hot
+
+
+def teacher_forcing_single_pass(decoder, data_batch, z, rnn_max_length):
+    out_one_hot = torch.zeros_like(data_batch)
+    out_one_hot[:, :rnn_max_length, :], _ = decoder.forward_teacher_forced(data_batch[:, :rnn_max_length, :], z)
+    return out_one_hot
+
+
+def run_epoch(decoder, optimizer, labels, lengths, batch_idx_list, latent_dim, num_classes, teacher_forcing_fn):
+    """
+    One epoch of teacher-forced decoding (forward + backward); returns the number of decoded tokens per second.
+    """
+    num_tokens = 0
+    start = time.perf_counter()
+    for batch_idx in batch_idx_list:
+        data_batch = f.one_hot(labels[batch_idx], num_classes=num_classes).to(torch.float32)
+        rnn_max_length = int(lengths[batch_idx].max())
+        z = torch.randn(batch_idx.shape[0], latent_dim)
+
+        out_one_hot = teacher_forcing_fn(decoder, data_batch, z, rnn_max_length)
+        loss = f.cross_entropy(out_one_hot.reshape(-1, num_classes), labels[batch_idx].reshape(-1))
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        num_tokens += batch_idx.shape[0] * rnn_max_length
+
+    return num_tokens / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    num_samples = 4000
+    max_length = 120
+    num_classes = 40
+    latent_dim = 64
+    batch_size = 250
+    nop_idx = 0
+
+    # long-tailed length distribution like polymer SELFIES
+    torch.manual_seed(42)
+    lengths = torch.distributions.LogNormal(3.0, 0.5).sample((num_samples,)).long().clamp(2, max_length)
+    labels = torch.randint(1, num_classes, size=(num_samples, max_length))
+    labels[torch.arange(max_length).unsqueeze(0) >= lengths.unsqueeze(1)] = nop_idx
+
+    decoder = Decoder(input_size=num_classes, num_layers=2, hidden_size=latent_dim, out_dimension=num_classes,
+                      bidirectional=True)
+    optimizer = torch.optim.Adam(decoder.parameters(), lr=1e-4)
+
+    print(f'{num_samples} sequences, mean length {lengths.float().mean():.1f}, max length {lengths.max()}, '
+          f'batch size {batch_size}, threads {torch.get_num_threads()}', flush=True)
+    for batching, batch_fn in [('random', lambda: random_batches(num_samples, batch_size)),
+                               ('length buckets', lambda: bucket_batches(lengths, batch_size))]:
+        for name, teacher_forcing_fn in [('step by step', teacher_forcing_step_by_step),
+                                         ('single pass', teacher_forcing_single_pass)]:
+            batch_idx_list = batch_fn()
+            start = time.perf_counter()
+            tokens_per_second = run_epoch(decoder, optimizer, labels, lengths, batch_idx_list, latent_dim,
+                                          num_classes, teacher_forcing_fn)
+            print(f'{batching:>15} / {name:<13}: {time.perf_counter() - start:7.2f} s per epoch '
+                  f'({tokens_per_second:,.0f} unrolled tokens/s)', flush=True)
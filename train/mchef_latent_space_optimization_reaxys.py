@@ -28,7 +28,9 @@ from molecule_chef.module.encoder import Encoder
 from molecule_chef.module.decoder import Decoder
 from molecule_chef.module.gated_graph_neural_network import GGNNSparse
 from molecule_chef.module.utils import TorchDetails, save_model, MChefParameters
-from molecule_chef.module.utils import FullyConnectedNeuralNetwork, PropertyNetworkPredictionModule
+from molecule_chef.module.utils import FullyConnectedNeuralNetwork, FusedPropertyNetworkPredictionModule
+from molecule_chef.module.utils import get_monomer_bags_idx_tensor, get_monomer_bags_graph_embedding_tensor
+from molecule_chef.module.utils import get_monomer_to_idx
 from molecule_chef.module.preprocess import AtomFeatureParams
 
 
@@ -388,7 +390,7 @@ if __name__ == '__main__':
     stop_embedding = state_dict['nn_stop_embedding']
 
     # load property prediction network
-    property_network = PropertyNetworkPredictionModule(
+    property_network = FusedPropertyNetworkPredictionModule(
         latent_dim=mchef_parameters.latent_dim,
         property_dim=mchef_parameters.property_dim,
         property_network_hidden_dim_list=mchef_parameters.property_network_hidden_sizes,
@@ -413,6 +415,7 @@ if __name__ == '__main__':
     train_monomer_bags_set = set(frozenset(monomer_bag) for monomer_bag in train_monomer_bags)
     test_monomer_bags = torch.load(os.path.join(save_directory, 'test_bags.pth'), map_location=device)
     unique_monomer_sets = torch.load(os.path.join(save_directory, 'unique_monomer_sets.pth'), map_location=device)
+    monomer_to_idx = get_monomer_to_idx(unique_monomer_sets)
 
     # generation polymers on the mean points - several times
     # random walk and gradient search
@@ -440,21 +443,15 @@ if __name__ == '__main__':
 
             # get train answer dict
             train_answer_dict = molecule_chef.get_answer_dict(
-                monomer_bags=batch_train_monomer_bags, unique_monomer_sets=unique_monomer_sets
+                monomer_bags=batch_train_monomer_bags, unique_monomer_sets=unique_monomer_sets,
+                monomer_to_idx=monomer_to_idx
             )
 
             # get graph embeddings of whole monomer bags
             all_monomers_graph_embedding_tensor = state_dict['all_monomers_graph_embedding_tensor'].to(device)
-            monomer_bags_graph_embedding_tensor = torch.zeros_like(all_monomers_graph_embedding_tensor[0]).view(1, -1)
-
-            # get monomer bags embedding tensors
-            for idx_of_bag in range(len(batch_train_monomer_bags)):
-                monomer_bags_graph_embedding = torch.zeros_like(all_monomers_graph_embedding_tensor[0])
-                for monomer_idx in train_answer_dict[idx_of_bag][:-1]:
-                    monomer_bags_graph_embedding += all_monomers_graph_embedding_tensor[monomer_idx]
-                monomer_bags_graph_embedding_tensor = torch.cat(
-                    [monomer_bags_graph_embedding_tensor, monomer_bags_graph_embedding.view(1, -1)], dim=0
-                )
+            monomer_bags_graph_embedding_tensor = get_monomer_bags_graph_embedding_tensor(
+                all_monomers_graph_embedding_tensor, get_monomer_bags_idx_tensor(train_answer_dict, device=device)
+            )
 
             # save monomer bag idx
             random_walk_batch_monomer_bag_list = list()
@@ -462,7 +459,7 @@ if __name__ == '__main__':
 
             with torch.no_grad():
                 # encode
-                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor[1:])
+                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor)
 
             for mu in mus:
                 # generating polymers starting from mus
@@ -23,6 +23,8 @@ from molecule_chef.module.decoder import Decoder
 from molecule_chef.module.gated_graph_neural_network import GGNNSparse
 from molecule_chef.module.utils import TorchDetails, FullyConnectedNeuralNetwork, MChefParameters
 from molecule_chef.module.utils import get_correct_reactant_bags_batch, PropertyNetworkPredictionModule
+from molecule_chef.module.utils import get_monomer_bags_idx_tensor, get_monomer_bags_graph_embedding_tensor
+from molecule_chef.module.utils import get_monomer_to_idx
 from molecule_chef.module.preprocess import AtomFeatureParams
 
 if __name__ == '__main__':
@@ -139,6 +141,7 @@ if __name__ == '__main__':
     valid_monomer_bags = torch.load(os.path.join(save_directory, 'valid_bags.pth'), map_location=device)
     test_monomer_bags = torch.load(os.path.join(save_directory, 'test_bags.pth'), map_location=device)
     unique_monomer_sets = torch.load(os.path.join(save_directory, 'unique_monomer_sets.pth'), map_location=device)
+    monomer_to_idx = get_monomer_to_idx(unique_monomer_sets)
 
     # store latent z points & property values
     z_mean_train = list()
@@ -168,24 +171,18 @@ if __name__ == '__main__':
 
                 # get train answer dict
                 train_answer_dict = molecule_chef.get_answer_dict(
-                    monomer_bags=batch_train_monomer_bags, unique_monomer_sets=unique_monomer_sets
+                    monomer_bags=batch_train_monomer_bags, unique_monomer_sets=unique_monomer_sets,
+                    monomer_to_idx=monomer_to_idx
                 )
 
                 # get graph embeddings of whole monomer bags
                 all_monomers_graph_embedding_tensor = state_dict['all_monomers_graph_embedding_tensor'].to(device)
-                monomer_bags_graph_embedding_tensor = torch.zeros_like(all_monomers_graph_embedding_tensor[0]).view(1, -1)
-
-                # get monomer bags embedding tensors
-                for idx_of_bag in range(len(batch_train_monomer_bags)):
-                    monomer_bags_graph_embedding = torch.zeros_like(all_monomers_graph_embedding_tensor[0])
-                    for monomer_idx in train_answer_dict[idx_of_bag][:-1]:
-                        monomer_bags_graph_embedding += all_monomers_graph_embedding_tensor[monomer_idx]
-                    monomer_bags_graph_embedding_tensor = torch.cat(
-                        [monomer_bags_graph_embedding_tensor, monomer_bags_graph_embedding.view(1, -1)], dim=0
-                    )
+                monomer_bags_graph_embedding_tensor = get_monomer_bags_graph_embedding_tensor(
+                    all_monomers_graph_embedding_tensor, get_monomer_bags_idx_tensor(train_answer_dict, device=device)
+                )
 
                 # encode
-                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor[1:])
+                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor)
 
                 # property prediction
                 property_prediction = molecule_chef.mchef_module.property_network(mus)
@@ -227,24 +224,18 @@ if __name__ == '__main__':
 
                 # get valid answer dict
                 valid_answer_dict = molecule_chef.get_answer_dict(
-                    monomer_bags=batch_valid_monomer_bags, unique_monomer_sets=unique_monomer_sets
+                    monomer_bags=batch_valid_monomer_bags, unique_monomer_sets=unique_monomer_sets,
+                    monomer_to_idx=monomer_to_idx
                 )
 
                 # get graph embeddings of whole monomer bags
                 all_monomers_graph_embedding_tensor = state_dict['all_monomers_graph_embedding_tensor'].to(device)
-                monomer_bags_graph_embedding_tensor = torch.zeros_like(all_monomers_graph_embedding_tensor[0]).view(1, -1)
-
-                # get monomer bags embedding tensors
-                for idx_of_bag in range(len(batch_valid_monomer_bags)):
-                    monomer_bags_graph_embedding = torch.zeros_like(all_monomers_graph_embedding_tensor[0])
-                    for monomer_idx in valid_answer_dict[idx_of_bag][:-1]:
-                        monomer_bags_graph_embedding += all_monomers_graph_embedding_tensor[monomer_idx]
-                    monomer_bags_graph_embedding_tensor = torch.cat(
-                        [monomer_bags_graph_embedding_tensor, monomer_bags_graph_embedding.view(1, -1)], dim=0
-                    )
+                monomer_bags_graph_embedding_tensor = get_monomer_bags_graph_embedding_tensor(
+                    all_monomers_graph_embedding_tensor, get_monomer_bags_idx_tensor(valid_answer_dict, device=device)
+                )
 
                 # encode
-                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor[1:])
+                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor)
 
                 # property prediction
                 property_prediction = molecule_chef.mchef_module.property_network(mus)
@@ -287,24 +278,18 @@ if __name__ == '__main__':
 
                 # get test answer dict
                 test_answer_dict = molecule_chef.get_answer_dict(
-                    monomer_bags=batch_test_monomer_bags, unique_monomer_sets=unique_monomer_sets
+                    monomer_bags=batch_test_monomer_bags, unique_monomer_sets=unique_monomer_sets,
+                    monomer_to_idx=monomer_to_idx
                 )
 
                 # get graph embeddings of whole monomer bags
                 all_monomers_graph_embedding_tensor = state_dict['all_monomers_graph_embedding_tensor'].to(device)
-                monomer_bags_graph_embedding_tensor = torch.zeros_like(all_monomers_graph_embedding_tensor[0]).view(1, -1)
-
-                # get monomer bags embedding tensors
-                for idx_of_bag in range(len(batch_test_monomer_bags)):
-                    monomer_bags_graph_embedding = torch.zeros_like(all_monomers_graph_embedding_tensor[0])
-                    for monomer_idx in test_answer_dict[idx_of_bag][:-1]:
-                        monomer_bags_graph_embedding += all_monomers_graph_embedding_tensor[monomer_idx]
-                    monomer_bags_graph_embedding_tensor = torch.cat(
-                        [monomer_bags_graph_embedding_tensor, monomer_bags_graph_embedding.view(1, -1)], dim=0
-                    )
+                monomer_bags_graph_embedding_tensor = get_monomer_bags_graph_embedding_tensor(
+                    all_monomers_graph_embedding_tensor, get_monomer_bags_idx_tensor(test_answer_dict, device=device)
+                )
 
                 # encode
-                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor[1:])
+                z_samples, mus, log_vars = molecule_chef.mchef_module.encoder(monomer_bags_graph_embedding_tensor)
 
                 # property prediction
                 property_prediction = molecule_chef.mchef_module.property_network(mus)
@@ -7,11 +7,8 @@ import optuna
 
 from optuna.trial import TrialState
 
-from dask.distributed import Client, wait
-from dask_cuda import LocalCUDACluster
-from multiprocessing import Manager
+from multiprocessing import Manager, get_context
 from joblib import parallel_backend
-# "https://github.com/rapidsai/dask-cuda/issues/789"
 
 import time
 import random
@@ -31,6 +28,7 @@ from pathlib import Path
 from sklearn.model_selection import train_test_split
 
 from molecule_chef.mchef.molecule_chef_optuna import MoleculeChef
+from training.callbacks import OptunaPruningCallback
 from molecule_chef.module.ggnn_base import GGNNParams
 from molecule_chef.module.gated_graph_neural_network import GraphFeaturesStackIndexAdd
 from molecule_chef.module.encoder import Encoder
@@ -53,151 +51,165 @@ def get_number_of_backbone_atoms(target_mol):
     return backbone_length
 
 
+def get_objective_value(reconstruction_loss, divergence_loss, property_loss):
+    return reconstruction_loss + divergence_loss * 100 + property_loss * 10
+
+
 class Objective:
-    def __init__(self, gpu_queue):
-        # Shared queue to manage GPU IDs.
+    def __init__(self, gpu_queue=None):
+        # Shared queue to manage GPU IDs (None: train on CPU)
         self.gpu_queue = gpu_queue
 
     def __call__(self, trial):
+        if self.gpu_queue is None:
+            return self.optimize(trial, device=torch.device('cpu'))
+
         # Fetch GPU ID for this trial.
         gpu_id = self.gpu_queue.get()
-
-        # optimization
-        with torch.cuda.device(gpu_id):
-            # set torch details class
-            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-            print(device, flush=True)
-            torch_details = TorchDetails(device=device, data_type=torch.float32)
-
-            # set hyperparameters
-            # divergence_weight = trial.suggest_float(name="divergence_weight", low=1e-1, high=10, log=True)
-            # ggnn_num_layers = trial.suggest_int(name="ggnn_num_layers", low=1, high=3)
-            # graph_embedding_dim = trial.suggest_int(name="graph_embedding_dim", low=64, high=101)
-            # encoder_layer_1d_dim = trial.suggest_int(name='encoder_layer_1d_dim', low=48, high=64)
-            # latent_space_dim = trial.suggest_int(name="latent_space_dim", low=24, high=48)
-            # learning_rate = trial.suggest_float("learning_rate", low=1e-5, high=1e-2, log=True)
-            # decoder_num_of_layers = trial.suggest_int(name="decoder_num_of_layers", low=2, high=5)
-            # decoder_neural_net_hidden_dim = trial.suggest_int(name="decoder_neural_net_hidden_dim", low=64, high=101)
-
-            divergence_weight = trial.suggest_float(name="divergence_weight", low=1e-1, high=10, log=True)
-            latent_space_dim = trial.suggest_int(name="latent_space_dim", low=25, high=50)
-            learning_rate = trial.suggest_float("learning_rate", low=1e-5, high=1e-2, log=True)
-            ggnn_num_layers = 4
-            graph_embedding_dim = 50
-            encoder_layer_1d_dim = 200
-            decoder_num_of_layers = 2
-            decoder_neural_net_hidden_dim = 128
-
-            # atomic feature parameters for graph embeddings
-            atom_feature_parameters = AtomFeatureParams()
-
-            # set parameters
-            mchef_parameters = MChefParameters(
-                h_layer_size=atom_feature_parameters.atom_feature_length,  # 101
-                ggnn_num_layers=ggnn_num_layers,
-                graph_embedding_dim=graph_embedding_dim,
-                latent_dim=latent_space_dim,
-                encoder_layer_1d_dim=encoder_layer_1d_dim,
-                decoder_num_of_layers=decoder_num_of_layers,
-                decoder_max_steps=5,
-                decoder_neural_net_hidden_dim=[decoder_neural_net_hidden_dim],
-                property_network_hidden_sizes=[[32, 16]],
-                property_dim=1,  # property dimension
-                property_weights=(1.0,),
-                dtype=torch_details.data_type,
-                device=device,
-            )
-
-            # set gated graph neural network parameters
-            graph_neural_network_parameters = GGNNParams(
-                h_layer_size=mchef_parameters.h_layer_size,
-                edge_names=atom_feature_parameters.bond_names,
-                num_layers=mchef_parameters.ggnn_num_layers,
-                torch_details=torch_details
-            )
-
-            # set graph featurization networks
-            graph_featurization = GraphFeaturesStackIndexAdd(
-                neural_net_project=FullyConnectedNeuralNetwork(
-                    input_dim=mchef_parameters.h_layer_size,
-                    output_dim=mchef_parameters.graph_embedding_dim,
-                    hidden_sizes=[]
-                ),
-                neural_net_gate=FullyConnectedNeuralNetwork(
-                    input_dim=mchef_parameters.h_layer_size,
-                    output_dim=mchef_parameters.graph_embedding_dim,
-                    hidden_sizes=[]
-                ),
-                torch_details=torch_details
-            )
-
-            # graph neural network
-            graph_neural_network = GGNNSparse(
-                params=graph_neural_network_parameters, graph_feature=graph_featurization
-            ).to(device)
-
-            # set encoder
-            encoder = Encoder(
-                in_dimension=mchef_parameters.graph_embedding_dim,
-                layer_1d=mchef_parameters.encoder_layer_1d_dim,
-                latent_dimension=mchef_parameters.latent_dim
-            ).to(device)
-
-            # set decoder
-            decoder = Decoder(
-                number_of_layers=mchef_parameters.decoder_num_of_layers,
-                max_steps=mchef_parameters.decoder_max_steps,
-                graph_embedding_dim=mchef_parameters.graph_embedding_dim,
-                latent_dimension=mchef_parameters.latent_dim,
-                gru_neural_net_hidden_dim=mchef_parameters.decoder_neural_net_hidden_dim,
-                torch_details=torch_details
-            ).to(device)
-
-            # set property prediction network
-            property_network_module = PropertyNetworkPredictionModule(
-                latent_dim=mchef_parameters.latent_dim,
-                property_dim=mchef_parameters.property_dim,
-                property_network_hidden_dim_list=mchef_parameters.property_network_hidden_sizes,
-                dtype=torch_details.data_type,
-                device=torch_details.device,
-                weights=mchef_parameters.property_weights
-            ).to(device)
-
-            # set stop embedding
-            stop_embedding = nn.Parameter(
-                torch.empty(mchef_parameters.graph_embedding_dim, dtype=torch_details.data_type,
-                            device=torch_details.device)
-            )
-            bound = 1 / np.sqrt(mchef_parameters.graph_embedding_dim)
-            nn.init.uniform_(stop_embedding, -bound, bound)
-
-            # instantiate molecule chef class
-            molecule_chef = MoleculeChef(
-                graph_neural_network=graph_neural_network,
-                encoder=encoder,
-                decoder=decoder,
-                property_network=property_network_module,
-                stop_embedding=stop_embedding,
-                torch_details=torch_details
-            )
-
-            # train Molecule Chef
-            model_save_directory = os.path.join(save_directory,
-                                                f'divergence_weight_{divergence_weight:.3f}_latent_dim_{latent_space_dim}_learning_rate_{learning_rate:.3f}')
-            reconstruction_loss, divergence_loss, property_loss = molecule_chef.train(
-                num_epochs=60,
-                batch_size=32,
-                save_directory=model_save_directory,
-                lr=learning_rate,
-                weight_decay=1e-4,
-                mmd_weight=divergence_weight,
-                train_monomer_bags=train_monomer_bags,
-                test_monomer_bags=valid_monomer_bags,
-                unique_monomer_sets=unique_monomer_sets,
-                unique_mols=unique_mols,
-                train_property_data=train_property,
-                test_property_data=valid_property
-            )
+        try:
+            with torch.cuda.device(gpu_id):
+                return self.optimize(trial, device=torch.device('cuda'))
+        finally:
+            # return GPU ID to the queue (also for pruned trials)
+            time.sleep(random.randint(1, 8))
+            self.gpu_queue.put(gpu_id)
+
+    def optimize(self, trial, device):
+        # set torch details class
+        print(device, flush=True)
+        torch_details = TorchDetails(device=device, data_type=torch.float32)
+
+        # set hyperparameters
+        # divergence_weight = trial.suggest_float(name="divergence_weight", low=1e-1, high=10, log=True)
+        # ggnn_num_layers = trial.suggest_int(name="ggnn_num_layers", low=1, high=3)
+        # graph_embedding_dim = trial.suggest_int(name="graph_embedding_dim", low=64, high=101)
+        # encoder_layer_1d_dim = trial.suggest_int(name='encoder_layer_1d_dim', low=48, high=64)
+        # latent_space_dim = trial.suggest_int(name="latent_space_dim", low=24, high=48)
+        # learning_rate = trial.suggest_float("learning_rate", low=1e-5, high=1e-2, log=True)
+        # decoder_num_of_layers = trial.suggest_int(name="decoder_num_of_layers", low=2, high=5)
+        # decoder_neural_net_hidden_dim = trial.suggest_int(name="decoder_neural_net_hidden_dim", low=64, high=101)
+
+        divergence_weight = trial.suggest_float(name="divergence_weight", low=1e-1, high=10, log=True)
+        latent_space_dim = trial.suggest_int(name="latent_space_dim", low=25, high=50)
+        learning_rate = trial.suggest_float("learning_rate", low=1e-5, high=1e-2, log=True)
+        ggnn_num_layers = 4
+        graph_embedding_dim = 50
+        encoder_layer_1d_dim = 200
+        decoder_num_of_layers = 2
+        decoder_neural_net_hidden_dim = 128
+
+        # atomic feature parameters for graph embeddings
+        atom_feature_parameters = AtomFeatureParams()
+
+        # set parameters
+        mchef_parameters = MChefParameters(
+            h_layer_size=atom_feature_parameters.atom_feature_length,  # 101
+            ggnn_num_layers=ggnn_num_layers,
+            graph_embedding_dim=graph_embedding_dim,
+            latent_dim=latent_space_dim,
+            encoder_layer_1d_dim=encoder_layer_1d_dim,
+            decoder_num_of_layers=decoder_num_of_layers,
+            decoder_max_steps=5,
+            decoder_neural_net_hidden_dim=[decoder_neural_net_hidden_dim],
+            property_network_hidden_sizes=[[32, 16]],
+            property_dim=1,  # property dimension
+            property_weights=(1.0,),
+            dtype=torch_details.data_type,
+            device=device,
+        )
+
+        # set gated graph neural network parameters
+        graph_neural_network_parameters = GGNNParams(
+            h_layer_size=mchef_parameters.h_layer_size,
+            edge_names=atom_feature_parameters.bond_names,
+            num_layers=mchef_parameters.ggnn_num_layers,
+            torch_details=torch_details
+        )
+
+        # set graph featurization networks
+        graph_featurization = GraphFeaturesStackIndexAdd(
+            neural_net_project=FullyConnectedNeuralNetwork(
+                input_dim=mchef_parameters.h_layer_size,
+                output_dim=mchef_parameters.graph_embedding_dim,
+                hidden_sizes=[]
+            ),
+            neural_net_gate=FullyConnectedNeuralNetwork(
+                input_dim=mchef_parameters.h_layer_size,
+                output_dim=mchef_parameters.graph_embedding_dim,
+                hidden_sizes=[]
+            ),
+            torch_details=torch_details
+        )
+
+        # graph neural network
+        graph_neural_network = GGNNSparse(
+            params=graph_neural_network_parameters, graph_feature=graph_featurization
+        ).to(device)
+
+        # set encoder
+        encoder = Encoder(
+            in_dimension=mchef_parameters.graph_embedding_dim,
+            layer_1d=mchef_parameters.encoder_layer_1d_dim,
+            latent_dimension=mchef_parameters.latent_dim
+        ).to(device)
+
+        # set decoder
+        decoder = Decoder(
+            number_of_layers=mchef_parameters.decoder_num_of_layers,
+            max_steps=mchef_parameters.decoder_max_steps,
+            graph_embedding_dim=mchef_parameters.graph_embedding_dim,
+            latent_dimension=mchef_parameters.latent_dim,
+            gru_neural_net_hidden_dim=mchef_parameters.decoder_neural_net_hidden_dim,
+            torch_details=torch_details
+        ).to(device)
+
+        # set property prediction network
+        property_network_module = PropertyNetworkPredictionModule(
+            latent_dim=mchef_parameters.latent_dim,
+            property_dim=mchef_parameters.property_dim,
+            property_network_hidden_dim_list=mchef_parameters.property_network_hidden_sizes,
+            dtype=torch_details.data_type,
+            device=torch_details.device,
+            weights=mchef_parameters.property_weights
+        ).to(device)
+
+        # set stop embedding
+        stop_embedding = nn.Parameter(
+            torch.empty(mchef_parameters.graph_embedding_dim, dtype=torch_details.data_type,
+                        device=torch_details.device)
+        )
+        bound = 1 / np.sqrt(mchef_parameters.graph_embedding_dim)
+        nn.init.uniform_(stop_embedding, -bound, bound)
+
+        # instantiate molecule chef class
+        molecule_chef = MoleculeChef(
+            graph_neural_network=graph_neural_network,
+            encoder=encoder,
+            decoder=decoder,
+            property_network=property_network_module,
+            stop_embedding=stop_embedding,
+            torch_details=torch_details
+        )
+
+        # train Molecule Chef
+        model_save_directory = os.path.join(save_directory,
+                                            f'divergence_weight_{divergence_weight:.3f}_latent_dim_{latent_space_dim}_learning_rate_{learning_rate:.3f}')
+        reconstruction_loss, divergence_loss, property_loss = molecule_chef.train(
+            num_epochs=60,
+            batch_size=32,
+            save_directory=model_save_directory,
+            lr=learning_rate,
+            weight_decay=1e-4,
+            mmd_weight=divergence_weight,
+            train_monomer_bags=train_monomer_bags,
+            test_monomer_bags=valid_monomer_bags,
+            unique_monomer_sets=unique_monomer_sets,
+            unique_mols=unique_mols,
+            train_property_data=train_property,
+            test_property_data=valid_property,
+            mixed_precision=False,  # bfloat16 autocast (CPUs with AVX-512 BF16 / AMX)
+            callbacks=[OptunaPruningCallback(trial, objective=get_objective_value)]
+        )
 
         save_parameter_dict = dict()
         info = vars(mchef_parameters)
@@ -227,11 +239,7 @@ class Objective:
         # plot result
         molecule_chef.plot_learning_curve()
 
-        # return GPU ID to the queue
-        time.sleep(random.randint(1, 8))
-        self.gpu_queue.put(gpu_id)
-
-        return reconstruction_loss + divergence_loss * 100 + property_loss * 10
+        return get_objective_value(reconstruction_loss, divergence_loss, property_loss)
 
 
 def tune_hyperparameters():
@@ -258,6 +266,62 @@ def tune_hyperparameters():
                 n_jobs=n_gpus
             )
 
+    print_study_statistics(study)
+
+
+def get_storage(storage_url):
+    # wait for the SQLite lock of other processes
+    return optuna.storages.RDBStorage(url=storage_url, engine_kwargs={'connect_args': {'timeout': 100}})
+
+
+def optimize_on_cpu_cores(core_ids, storage_url, study_name, pruner, n_trials):
+    """
+    Run trials of the study in this process, pinned to core_ids with one torch thread per core
+    """
+    os.sched_setaffinity(0, core_ids)
+    torch.set_num_threads(len(core_ids))
+    study = optuna.load_study(study_name=study_name, storage=get_storage(storage_url), pruner=pruner)
+    study.optimize(func=Objective(), n_trials=n_trials)
+
+
+def tune_hyperparameters_cpu(n_workers, n_trials=32):
+    """
+    Tune hyperparameters using Optuna on CPU. n_workers processes share a SQLite storage in save_directory
+    and each runs trials on its own set of cores. Processes are forked (the data of __main__ is inherited).
+    Trials are pruned on the test objective of each epoch.
+    """
+    core_ids = sorted(os.sched_getaffinity(0))
+    cores_per_worker = len(core_ids) // n_workers
+    if cores_per_worker == 0:
+        raise ValueError(f'{n_workers} workers for {len(core_ids)} cores')
+
+    storage_url = 'sqlite:///' + os.path.join(save_directory, 'optuna.db')
+    study_name = 'mchef_optuna'
+    pruner = optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=10)
+    study = optuna.create_study(
+        study_name=study_name, storage=get_storage(storage_url), direction='minimize', pruner=pruner,
+        load_if_exists=True
+    )
+
+    context = get_context('fork')
+    processes = list()
+    for worker_idx in range(n_workers):
+        worker_core_ids = core_ids[worker_idx * cores_per_worker: (worker_idx + 1) * cores_per_worker]
+        worker_n_trials = n_trials // n_workers + int(worker_idx < n_trials % n_workers)
+        process = context.Process(
+            target=optimize_on_cpu_cores,
+            args=(worker_core_ids, storage_url, study_name, pruner, worker_n_trials)
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+    print_study_statistics(optuna.load_study(study_name=study_name, storage=get_storage(storage_url)))
+
+
+def print_study_statistics(study):
     pruned_trials = [t for t in study.trials if t.state == optuna.trial.TrialState.PRUNED]
     complete_trials = [t for t in study.trials if t.state == optuna.trial.TrialState.COMPLETE]
 
@@ -280,9 +344,17 @@ def tune_hyperparameters():
 
 
 if __name__ == '__main__':
+    # without GPUs, run trials in a process pool over core sets (tune_hyperparameters_cpu)
+    use_cpu = not torch.cuda.is_available()
+    n_cpu_workers = 8
+
     # set clients
-    cluster = LocalCUDACluster()
-    client = Client(cluster)
+    if not use_cpu:
+        from dask.distributed import Client
+        from dask_cuda import LocalCUDACluster
+        # "https://github.com/rapidsai/dask-cuda/issues/789"
+        cluster = LocalCUDACluster()
+        client = Client(cluster)
 
     # set environments
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -389,4 +461,7 @@ if __name__ == '__main__':
     save_model(test_property, save_directory=save_directory, name='test_property.pth')
     save_model(unique_monomer_sets, save_directory=save_directory, name='unique_monomer_sets.pth')
 
-    tune_hyperparameters()
+    if use_cpu:
+        tune_hyperparameters_cpu(n_workers=n_cpu_workers)
+    else:
+        tune_hyperparameters()
@@ -0,0 +1,167 @@
+import os
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+
+from pathlib import Path
+from sklearn.preprocessing import StandardScaler
+
+sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
+from vae.decoder.torch import Decoder
+from vae.encoder.torch import CNNEncoder
+from vae.preprocess import load_label_encoding
+from vae.property_predictor.torch import PropertyNetworkPredictionModule
+from vae.training_optuna import train_model
+from vae.utils.dataset import SelfiesLabelDataset
+from vae.utils.save import VAEParameters
+
+
+def pin_to_local_cores(local_rank, local_world_size):
+    """
+    Pin this process to a contiguous block of the available cores (one socket if there is a process per socket)
+    with one torch thread per core. torchrun sets OMP_NUM_THREADS=1 otherwise.
+    """
+    core_ids = sorted(os.sched_getaffinity(0))
+    cores_per_process = len(core_ids) // local_world_size
+    if cores_per_process == 0:
+        raise ValueError(f'{local_world_size} processes for {len(core_ids)} cores')
+
+    local_core_ids = core_ids[local_rank * cores_per_process: (local_rank + 1) * cores_per_process]
+    os.sched_setaffinity(0, local_core_ids)
+    torch.set_num_threads(len(local_core_ids))
+
+
+if __name__ == '__main__':
+    # data parallel training on CPU (gloo) - one process per socket
+    # torchrun --standalone --nproc_per_node=2 vae_distributed.py
+    dist.init_process_group(backend='gloo')
+    rank = dist.get_rank()
+    pin_to_local_cores(local_rank=int(os.environ['LOCAL_RANK']),
+                       local_world_size=int(os.environ['LOCAL_WORLD_SIZE']))
+    device = torch.device('cpu')
+    dtype = torch.float32
+
+    # label encoding, alphabet, split and properties saved by vae_optuna_parallel.py
+    load_directory = '/home/sk77/PycharmProjects/publish/OMG/train/all/vae_optuna_10000_6000_3000_500_objective_1_10_10_1e-5_weight_decay'
+    save_directory = os.path.join(load_directory, 'distributed')
+    if rank == 0 and not os.path.exists(save_directory):
+        Path(save_directory).mkdir(parents=True)
+    dist.barrier()
+
+    encoding_alphabet = torch.load(os.path.join(load_directory, 'encoding_alphabet.pth'))
+    data, _ = load_label_encoding(load_directory, mmap_mode='r')
+    len_max_molec = data.shape[1]
+    len_alphabet = len(encoding_alphabet)
+    nop_idx = encoding_alphabet.index('[nop]')
+    asterisk_idx = encoding_alphabet.index('[*]')
+
+    train_monomer_bags_idx = torch.load(os.path.join(load_directory, 'train_idx.pth'))
+    valid_monomer_bags_idx = torch.load(os.path.join(load_directory, 'valid_idx.pth'))
+    property_value = torch.load(os.path.join(load_directory, 'property_value.pth'))
+
+    # property scaling
+    property_scaler = StandardScaler()
+    property_train_scaled = property_scaler.fit_transform(property_value[train_monomer_bags_idx])
+    property_valid_scaled = property_scaler.transform(property_value[valid_monomer_bags_idx])
+
+    labels_path = os.path.join(load_directory, 'selfies_labels.npy')
+    dataset_train = SelfiesLabelDataset(labels_path, property_train_scaled, indices=train_monomer_bags_idx)
+    dataset_valid = SelfiesLabelDataset(labels_path, property_valid_scaled, indices=valid_monomer_bags_idx)
+
+    # set VAE parameters
+    vae_parameters = VAEParameters(
+        data_path=labels_path,
+        save_directory=save_directory,
+        nop_idx=nop_idx,
+        asterisk_idx=asterisk_idx,
+        latent_dimension=256,
+        encoder_in_channels=len_alphabet,
+        encoder_feature_dim=len_max_molec,
+        encoder_convolution_channel_dim=[9, 9, 9],
+        encoder_kernel_size=[9, 9, 9],
+        encoder_layer_1d=1024,
+        encoder_layer_2d=512,
+        decoder_input_dimension=len_alphabet,
+        decoder_output_dimension=len_alphabet,
+        decoder_num_gru_layers=4,
+        decoder_bidirectional=True,
+        property_dim=1,
+        property_network_hidden_dim_list=[[64, 16]],
+        property_weights=(0.5,),
+        dtype=dtype,
+        device=device,
+        test_size=0.1,
+        random_state=42
+    )
+
+    # the same initial models in all processes (DDP also broadcasts the parameters of rank 0)
+    torch.manual_seed(42)
+    encoder = CNNEncoder(
+        in_channels=vae_parameters.encoder_in_channels,
+        feature_dim=vae_parameters.encoder_feature_dim,
+        convolution_channel_dim=vae_parameters.encoder_convolution_channel_dim,
+        kernel_size=vae_parameters.encoder_kernel_size,
+        layer_1d=vae_parameters.encoder_layer_1d,
+        layer_2d=vae_parameters.encoder_layer_2d,
+        latent_dimension=vae_parameters.latent_dimension
+    ).to(device)
+
+    decoder = Decoder(
+        input_size=vae_parameters.decoder_input_dimension,
+        num_layers=vae_parameters.decoder_num_gru_layers,
+        hidden_size=vae_parameters.latent_dimension,
+        out_dimension=vae_parameters.decoder_output_dimension,
+        bidirectional=vae_parameters.decoder_bidirectional
+    ).to(device)
+
+    property_network_module = PropertyNetworkPredictionModule(
+        latent_dim=vae_parameters.latent_dimension,
+        property_dim=vae_parameters.property_dim,
+        property_network_hidden_dim_list=vae_parameters.property_network_hidden_dim_list,
+        dtype=dtype,
+        device=device,
+        weights=vae_parameters.property_weights
+    ).to(device)
+
+    # different reparameterization noise in each process
+    torch.manual_seed(42 + rank)
+
+    print("start training", flush=True)
+    start = time.time()
+    reconstruction_loss, divergence_loss, property_loss = train_model(
+        vae_encoder=encoder,
+        vae_decoder=decoder,
+        property_predictor=property_network_module,
+        nop_idx=vae_parameters.nop_idx,
+        asterisk_idx=vae_parameters.asterisk_idx,
+        data_train=dataset_train,
+        data_valid=dataset_valid,
+        y_train=None,
+        y_valid=None,
+        y_scaler=property_scaler,
+        num_epochs=60,
+        batch_size=32,  # per process
+        lr_enc=1e-4,
+        lr_dec=1e-4,
+        lr_property=1e-4,
+        weight_decay=1e-5,
+        mmd_weight=1.0,
+        save_directory=save_directory,
+        dtype=dtype,
+        device=device,
+        num_workers=2,
+        prefetch_factor=4,
+        checkpoint_path=os.path.join(save_directory, 'checkpoint.pth'),
+        distributed=True
+    )
+
+    if rank == 0:
+        # save parameter
+        torch.save(vars(vae_parameters).copy(), os.path.join(save_directory, 'vae_parameters.pth'))
+
+        end = time.time()
+        print("total %.3f minutes took for training" % ((end - start) / 60.0), flush=True)
+
+    dist.destroy_process_group()
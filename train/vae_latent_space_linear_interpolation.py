@@ -32,6 +32,7 @@ from rdkit.Chem.rdmolops import GetShortestPath
 
 
 from vae.preprocess import get_selfie_and_smiles_encodings_for_dataset, multiple_smile_to_hot, multiple_selfies_to_hot
+from vae.utils.evaluation import indices_to_selfies
 from vae.decoder.torch import Decoder
 from vae.encoder.torch import CNNEncoder
 from vae.property_predictor.torch import PropertyNetworkPredictionModule
@@ -53,17 +54,13 @@ def reconstruct_polymers(encoding_alphabet, one_hot_encoded_vector):
     # set parameters
     reconstructed_molecules = []
 
-    molecules_num = one_hot_encoded_vector.shape[0]
-    reconstruct_one_hot = one_hot_encoded_vector.clone().detach()
-    for recon_idx in range(molecules_num):
-        gathered_atoms = ''
-        one_hot_idx = reconstruct_one_hot[recon_idx]
-        for recon_value in one_hot_idx:
-            gathered_atoms += encoding_alphabet[recon_value]
-
-        generated_molecule = gathered_atoms.replace('[nop]', '')
-        generated_molecule = '[*]' + generated_molecule  # add the first asterisk
-        smiles_generated_molecule = sf.decoder(generated_molecule)
+    # add the first asterisk
+    generated_molecule_list = indices_to_selfies(encoding_alphabet, one_hot_encoded_vector, prefix='[*]')
+    smiles_generated_molecule_list = sf.batch_decoder(generated_molecule_list)
+    for generated_molecule, smiles_generated_molecule in zip(generated_molecule_list, smiles_generated_molecule_list):
+        if smiles_generated_molecule is None:
+            reconstructed_molecules.append(None)
+            continue
 
         # convert to canonical smiles
         mol = Chem.MolFromSmiles(smiles_generated_molecule)
@@ -163,6 +160,7 @@ if __name__ == '__main__':
     # load SELFIES data - due to the random order
     encoding_list = torch.load(os.path.join(save_directory, 'encoding_list.pth'))
     encoding_alphabet = torch.load(os.path.join(save_directory, 'encoding_alphabet.pth'))
+    sf.warm_symbol_caches(encoding_alphabet)  # decoding of generated SELFIES
     largest_molecule_len = torch.load(os.path.join(save_directory, 'largest_molecule_len.pth'))
 
     # set encoder
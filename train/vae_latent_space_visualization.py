@@ -92,6 +92,7 @@ if __name__ == '__main__':
     # load SELFIES data - due to the random order
     encoding_list = torch.load(os.path.join(save_directory, 'encoding_list.pth'))
     encoding_alphabet = torch.load(os.path.join(save_directory, 'encoding_alphabet.pth'))
+    sf.warm_symbol_caches(encoding_alphabet)  # decoding of generated SELFIES
     largest_molecule_len = torch.load(os.path.join(save_directory, 'largest_molecule_len.pth'))
 
     print('[VAE] Constructing selfies one_hot_encoded vectors..', flush=True)
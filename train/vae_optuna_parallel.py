@@ -1,5 +1,4 @@
 import os
-import pickle
 import sys
 import time
 import torch
@@ -10,13 +9,11 @@ import pandas as pd
 
 import optuna
 
+from optuna.storages import RetryFailedTrialCallback
 from optuna.trial import TrialState
 
-from dask.distributed import Client, wait
-from dask_cuda import LocalCUDACluster
-from multiprocessing import Manager
+from multiprocessing import Manager, get_context
 from joblib import parallel_backend
-# "https://github.com/rapidsai/dask-cuda/issues/789"
 
 from pathlib import Path
 
@@ -30,9 +27,12 @@ from sklearn.preprocessing import StandardScaler
 sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
 from vae.decoder.torch import Decoder
 from vae.encoder.torch import CNNEncoder
-from vae.preprocess import get_selfie_and_smiles_encodings_for_dataset, multiple_selfies_to_hot
+from vae.preprocess import get_selfie_and_smiles_encodings_for_dataset, multiple_selfies_to_label, \
+    save_label_encoding, load_label_encoding
 from vae.property_predictor.torch import PropertyNetworkPredictionModule
 from vae.training_optuna import train_model
+from training.callbacks import OptunaPruningCallback
+from vae.utils.dataset import SelfiesLabelDataset
 from vae.utils.save import VAEParameters
 
 
@@ -48,171 +48,189 @@ def get_number_of_backbone_atoms(target_mol):
     return backbone_length
 
 
+def get_objective_value(reconstruction_loss, divergence_loss, property_loss):
+    return reconstruction_loss + divergence_loss * 10 + property_loss * 10
+
+
 class Objective:
-    def __init__(self, gpu_queue):
-        # Shared queue to manage GPU IDs.
+    def __init__(self, gpu_queue=None):
+        # Shared queue to manage GPU IDs (None: train on CPU)
         self.gpu_queue = gpu_queue
 
     def __call__(self, trial):
+        if self.gpu_queue is None:
+            return self.optimize(trial, device=torch.device('cpu'))
+
         # Fetch GPU ID for this trial.
         gpu_id = self.gpu_queue.get()
-
-        # optimization
-        with torch.cuda.device(gpu_id):
-            # set torch details class
-            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-            print(device, flush=True)
-            dtype = torch.float32
-
-            # set hyperparameters
-            divergence_weight = trial.suggest_float(name="divergence_weight", low=1e-1, high=10, log=True)
-            latent_space_dim = trial.suggest_int(name="latent_space_dim", low=64, high=512, log=True)
-            learning_rate = trial.suggest_float(name="learning_rate", low=1e-5, high=1e-2, log=True)
-
-            # encoder_layer_1d = trial.suggest_int(name="encoder_layer_1d", low=512, high=1024, log=True)
-            # encoder_layer_2d = trial.suggest_int(name="encoder_layer_2d", low=256, high=512, log=True)
-            encoder_layer_1d = 1024
-            encoder_layer_2d = 512
-
-            # CNN parameters
-            # channel_1_dim = trial.suggest_categorical(name="channel_1", choices=[3, 5, 7, 9])
-            # kernel_1_dim = trial.suggest_categorical(name="kernel_1", choices=[3, 5, 7, 9])
-            #
-            # channel_2_dim = trial.suggest_categorical(name="channel_2", choices=[3, 5, 7, 9])
-            # kernel_2_dim = trial.suggest_categorical(name="kernel_2", choices=[3, 5, 7, 9])
-            #
-            # channel_3_dim = trial.suggest_categorical(name="channel_3", choices=[3, 5, 7, 9])
-            # kernel_3_dim = trial.suggest_categorical(name="kernel_3", choices=[3, 5, 7, 9])
-            channel_1_dim = 9
-            kernel_1_dim = 9
-
-            channel_2_dim = 9
-            kernel_2_dim = 9
-
-            channel_3_dim = 9
-            kernel_3_dim = 9
-
-            # decoder parameter
-            # decoder_num_gru_layers = trial.suggest_int(name="decoder_num_gru_layers", low=2, high=8)
-            decoder_num_gru_layers = 4
-
-            data_train_tensor = torch.tensor(data_train, dtype=dtype).to(device)
-            data_valid_tensor = torch.tensor(data_valid, dtype=dtype).to(device)
-            y_train_tensor = torch.tensor(property_train_scaled, dtype=dtype).to(device)
-            y_valid_tensor = torch.tensor(property_valid_scaled, dtype=dtype).to(device)
-
-            # set VAE parameters
-            vae_parameters = VAEParameters(
-                data_path=data_path,
-                save_directory=save_directory,
-                nop_idx=nop_idx,
-                asterisk_idx=asterisk_idx,
-                latent_dimension=latent_space_dim,
-                encoder_in_channels=data.shape[2],
-                encoder_feature_dim=data.shape[1],
-                encoder_convolution_channel_dim=[channel_1_dim, channel_2_dim, channel_3_dim],
-                encoder_kernel_size=[kernel_1_dim, kernel_2_dim, kernel_3_dim],
-                encoder_layer_1d=encoder_layer_1d,
-                encoder_layer_2d=encoder_layer_2d,
-                decoder_input_dimension=len_alphabet,
-                decoder_output_dimension=len_alphabet,
-                decoder_num_gru_layers=decoder_num_gru_layers,
-                decoder_bidirectional=True,
-                property_dim=1,
-                property_network_hidden_dim_list=[[64, 16]],
-                property_weights=(0.5,),
-                dtype=dtype,
-                device=device,
-                test_size=0.1,
-                random_state=42
-            )
-
-            # set encoder
-            encoder = CNNEncoder(
-                in_channels=vae_parameters.encoder_in_channels,
-                feature_dim=vae_parameters.encoder_feature_dim,
-                convolution_channel_dim=vae_parameters.encoder_convolution_channel_dim,
-                kernel_size=vae_parameters.encoder_kernel_size,
-                layer_1d=vae_parameters.encoder_layer_1d,
-                layer_2d=vae_parameters.encoder_layer_2d,
-                latent_dimension=vae_parameters.latent_dimension
-            ).to(device)
-
-            # set decoder
-            decoder = Decoder(
-                input_size=vae_parameters.decoder_input_dimension,
-                num_layers=vae_parameters.decoder_num_gru_layers,
-                hidden_size=vae_parameters.latent_dimension,
-                out_dimension=vae_parameters.decoder_output_dimension,
-                bidirectional=vae_parameters.decoder_bidirectional
-            ).to(device)
-
-            # set property prediction network
-            property_network_module = PropertyNetworkPredictionModule(
-                latent_dim=vae_parameters.latent_dimension,
-                property_dim=vae_parameters.property_dim,
-                property_network_hidden_dim_list=vae_parameters.property_network_hidden_dim_list,
-                dtype=dtype,
-                device=device,
-                weights=vae_parameters.property_weights
-            ).to(device)
-
-            # training
-            model_save_directory = os.path.join(save_directory,
-                                                f'divergence_weight_{divergence_weight:.3f}_latent_dim_{latent_space_dim}_learning_rate_{learning_rate:.3f}')
-            if not os.path.exists(model_save_directory):
-                Path(model_save_directory).mkdir(parents=True)
-
-            print("start training", flush=True)
-            start = time.time()
-            reconstruction_loss, divergence_loss, property_loss = train_model(
-                vae_encoder=encoder,
-                vae_decoder=decoder,
-                property_predictor=property_network_module,
-                nop_idx=vae_parameters.nop_idx,
-                asterisk_idx=vae_parameters.asterisk_idx,
-                data_train=data_train_tensor,
-                data_valid=data_valid_tensor,
-                y_train=y_train_tensor,
-                y_valid=y_valid_tensor,
-                y_scaler=property_scaler,
-                num_epochs=60,
-                batch_size=32,
-                lr_enc=learning_rate,
-                lr_dec=learning_rate,
-                lr_property=learning_rate,
-                weight_decay=1e-5,
-                mmd_weight=divergence_weight,
-                save_directory=model_save_directory,
-                dtype=dtype,
-                device=device
-            )
-
-            # save parameter
-            save_parameter_dict = dict()
-            info = vars(vae_parameters)
-            for key, value in info.items():
-                save_parameter_dict[key] = value
-
-            torch.save(save_parameter_dict, os.path.join(model_save_directory, 'vae_parameters.pth'))
-
-            end = time.time()
-            print("total %.3f minutes took for training" % ((end - start) / 60.0), flush=True)
-
-            # return GPU ID to the queue
+        try:
+            with torch.cuda.device(gpu_id):
+                return self.optimize(trial, device=torch.device('cuda'))
+        finally:
+            # return GPU ID to the queue (also for pruned trials)
             time.sleep(random.randint(1, 8))
             self.gpu_queue.put(gpu_id)
 
-            return reconstruction_loss + divergence_loss * 10 + property_loss * 10
+    def optimize(self, trial, device):
+        print(device, flush=True)
+        dtype = torch.float32
+
+        # set hyperparameters
+        divergence_weight = trial.suggest_float(name="divergence_weight", low=1e-1, high=10, log=True)
+        latent_space_dim = trial.suggest_int(name="latent_space_dim", low=64, high=512, log=True)
+        learning_rate = trial.suggest_float(name="learning_rate", low=1e-5, high=1e-2, log=True)
+
+        # encoder_layer_1d = trial.suggest_int(name="encoder_layer_1d", low=512, high=1024, log=True)
+        # encoder_layer_2d = trial.suggest_int(name="encoder_layer_2d", low=256, high=512, log=True)
+        encoder_layer_1d = 1024
+        encoder_layer_2d = 512
+
+        # CNN parameters
+        # channel_1_dim = trial.suggest_categorical(name="channel_1", choices=[3, 5, 7, 9])
+        # kernel_1_dim = trial.suggest_categorical(name="kernel_1", choices=[3, 5, 7, 9])
+        #
+        # channel_2_dim = trial.suggest_categorical(name="channel_2", choices=[3, 5, 7, 9])
+        # kernel_2_dim = trial.suggest_categorical(name="kernel_2", choices=[3, 5, 7, 9])
+        #
+        # channel_3_dim = trial.suggest_categorical(name="channel_3", choices=[3, 5, 7, 9])
+        # kernel_3_dim = trial.suggest_categorical(name="kernel_3", choices=[3, 5, 7, 9])
+        channel_1_dim = 9
+        kernel_1_dim = 9
+
+        channel_2_dim = 9
+        kernel_2_dim = 9
+
+        channel_3_dim = 9
+        kernel_3_dim = 9
+
+        # decoder parameter
+        # decoder_num_gru_layers = trial.suggest_int(name="decoder_num_gru_layers", low=2, high=8)
+        decoder_num_gru_layers = 4
+
+        # set VAE parameters
+        vae_parameters = VAEParameters(
+            data_path=data_path,
+            save_directory=save_directory,
+            nop_idx=nop_idx,
+            asterisk_idx=asterisk_idx,
+            latent_dimension=latent_space_dim,
+            encoder_in_channels=len_alphabet,
+            encoder_feature_dim=len_max_molec,
+            encoder_convolution_channel_dim=[channel_1_dim, channel_2_dim, channel_3_dim],
+            encoder_kernel_size=[kernel_1_dim, kernel_2_dim, kernel_3_dim],
+            encoder_layer_1d=encoder_layer_1d,
+            encoder_layer_2d=encoder_layer_2d,
+            decoder_input_dimension=len_alphabet,
+            decoder_output_dimension=len_alphabet,
+            decoder_num_gru_layers=decoder_num_gru_layers,
+            decoder_bidirectional=True,
+            property_dim=1,
+            property_network_hidden_dim_list=[[64, 16]],
+            property_weights=(0.5,),
+            dtype=dtype,
+            device=device,
+            test_size=0.1,
+            random_state=42
+        )
+
+        # set encoder
+        encoder = CNNEncoder(
+            in_channels=vae_parameters.encoder_in_channels,
+            feature_dim=vae_parameters.encoder_feature_dim,
+            convolution_channel_dim=vae_parameters.encoder_convolution_channel_dim,
+            kernel_size=vae_parameters.encoder_kernel_size,
+            layer_1d=vae_parameters.encoder_layer_1d,
+            layer_2d=vae_parameters.encoder_layer_2d,
+            latent_dimension=vae_parameters.latent_dimension
+        ).to(device)
+
+        # set decoder
+        decoder = Decoder(
+            input_size=vae_parameters.decoder_input_dimension,
+            num_layers=vae_parameters.decoder_num_gru_layers,
+            hidden_size=vae_parameters.latent_dimension,
+            out_dimension=vae_parameters.decoder_output_dimension,
+            bidirectional=vae_parameters.decoder_bidirectional
+        ).to(device)
+
+        # set property prediction network
+        property_network_module = PropertyNetworkPredictionModule(
+            latent_dim=vae_parameters.latent_dimension,
+            property_dim=vae_parameters.property_dim,
+            property_network_hidden_dim_list=vae_parameters.property_network_hidden_dim_list,
+            dtype=dtype,
+            device=device,
+            weights=vae_parameters.property_weights
+        ).to(device)
+
+        # training
+        # a trial retried after its worker died (RetryFailedTrialCallback) resumes the checkpoint of the failed trial
+        retried_trial_number = RetryFailedTrialCallback.retried_trial_number(trial)
+        trial_number = trial.number if retried_trial_number is None else retried_trial_number
+        model_save_directory = os.path.join(save_directory, f'trial_{trial_number}')
+        if not os.path.exists(model_save_directory):
+            Path(model_save_directory).mkdir(parents=True)
+        checkpoint_path = os.path.join(model_save_directory, 'checkpoint.pth')
+        if retried_trial_number is None and os.path.exists(checkpoint_path):
+            # left by an earlier study in save_directory (trial numbers restart at 0): train from scratch
+            os.remove(checkpoint_path)
+
+        print("start training", flush=True)
+        start = time.time()
+        reconstruction_loss, divergence_loss, property_loss = train_model(
+            vae_encoder=encoder,
+            vae_decoder=decoder,
+            property_predictor=property_network_module,
+            nop_idx=vae_parameters.nop_idx,
+            asterisk_idx=vae_parameters.asterisk_idx,
+            data_train=dataset_train,
+            data_valid=dataset_valid,
+            y_train=None,
+            y_valid=None,
+            y_scaler=property_scaler,
+            num_epochs=60,
+            batch_size=32,
+            lr_enc=learning_rate,
+            lr_dec=learning_rate,
+            lr_property=learning_rate,
+            weight_decay=1e-5,
+            mmd_weight=divergence_weight,
+            save_directory=model_save_directory,
+            dtype=dtype,
+            device=device,
+            num_workers=4,
+            pin_memory=device.type == 'cuda',
+            prefetch_factor=4,
+            mixed_precision=False,  # bfloat16 autocast (CPUs with AVX-512 BF16 / AMX)
+            checkpoint_path=checkpoint_path,  # resume a retried trial
+            callbacks=[OptunaPruningCallback(trial, objective=get_objective_value)],
+            run_config=dict(trial.params)  # a checkpoint of other hyperparameters is not resumed
+        )
+
+        # save parameter
+        save_parameter_dict = dict()
+        info = vars(vae_parameters)
+        for key, value in info.items():
+            save_parameter_dict[key] = value
+
+        torch.save(save_parameter_dict, os.path.join(model_save_directory, 'vae_parameters.pth'))
+
+        end = time.time()
+        print("total %.3f minutes took for training" % ((end - start) / 60.0), flush=True)
+
+        return get_objective_value(reconstruction_loss, divergence_loss, property_loss)
 
 
 def tune_hyperparameters():
     """
     Tune hyperparmeters using Optuna
     https://github.com/optuna/optuna/issues/1365
+    Trials are stored in a SQLite storage in save_directory (shared with tune_hyperparameters_cpu), so trial numbers
+    continue over runs and failed trials are retried.
     """
+    storage_url = 'sqlite:///' + os.path.join(save_directory, 'optuna.db')
     study = optuna.create_study(
-        direction='minimize'
+        study_name='vae_optuna', storage=get_storage(storage_url), direction='minimize', load_if_exists=True
     )
 
     # parallel optimization
@@ -232,6 +250,66 @@ def tune_hyperparameters():
                 n_jobs=n_gpus
             )
 
+    print_study_statistics(study)
+
+
+def get_storage(storage_url):
+    # wait for the SQLite lock of other processes. Trials of a dead worker (no heartbeat for grace_period seconds)
+    # are failed and retried with the same hyperparameters
+    return optuna.storages.RDBStorage(
+        url=storage_url, engine_kwargs={'connect_args': {'timeout': 100}}, heartbeat_interval=60, grace_period=120,
+        failed_trial_callback=RetryFailedTrialCallback(max_retry=3)
+    )
+
+
+def optimize_on_cpu_cores(core_ids, storage_url, study_name, pruner, n_trials):
+    """
+    Run trials of the study in this process, pinned to core_ids with one torch thread per core
+    """
+    os.sched_setaffinity(0, core_ids)
+    torch.set_num_threads(len(core_ids))
+    study = optuna.load_study(study_name=study_name, storage=get_storage(storage_url), pruner=pruner)
+    study.optimize(func=Objective(), n_trials=n_trials)
+
+
+def tune_hyperparameters_cpu(n_workers, n_trials=32):
+    """
+    Tune hyperparameters using Optuna on CPU. n_workers processes share a SQLite storage in save_directory
+    and each runs trials on its own set of cores. Processes are forked (the data of __main__ is inherited).
+    Trials are pruned on the validation objective of each epoch.
+    """
+    core_ids = sorted(os.sched_getaffinity(0))
+    cores_per_worker = len(core_ids) // n_workers
+    if cores_per_worker == 0:
+        raise ValueError(f'{n_workers} workers for {len(core_ids)} cores')
+
+    storage_url = 'sqlite:///' + os.path.join(save_directory, 'optuna.db')
+    study_name = 'vae_optuna'
+    pruner = optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=10)
+    study = optuna.create_study(
+        study_name=study_name, storage=get_storage(storage_url), direction='minimize', pruner=pruner,
+        load_if_exists=True
+    )
+
+    context = get_context('fork')
+    processes = list()
+    for worker_idx in range(n_workers):
+        worker_core_ids = core_ids[worker_idx * cores_per_worker: (worker_idx + 1) * cores_per_worker]
+        worker_n_trials = n_trials // n_workers + int(worker_idx < n_trials % n_workers)
+        process = context.Process(
+            target=optimize_on_cpu_cores,
+            args=(worker_core_ids, storage_url, study_name, pruner, worker_n_trials)
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+    print_study_statistics(optuna.load_study(study_name=study_name, storage=get_storage(storage_url)))
+
+
+def print_study_statistics(study):
     pruned_trials = [t for t in study.trials if t.state == optuna.trial.TrialState.PRUNED]
     complete_trials = [t for t in study.trials if t.state == optuna.trial.TrialState.COMPLETE]
 
@@ -254,9 +332,17 @@ def tune_hyperparameters():
 
 
 if __name__ == '__main__':
+    # without GPUs, run trials in a process pool over core sets (tune_hyperparameters_cpu)
+    use_cpu = not torch.cuda.is_available()
+    n_cpu_workers = 8
+
     # set clients
-    cluster = LocalCUDACluster()
-    client = Client(cluster)
+    if not use_cpu:
+        from dask.distributed import Client
+        from dask_cuda import LocalCUDACluster
+        # "https://github.com/rapidsai/dask-cuda/issues/789"
+        cluster = LocalCUDACluster()
+        client = Client(cluster)
 
     # set environments
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -283,25 +369,29 @@ if __name__ == '__main__':
 
     print('Representation: SELFIES', flush=True)
     encoding_list, encoding_alphabet, largest_molecule_len, _, _, _ = \
-        get_selfie_and_smiles_encodings_for_dataset(df_polymer)
-    print('--> Creating one-hot encoding...', flush=True)
-    data = multiple_selfies_to_hot(encoding_list, largest_molecule_len, encoding_alphabet)
-    print('Finished creating one-hot encoding.', flush=True)
+        get_selfie_and_smiles_encodings_for_dataset(df_polymer, vocabulary_path=os.path.join(save_directory, 'vocabulary.json'))
+    print('--> Creating label encoding...', flush=True)
+    labels, lengths = multiple_selfies_to_label(encoding_list, largest_molecule_len, encoding_alphabet)
+    print('Finished creating label encoding.', flush=True)
 
     # exclude the first character - [*]
-    data = data[:, 1:, :]
+    labels = labels[:, 1:]
+    lengths = lengths - 1
 
     # save data - due to the random order
-    torch.save(data, os.path.join(save_directory, 'data.pth'), pickle_protocol=pickle.HIGHEST_PROTOCOL)
+    save_label_encoding(save_directory, labels, lengths)
     torch.save(encoding_list, os.path.join(save_directory, 'encoding_list.pth'))
     torch.save(encoding_alphabet, os.path.join(save_directory, 'encoding_alphabet.pth'))
     torch.save(largest_molecule_len, os.path.join(save_directory, 'largest_molecule_len.pth'))
 
+    # memory map the saved label encoding
+    data, lengths = load_label_encoding(save_directory, mmap_mode='r')
+
     # set parameters
     print(data.shape, flush=True)
     len_max_molec = data.shape[1]
     print(len_max_molec, flush=True)
-    len_alphabet = data.shape[2]
+    len_alphabet = len(encoding_alphabet)
     print(len_alphabet, flush=True)
 
     nop_idx = 0
@@ -346,8 +436,6 @@ if __name__ == '__main__':
     property_value = df_polymer['LogP'].to_numpy().reshape(-1, 1)
     torch.save(property_value, os.path.join(save_directory, 'property_value.pth'))
 
-    data_train = data[train_monomer_bags_idx]
-    data_valid = data[valid_monomer_bags_idx]
     property_train = property_value[train_monomer_bags_idx]
     property_valid = property_value[valid_monomer_bags_idx]
 
@@ -356,6 +444,15 @@ if __name__ == '__main__':
     property_train_scaled = property_scaler.fit_transform(property_train)
     property_valid_scaled = property_scaler.transform(property_valid)
 
-    tune_hyperparameters()
+    # label encoded data (uint8 / int16) read from the memory mapped file by DataLoader workers
+    # and expanded to one-hot vectors per batch on the device
+    labels_path = os.path.join(save_directory, 'selfies_labels.npy')
+    dataset_train = SelfiesLabelDataset(labels_path, property_train_scaled, indices=train_monomer_bags_idx)
+    dataset_valid = SelfiesLabelDataset(labels_path, property_valid_scaled, indices=valid_monomer_bags_idx)
+
+    if use_cpu:
+        tune_hyperparameters_cpu(n_workers=n_cpu_workers)
+    else:
+        tune_hyperparameters()
 
 
@@ -8,7 +8,6 @@ sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
 import selfies as sf
 
 import torch
-import torch.nn.functional as f
 
 from torch.distributions.multivariate_normal import MultivariateNormal
 
@@ -27,23 +26,20 @@ from vae.decoder.torch import Decoder
 from vae.encoder.torch import Encoder, CNNEncoder
 from vae.property_predictor.torch import PropertyNetworkPredictionModule
 from vae.preprocess import get_selfie_and_smiles_encodings_for_dataset, multiple_smile_to_hot, multiple_selfies_to_hot
+from vae.utils.evaluation import indices_to_selfies
 
 
 def reconstruct_polymers(encoding_alphabet, one_hot_encoded_vector):
     # set parameters
     reconstructed_molecules = []
 
-    molecules_num = one_hot_encoded_vector.shape[0]
-    reconstruct_one_hot = one_hot_encoded_vector.clone().detach()
-    for recon_idx in range(molecules_num):
-        gathered_atoms = ''
-        one_hot_idx = reconstruct_one_hot[recon_idx]
-        for recon_value in one_hot_idx:
-            gathered_atoms += encoding_alphabet[recon_value]
-
-        generated_molecule = gathered_atoms.replace('[nop]', '')
-        generated_molecule = '[*]' + generated_molecule  # add the first asterisk
-        smiles_generated_molecule = sf.decoder(generated_molecule)
+    # add the first asterisk
+    generated_molecule_list = indices_to_selfies(encoding_alphabet, one_hot_encoded_vector, prefix='[*]')
+    smiles_generated_molecule_list = sf.batch_decoder(generated_molecule_list)
+    for generated_molecule, smiles_generated_molecule in zip(generated_molecule_list, smiles_generated_molecule_list):
+        if smiles_generated_molecule is None:
+            reconstructed_molecules.append(None)
+            continue
 
         # convert to canonical smiles
         mol = Chem.MolFromSmiles(smiles_generated_molecule)
@@ -142,6 +138,7 @@ if __name__ == '__main__':
     # load SELFIES data - due to the random order
     encoding_list = torch.load(os.path.join(save_directory, 'encoding_list.pth'), map_location=device)
     encoding_alphabet = torch.load(os.path.join(save_directory, 'encoding_alphabet.pth'), map_location=device)
+    sf.warm_symbol_caches(encoding_alphabet)  # decoding of generated SELFIES
     largest_molecule_len = torch.load(os.path.join(save_directory, 'largest_molecule_len.pth'), map_location=device)
 
     # set encoder
@@ -193,90 +190,25 @@ if __name__ == '__main__':
     rnn_max_length = largest_molecule_len
     generated_polymer_list = list()
 
+    # batched generation - all sequences of a chunk are decoded in lockstep
+    generation_batch_size = 1000
+    num_chunks = ceil(number_of_generation / generation_batch_size)
+
     tqdm.write("Generation ...")
-    pbar = tqdm(range(number_of_generation), total=number_of_generation, leave=True)
+    pbar = tqdm(range(num_chunks), total=num_chunks, leave=True)
     time.sleep(1.0)
     with pbar as t:
-        for iteration in t:
+        for chunk_idx in t:
             with torch.no_grad():
                 # sample gaussian prior
-                random_prior = multivariate_normal.sample().unsqueeze(0)
-                hidden = vae_decoder.init_hidden(random_prior)
-                out_one_hot = torch.zeros(size=(1, largest_molecule_len, len(encoding_alphabet)),
-                                          dtype=dtype, device=device)
-                nop_tensor = -torch.ones(size=(1, ), dtype=dtype, device=device)
-                asterisk_tensor = -torch.ones(size=(1,), dtype=dtype, device=device)
-                updated_nop_tensor = -torch.ones(size=(1,), dtype=dtype, device=device)
-                x_input = torch.zeros(size=(1, 1, len(encoding_alphabet)), dtype=dtype, device=device)
-
-                # no teacher forcing
-                for seq_index in range(rnn_max_length):
-                    out_one_hot_line, hidden = vae_decoder(x=x_input, hidden=hidden)
-                    # find 'nop' idx
-                    boolean_tensor = out_one_hot_line[0].argmax(dim=-1) == nop_idx
-                    nonzero_tensor = boolean_tensor.nonzero()
-
-                    for nonzero_num in range(nonzero_tensor.shape[0]):
-                        nonzero_idx = nonzero_tensor[nonzero_num][0].item()
-                        # store
-                        if nop_tensor[nonzero_idx] < 0:
-                            nop_tensor[nonzero_idx] = seq_index
-
-                    # find 'asterisk' idx
-                    boolean_tensor = out_one_hot_line[0].argmax(dim=-1) == asterisk_idx
-                    nonzero_tensor = boolean_tensor.nonzero()
-                    for nonzero_num in range(nonzero_tensor.shape[0]):
-                        nonzero_idx = nonzero_tensor[nonzero_num][0].item()
-                        # store
-                        if asterisk_tensor[nonzero_idx] < 0:
-                            asterisk_tensor[nonzero_idx] = 0.0  # generated one asterisk
-
-                        elif asterisk_tensor[nonzero_idx] == 0:
-                            asterisk_tensor[
-                                nonzero_idx] = seq_index  # generated two asterisks other than the initiator
-
-                    # change value of asterisk tensor: 0 -> -1
-                    # asterisk_tensor[asterisk_tensor == 0.0] = -1.0  # yield bug -> more than 2 asterisks
-
-                    # update nop tensor
-                    for idx in range(asterisk_tensor.shape[0]):
-                        if nop_tensor[idx] == -1.0 and asterisk_tensor[idx] <= 0.0:
-                            continue
-                        elif nop_tensor[idx] < 0 < asterisk_tensor[idx]:
-                            updated_nop_tensor[idx] = asterisk_tensor[idx]
-                        elif nop_tensor[idx] > 0 >= asterisk_tensor[idx]:
-                            updated_nop_tensor[idx] = nop_tensor[idx]
-                        elif nop_tensor[idx] >= asterisk_tensor[idx]:
-                            updated_nop_tensor[idx] = asterisk_tensor[idx]
-                        else:
-                            updated_nop_tensor[idx] = nop_tensor[idx]
-
-                    # stop generation if all tensors contain 'nop': elements of nop tensor is not negative
-                    flag = 1  # flag = 1 means 'stop'
-                    for idx, value in enumerate(updated_nop_tensor):
-                        if value < 0:  # there is non 'nop'
-                            flag = 0
-                            break
-                    if flag == 1:
-                        break
-
-                    out_one_hot[:, seq_index, :] = out_one_hot_line[0]
-
-                    # change input - no teacher forcing (one-hot)
-                    x_input = out_one_hot_line.argmax(dim=-1)
-                    x_input = f.one_hot(x_input, num_classes=len(encoding_alphabet)).to(torch.float)
-
-                # x_indices
-                x_hat_prob = f.softmax(out_one_hot, dim=-1)
-                x_hat_indices = x_hat_prob.argmax(dim=-1)
-
-                # modify x_hat_indices value to nop_idx after the nop appears
-                for idx, value in enumerate(updated_nop_tensor):
-                    if value >= 0.0:
-                        x_hat_indices[idx, int(value): rnn_max_length] = nop_idx
+                chunk_size = min(generation_batch_size, number_of_generation - chunk_idx * generation_batch_size)
+                random_prior = multivariate_normal.sample((chunk_size,))
+                x_hat_indices = vae_decoder.generate(
+                    random_prior, max_length=rnn_max_length, nop_idx=nop_idx, asterisk_idx=asterisk_idx
+                )
 
                 # convert to SMILES string
-                generated_molecules = reconstruct_polymers(encoding_alphabet, x_hat_indices)
+                generated_molecules = reconstruct_polymers(encoding_alphabet, x_hat_indices.cpu())
 
                 # store
                 for polymer in generated_molecules:
@@ -0,0 +1,4 @@
+"""
+Training utilities shared by the VAE (vae.training_optuna.train_model) and MoleculeChef (MoleculeChef.train).
+"""
+from training.callbacks import TrainingCallback, OptunaPruningCallback
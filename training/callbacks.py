@@ -0,0 +1,29 @@
+class TrainingCallback(object):
+    """
+    Hooks of vae.training_optuna.train_model and MoleculeChef.train (callbacks argument).
+    Subclasses override the hooks they need.
+    """
+    def on_epoch_end(self, epoch, reconstruction_loss, divergence_loss, property_loss):
+        """
+        Called after the evaluation of each epoch with the evaluation losses (float):
+        the validation losses of train_model and the test losses of MoleculeChef.train
+        """
+        pass
+
+
+class OptunaPruningCallback(TrainingCallback):
+    def __init__(self, trial, objective):
+        """
+        Report the evaluation objective of each epoch to an Optuna trial and prune unpromising trials
+        (raise optuna.TrialPruned out of train_model / MoleculeChef.train).
+        objective: function of the evaluation losses (reconstruction, divergence, property) -> reported value
+        """
+        self.trial = trial
+        self.objective = objective
+
+    def on_epoch_end(self, epoch, reconstruction_loss, divergence_loss, property_loss):
+        from optuna import TrialPruned  # optuna is only needed for hyperparameter tuning
+
+        self.trial.report(self.objective(reconstruction_loss, divergence_loss, property_loss), step=epoch)
+        if self.trial.should_prune():
+            raise TrialPruned(f'Trial {self.trial.number} pruned at epoch {epoch + 1}')
@@ -1,4 +1,18 @@
-from torch import nn
+from typing import Tuple
+
+import torch
+from torch import nn, Tensor
+from torch.nn import functional as f
+
+
+def get_gru_autocast_dtype(x):
+    """
+    dtype of the GRU under CPU autocast (None otherwise). GRUs are not on the CPU autocast op list of older PyTorch
+    versions, so the input, hidden state and weights are cast explicitly.
+    """
+    if x.device.type == 'cpu' and torch.is_autocast_cpu_enabled():
+        return torch.get_autocast_cpu_dtype()
+    return None
 
 
 class Decoder(nn.Module):
@@ -42,8 +56,140 @@ class Decoder(nn.Module):
         A forward pass throught the entire model.
         """
 
+        # a one-step sequence under CPU autocast
+        if get_gru_autocast_dtype(x) is not None:
+            return self.forward_sequence(x, hidden)
+
         # Decode
         output, hidden = self.decode_RNN(x, hidden)
         output = self.decode_FC(output)  # fully connected layer
 
         return output, hidden
+
+    def forward_sequence(self, x, hidden):
+        """
+        Decode a whole sequence x [l, b, input_size] in one pass. Equivalent to calling forward once per step
+        while carrying the hidden state: a one-step call of the bidirectional GRU runs both directions forward in time,
+        so each layer and direction is run as a unidirectional GRU over the sequence (fused multi-step kernels).
+        """
+        rnn = self.decode_RNN
+        num_directions = 2 if self.bidirectional else 1
+        param_names = ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'] if rnn.bias else ['weight_ih', 'weight_hh']
+
+        autocast_dtype = get_gru_autocast_dtype(x)
+        if autocast_dtype is not None:
+            x, hidden = x.to(autocast_dtype), hidden.to(autocast_dtype)
+
+        layer_input = x
+        hidden_list = []
+        for layer in range(self.num_layers):
+            output_list = []
+            for direction in range(num_directions):
+                suffix = '_reverse' if direction == 1 else ''
+                params = [getattr(rnn, '%s_l%d%s' % (name, layer, suffix)) for name in param_names]
+                if autocast_dtype is not None:
+                    params = [param.to(autocast_dtype) for param in params]
+                hidden_idx = layer * num_directions + direction
+                output, layer_hidden = torch.gru(
+                    layer_input, hidden[hidden_idx: hidden_idx + 1].contiguous(), params, rnn.bias,
+                    1, 0.0, self.training, False, False
+                )
+                output_list.append(output)
+                hidden_list.append(layer_hidden)
+            layer_input = torch.cat(output_list, dim=-1)
+            if rnn.dropout > 0.0 and layer < self.num_layers - 1:
+                layer_input = f.dropout(layer_input, p=rnn.dropout, training=self.training)
+
+        output = self.decode_FC(layer_input)  # fully connected layer
+
+        return output, torch.cat(hidden_list, dim=0)
+
+    def forward_teacher_forced(self, inputs, z):
+        """
+        Teacher forcing in a single pass. inputs [b, l, input_size] are the answers (batch first);
+        the decoder input at step t is inputs[:, t - 1] (zeros at t = 0) and the hidden state is initialized with z.
+        Returns the output [b, l, out_dimension] and the last hidden state.
+        The per-step forward stays for free-running generation.
+        """
+        x = torch.cat([torch.zeros_like(inputs[:, :1, :]), inputs[:, :-1, :]], dim=1).transpose(0, 1)
+        output, hidden = self.forward_sequence(x, self.init_hidden(z))
+
+        return output.transpose(0, 1), hidden
+
+    @torch.no_grad()
+    def generate(self, z, max_length, nop_idx, asterisk_idx):
+        """
+        Free-running generation of a batch of latent vectors z [b, latent] in lockstep.
+        A sequence stops at its first 'nop' or second 'asterisk' (the first one after the initiator) following the rule
+        of train/vae_prior_generation.py (a 'nop' at step 0 stops only with an asterisk); decoding exits early
+        once every sequence has stopped. Returns labels [b, max_length] padded with nop_idx after the stop.
+        """
+        batch_size = z.shape[0]
+        device = z.device
+
+        hidden = self.init_hidden(z)
+        x_input = torch.zeros(size=(1, batch_size, self.input_size), dtype=z.dtype, device=device)
+        labels = torch.full(size=(batch_size, max_length), fill_value=nop_idx, dtype=torch.long, device=device)
+
+        minus_one = -torch.ones(size=(batch_size,), dtype=torch.long, device=device)
+        nop_tensor = minus_one.clone()
+        asterisk_tensor = minus_one.clone()  # -1: no asterisk, 0: one asterisk, step of the second asterisk
+        asterisk_count = torch.zeros_like(minus_one)
+        stop_tensor = minus_one.clone()
+
+        for seq_index in range(max_length):
+            out_one_hot_line, hidden = self.forward(x=x_input, hidden=hidden)
+            x_hat_indices = out_one_hot_line[0].argmax(dim=-1)
+            nop_tensor, asterisk_count, asterisk_tensor, stop_tensor = update_stop_step(
+                x_hat_indices, seq_index, nop_idx, asterisk_idx, nop_tensor, asterisk_count, asterisk_tensor, stop_tensor
+            )
+
+            # stop generation if all sequences stopped
+            if bool((stop_tensor >= 0).all()):
+                break
+
+            labels[:, seq_index] = x_hat_indices
+
+            # change input - no teacher forcing (one-hot)
+            x_input = f.one_hot(x_hat_indices, num_classes=self.input_size).to(z.dtype).unsqueeze(0)
+
+        return mask_after_stop(labels, stop_tensor, nop_idx)
+
+
+def update_stop_step(x_hat_indices, seq_index: int, nop_idx: int, asterisk_idx: int,
+                     nop_tensor, asterisk_count, asterisk_tensor, stop_tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """
+    Bookkeeping of one generation step (decoded indices x_hat_indices [b]): first 'nop', asterisk count,
+    asterisk tensor (-1: no asterisk, 0: one asterisk, step of the second asterisk) and stop step (-1: not stopped).
+    TorchScript compatible (shared with the exported generator).
+    """
+    seq_index_tensor = torch.full_like(nop_tensor, seq_index)
+
+    # first 'nop' and asterisks
+    nop_tensor = torch.where((nop_tensor < 0) & (x_hat_indices == nop_idx), seq_index_tensor, nop_tensor)
+    is_asterisk = x_hat_indices == asterisk_idx
+    asterisk_count = asterisk_count + is_asterisk.long()
+    asterisk_tensor = torch.where(is_asterisk & (asterisk_count == 1), torch.zeros_like(asterisk_tensor), asterisk_tensor)
+    asterisk_tensor = torch.where(is_asterisk & (asterisk_count == 2), seq_index_tensor, asterisk_tensor)
+
+    # stop step
+    stop_tensor = torch.where(
+        (nop_tensor == -1) & (asterisk_tensor <= 0), stop_tensor,
+        torch.where(
+            (nop_tensor < 0) & (asterisk_tensor > 0), asterisk_tensor,
+            torch.where(
+                (nop_tensor > 0) & (asterisk_tensor <= 0), nop_tensor,
+                torch.where(nop_tensor >= asterisk_tensor, asterisk_tensor, nop_tensor)
+            )
+        )
+    )
+    return nop_tensor, asterisk_count, asterisk_tensor, stop_tensor
+
+
+def mask_after_stop(labels, stop_tensor, nop_idx: int):
+    """
+    Set labels [b, l] to nop_idx from the stop step on (stop_tensor [b], -1: not stopped)
+    """
+    step_tensor = torch.arange(labels.shape[1], device=labels.device).unsqueeze(0)
+    after_stop = (stop_tensor >= 0).unsqueeze(1) & (step_tensor >= stop_tensor.unsqueeze(1))
+    return labels.masked_fill(after_stop, nop_idx)
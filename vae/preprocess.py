@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import pandas as pd
 
@@ -5,41 +6,47 @@ import sys
 sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
 import selfies as sf
 
+from vae.utils.statistics import compute_corpus_statistics
 
-def get_selfie_and_smiles_encodings_for_dataset(df):
+
+def get_selfie_and_smiles_encodings_for_dataset(df, n_jobs=None, vocabulary_path=None):
     """
     Returns encoding, alphabet and length of largest molecule in SMILES and
     SELFIES, given a file containing SMILES molecules.
 
     input:
         csv file with molecules. Column's name must be 'smiles'.
+        n_jobs: number of processes translating SMILES to SELFIES (None -> all CPUs)
+        vocabulary_path: if given, the corpus statistics (alphabets, lengths, counts) are saved to this json file
     output:
         - selfies encoding
-        - selfies alphabet
+        - selfies alphabet (sorted, '[nop]' first)
         - longest selfies string
         - smiles encoding (equivalent to file content)
-        - smiles alphabet (character based)
+        - smiles alphabet (character based, sorted, ' ' last)
         - longest smiles string
     """
 
     # df = pd.read_csv(file_path)
     smiles_list = np.asanyarray(df['product'])
-    smiles_alphabet = list(set(''.join(smiles_list)))
-    smiles_alphabet.append(' ')  # for padding
-
-    largest_smiles_len = len(max(smiles_list, key=len))
 
     # print('--> Translating SMILES to SELFIES...')
-    selfies_list = list(map(sf.encoder, smiles_list, [True] * len(smiles_list)))
-    all_selfies_symbols = sf.get_alphabet_from_selfies(selfies_list)
-    all_selfies_symbols.add('[nop]')
-    selfies_alphabet = list(all_selfies_symbols)
-
-    largest_selfies_len = max(sf.len_selfies(s) for s in selfies_list)
+    selfies_list, errors = sf.batch_encoder(smiles_list, strict=True, n_jobs=n_jobs, return_errors=True)
+    if errors:
+        idx, err = errors[0]
+        raise sf.EncoderError(f'{len(errors)} SMILES failed to be translated, first at index {idx}: {err}')
+
+    # alphabets and lengths in a single streaming pass over shards
+    shard_size = 100000
+    statistics = compute_corpus_statistics(selfies_list, smiles_list, shard_size=shard_size,
+                                           n_jobs=n_jobs if len(selfies_list) > shard_size else 1)
+    if vocabulary_path is not None:
+        statistics.save(vocabulary_path)
 
     # print('Finished translating SMILES to SELFIES.')
 
-    return selfies_list, selfies_alphabet, largest_selfies_len, smiles_list, smiles_alphabet, largest_smiles_len
+    return selfies_list, statistics.selfies_alphabet(), statistics.largest_selfies_len, \
+        smiles_list, statistics.smiles_alphabet(), statistics.largest_smiles_len
 
 
 def smile_to_hot(smile, largest_smile_len, alphabet):
@@ -81,12 +88,8 @@ def selfies_to_hot(selfie, largest_selfie_len, alphabet):
     """
     symbol_to_int = dict((c, i) for i, c in enumerate(alphabet))
 
-    # pad with [nop]
-    selfie += '[nop]' * (largest_selfie_len - sf.len_selfies(selfie))
-
-    # integer encode
-    symbol_list = sf.split_selfies(selfie)
-    integer_encoded = [symbol_to_int[symbol] for symbol in symbol_list]
+    # integer encode and pad with [nop]
+    integer_encoded = sf.selfies_to_encoding(selfie, symbol_to_int, pad_to_len=largest_selfie_len, enc_type='label')
 
     # one hot-encode the integer encoded selfie
     onehot_encoded = list()
@@ -99,11 +102,49 @@ def selfies_to_hot(selfie, largest_selfie_len, alphabet):
 
 
 def multiple_selfies_to_hot(selfies_list, largest_molecule_len, alphabet):
-    """Convert a list of selfies strings to a one-hot encoding
+    """Convert a list of selfies strings to a one-hot encoding (uint8)
     """
+    symbol_to_int = dict((c, i) for i, c in enumerate(alphabet))
 
-    hot_list = []
-    for s in selfies_list:
-        _, onehot_encoded = selfies_to_hot(s, largest_molecule_len, alphabet)
-        hot_list.append(onehot_encoded)
-    return np.array(hot_list)
+    return sf.batch_selfies_to_hot_array(selfies_list, symbol_to_int, pad_to_len=largest_molecule_len)
+
+
+def get_label_dtype(alphabet):
+    """Smallest integer dtype that can hold every index of the alphabet
+    """
+    return np.uint8 if len(alphabet) <= np.iinfo(np.uint8).max + 1 else np.int16
+
+
+def multiple_selfies_to_label(selfies_list, largest_molecule_len, alphabet, out=None):
+    """Convert a list of selfies strings to a compact label (integer) encoding
+
+    Returned shapes: labels (num_selfies x largest_molecule_len) padded with '[nop]' and
+    lengths (num_selfies,) holding the number of symbols before padding.
+    One-hot vectors are expanded per batch (vae.utils.dataset.label_to_one_hot) instead of
+    storing the dense (num_selfies x largest_molecule_len x len_alphabet) array.
+    out: optional preallocated label array (e.g. np.lib.format.open_memmap) to fill in place.
+    """
+    symbol_to_int = dict((c, i) for i, c in enumerate(alphabet))
+
+    if out is None:
+        out = np.empty(shape=(len(selfies_list), largest_molecule_len), dtype=get_label_dtype(alphabet))
+    _, lengths = sf.batch_selfies_to_label_array(selfies_list, symbol_to_int, pad_to_len=largest_molecule_len,
+                                                 out=out, return_lengths=True)
+
+    return out, lengths.astype(np.int32)
+
+
+def save_label_encoding(save_directory, labels, lengths):
+    """Save label encodings as .npy files that can be memory mapped by load_label_encoding
+    """
+    np.save(os.path.join(save_directory, 'selfies_labels.npy'), labels)
+    np.save(os.path.join(save_directory, 'selfies_lengths.npy'), lengths)
+
+
+def load_label_encoding(save_directory, mmap_mode='r'):
+    """Load label encodings saved by save_label_encoding. Arrays are memory mapped by default.
+    """
+    labels = np.load(os.path.join(save_directory, 'selfies_labels.npy'), mmap_mode=mmap_mode)
+    lengths = np.load(os.path.join(save_directory, 'selfies_lengths.npy'), mmap_mode=mmap_mode)
+
+    return labels, lengths
@@ -75,14 +75,77 @@ class PropertyNetworkPredictionModule(nn.Module):
         self.property_network_module = nn.ModuleList(property_network_list)
 
     def forward(self, latent_points):
-        prediction = torch.zeros(size=(latent_points.shape[0], 1),
-                                 device=latent_points.device, dtype=latent_points.dtype)
+        prediction_list = [property_network(latent_points) for property_network in self.property_network_module]
 
-        for property_idx in range(self.property_dim):
-            prediction_tensor = self.property_network_module[property_idx](latent_points)
-            prediction = torch.cat([prediction, prediction_tensor], dim=-1)
+        return torch.cat(prediction_list, dim=-1)
 
-        return prediction[:, 1:]
+
+class FusedPropertyNetworkPredictionModule(nn.Module):
+    def __init__(self, latent_dim, property_dim, property_network_hidden_dim_list, dtype, device, weights=(0.5, 0.5)):
+        """
+        PropertyNetworkPredictionModule with all property networks evaluated together. Networks of the same depth
+        are stacked into one FusedFullyConnectedNeuralNetwork (one matmul per layer).
+        State dicts of PropertyNetworkPredictionModule are converted when loaded.
+        """
+        super(FusedPropertyNetworkPredictionModule, self).__init__()
+        if len(property_network_hidden_dim_list) != property_dim:
+            raise ValueError('Insert the property network structure corresponding to the property dimension')
+        if len(weights) != property_dim:
+            raise ValueError('Insert the weights corresponding to the property dimension')
+        if property_dim < 1:
+            raise ValueError("There is no property target")
+
+        self.latent_dim = latent_dim
+        self.property_dim = property_dim
+        self.dtype = dtype
+        self.device = device
+
+        weights = torch.tensor(weights, dtype=dtype, device=device)
+        self.normalized_weights_tensor = f.normalize(weights, p=1.0, dim=0)
+
+        # group property networks by depth
+        depth_to_property_idx = dict()
+        for property_idx, dim_list in enumerate(property_network_hidden_dim_list):
+            depth_to_property_idx.setdefault(len(dim_list), []).append(property_idx)
+        self.group_property_idx = list(depth_to_property_idx.values())
+
+        self.property_network_groups = nn.ModuleList([
+            FusedFullyConnectedNeuralNetwork(
+                input_dim=latent_dim,
+                output_dim=1,
+                hidden_sizes_list=[property_network_hidden_dim_list[property_idx] for property_idx in property_idx_list]
+            ) for property_idx_list in self.group_property_idx
+        ])
+
+        # column of each property in the concatenated group outputs
+        group_order = [property_idx for property_idx_list in self.group_property_idx for property_idx in property_idx_list]
+        self.output_order = torch.argsort(torch.tensor(group_order)).tolist()
+
+        self._register_load_state_dict_pre_hook(self._convert_unfused_state_dict)
+
+    def forward(self, latent_points):
+        if len(self.property_network_groups) == 1:
+            return self.property_network_groups[0](latent_points)
+
+        prediction = torch.cat([network(latent_points) for network in self.property_network_groups], dim=-1)
+        return prediction[:, self.output_order]
+
+    def _convert_unfused_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                    error_msgs):
+        unfused_prefix = prefix + 'property_network_module.'
+        if not any(key.startswith(unfused_prefix) for key in state_dict):
+            return
+
+        for group_idx, property_idx_list in enumerate(self.group_property_idx):
+            head_state_dict_list = list()
+            for property_idx in property_idx_list:
+                head_prefix = f'{unfused_prefix}{property_idx}.'
+                head_state_dict_list.append({
+                    key[len(head_prefix):]: state_dict.pop(key) for key in list(state_dict) if key.startswith(head_prefix)
+                })
+            group_state_dict = self.property_network_groups[group_idx].fuse_state_dicts(head_state_dict_list)
+            for key, value in group_state_dict.items():
+                state_dict[f'{prefix}property_network_groups.{group_idx}.{key}'] = value
 
 
 class FullyConnectedNeuralNetwork(nn.Module):
@@ -108,5 +171,89 @@ class FullyConnectedNeuralNetwork(nn.Module):
         return hidden_tensor
 
 
+class FusedFullyConnectedNeuralNetwork(nn.Module):
+    def __init__(self, input_dim: int, output_dim: int, hidden_sizes_list: List[List[int]]):
+        """
+        A stack of FullyConnectedNeuralNetwork of the same depth evaluated as one network: the first layer
+        concatenates the weights of all networks and the following layers are block-diagonal (masked) matmuls.
+        Batch norms of all networks are one BatchNorm1d over the concatenated hidden units.
+        """
+        super(FusedFullyConnectedNeuralNetwork, self).__init__()
+        if len({len(hidden_sizes) for hidden_sizes in hidden_sizes_list}) != 1:
+            raise ValueError('Fused networks should have the same number of hidden layers')
+
+        self.num_networks = len(hidden_sizes_list)
+        self.layer_sizes_list = [[input_dim] + hidden_sizes + [output_dim] for hidden_sizes in hidden_sizes_list]
+        num_layers = len(self.layer_sizes_list[0]) - 1
+
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for layer_num in range(num_layers):
+            # same initialization as nn.Linear of each network
+            linear_list = [nn.Linear(layer_sizes[layer_num], layer_sizes[layer_num + 1])
+                           for layer_sizes in self.layer_sizes_list]
+            weight, bias = self._fuse_linear([(linear.weight.detach(), linear.bias.detach()) for linear in linear_list],
+                                             layer_num)
+            self.weights.append(nn.Parameter(weight))
+            self.biases.append(nn.Parameter(bias))
+            if layer_num > 0:
+                weight_mask = torch.block_diag(
+                    *[torch.ones(linear.in_features, linear.out_features) for linear in linear_list]
+                )
+                self.register_buffer(f'weight_mask_{layer_num}', weight_mask, persistent=False)
+
+        self.batch_norm_layers = nn.ModuleList([
+            nn.BatchNorm1d(sum(hidden_sizes[layer_num] for hidden_sizes in hidden_sizes_list))
+            for layer_num in range(num_layers - 1)
+        ])
+
+    @staticmethod
+    def _fuse_linear(weight_bias_list, layer_num):
+        """
+        Fused weight [in, out] and bias [out] from nn.Linear weights [out, in] and biases of each network.
+        """
+        if layer_num == 0:  # shared input
+            weight = torch.cat([weight.t() for weight, _ in weight_bias_list], dim=1)
+        else:
+            weight = torch.block_diag(*[weight.t() for weight, _ in weight_bias_list])
+        bias = torch.cat([bias for _, bias in weight_bias_list])
 
+        return weight, bias
+
+    def forward(self, input_tensor: torch.Tensor):
+        hidden_tensor = input_tensor
+        num_layers = len(self.weights)
+        for layer_num in range(num_layers):
+            weight = self.weights[layer_num]
+            if layer_num > 0:
+                weight = weight * getattr(self, f'weight_mask_{layer_num}')
+            hidden_tensor = torch.addmm(self.biases[layer_num], hidden_tensor, weight)
+            if layer_num < num_layers - 1:
+                hidden_tensor = self.batch_norm_layers[layer_num](hidden_tensor)
+                hidden_tensor = f.leaky_relu(hidden_tensor)
+
+        # [b, networks * output_dim]
+        return hidden_tensor
+
+    def fuse_state_dicts(self, state_dict_list):
+        """
+        Fused state dict from the state dicts of FullyConnectedNeuralNetwork (one per network).
+        """
+        fused_state_dict = dict()
+        for layer_num in range(len(self.weights)):
+            weight, bias = self._fuse_linear(
+                [(state_dict[f'linear_layers.{layer_num}.weight'], state_dict[f'linear_layers.{layer_num}.bias'])
+                 for state_dict in state_dict_list], layer_num
+            )
+            fused_state_dict[f'weights.{layer_num}'] = weight
+            fused_state_dict[f'biases.{layer_num}'] = bias
+
+        for layer_num in range(len(self.batch_norm_layers)):
+            for key in ['weight', 'bias', 'running_mean', 'running_var']:
+                fused_state_dict[f'batch_norm_layers.{layer_num}.{key}'] = torch.cat(
+                    [state_dict[f'batch_norm_layers.{layer_num}.{key}'] for state_dict in state_dict_list]
+                )
+            fused_state_dict[f'batch_norm_layers.{layer_num}.num_batches_tracked'] = \
+                state_dict_list[0][f'batch_norm_layers.{layer_num}.num_batches_tracked']
 
+        return fused_state_dict
@@ -8,19 +8,28 @@ import torch
 import torch.nn as nn
 
 import sys
+import warnings
 sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
 import selfies as sf
 
 from math import ceil
+from functools import partial
 from tqdm import tqdm
 
 from torch.nn import functional as f
 from torch.optim.lr_scheduler import StepLR, ExponentialLR
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import BatchSampler, Dataset
+from torch.utils.data.distributed import DistributedSampler
 
 from matplotlib.lines import Line2D
 from rdkit.Chem import MolFromSmiles
 from sklearn.metrics import r2_score
-from vae.utils.save import save_model
+from metrics.kernels import estimate_maximum_mean_discrepancy, estimate_maximum_mean_discrepancy_linear
+from vae.utils.dataset import get_data_loader, to_one_hot_batch
+from vae.utils.distributed import get_rank_and_world_size, all_reduce_sum, all_gather_object
+from vae.utils.sampler import LengthBucketBatchSampler
+from vae.utils.save import save_model, save_checkpoint, load_checkpoint, get_rng_state, set_rng_state
 
 
 class EarlyStopping(object):
@@ -77,13 +86,76 @@ def plot_grad_flow(named_parameters, file_path, file_name):
     plt.savefig(os.path.join(file_path, '%s_gradient_flow.png' % file_name))
 
 
+class VAETrainingModule(nn.Module):
+    def __init__(self, vae_encoder, vae_decoder, property_predictor):
+        """
+        Training forward pass of the encoder, property predictor and decoder (teacher forcing) as one module,
+        so that a single DistributedDataParallel all-reduces the gradients of all models.
+        """
+        super(VAETrainingModule, self).__init__()
+        self.vae_encoder = vae_encoder
+        self.vae_decoder = vae_decoder
+        self.property_predictor = property_predictor
+
+    def forward(self, data_batch, rnn_max_length: int):
+        # reshaping for efficient parallelization
+        inp_flat_one_hot = data_batch.transpose(dim0=1, dim1=2)  # convolution
+        latent_points, mus, log_vars = self.vae_encoder(inp_flat_one_hot)
+        predicted_property = self.property_predictor(latent_points)
+
+        # teacher forcing in a single pass - latent vectors as hidden (not zero-initialized hidden)
+        out_one_hot = torch.zeros_like(data_batch)
+        if rnn_max_length > 0:
+            out_one_hot[:, :rnn_max_length, :], _ = self.vae_decoder.forward_teacher_forced(
+                inputs=data_batch[:, :rnn_max_length, :], z=latent_points
+            )
+
+        return out_one_hot, latent_points, mus, log_vars, predicted_property
+
+
 def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_idx, data_train, data_valid, y_train,
                 y_valid, y_scaler, num_epochs, batch_size, lr_property, lr_enc, lr_dec, save_directory,
-                dtype, device, weight_decay=1e-5, kld_alpha=0.0, mmd_weight=10.0):
+                dtype, device, weight_decay=1e-5, kld_alpha=0.0, mmd_weight=10.0, length_bucketing=False,
+                num_workers=0, pin_memory=False, prefetch_factor=2, mixed_precision=False, checkpoint_path=None,
+                checkpoint_every=1, callbacks=(), distributed=False, mmd_estimator='quadratic', run_config=None):
     """
     Train the Variational Auto-Encoder
+    data_train and data_valid are either one-hot encoded [N, L, alphabet] or label encoded [N, L] tensors
+    sliced on the device, or vae.utils.dataset.SelfiesLabelDataset read from disk by a DataLoader
+    (num_workers, pin_memory, prefetch_factor). y_train and y_valid are ignored for datasets (they hold properties).
+    Label encoded data is expanded to one-hot vectors per batch.
+    length_bucketing: train on batches of similar lengths (vae.utils.sampler.LengthBucketBatchSampler)
+    so that the decoder is unrolled up to the max length of each bucket.
+    mixed_precision: run the forward passes under bfloat16 autocast (e.g. CPUs with AVX-512 BF16 / AMX);
+    losses and the MMD are computed in dtype. bfloat16 has the exponent range of float32, so no loss scaling.
+    checkpoint_path: save the training state (models, optimizers, schedulers, RNG states, epoch, loss history and
+    early stopping) every checkpoint_every epochs, atomically. Training resumes from checkpoint_path if it exists
+    (bit-identical to an uninterrupted run on CPU), so a killed run is restarted with the same call.
+    The checkpoint stores the run configuration (learning rates, loss weights, batch size, num_epochs, mmd_estimator,
+    world size, ... and run_config, a dict of the caller's hyperparameters e.g. latent_dim) and a checkpoint of
+    a different configuration is not resumed (ValueError). A checkpoint of a finished run (num_epochs or early
+    stopping) is not resumed either: training restarts from scratch with a warning and overwrites it.
+    The models of the lowest validation reconstruction loss are saved as best_*.pth in save_directory (also without
+    checkpoint_path).
+    callbacks: training.callbacks.TrainingCallback list, called after each validation with the validation losses
+    (e.g. OptunaPruningCallback).
+    distributed: data parallel training (DistributedDataParallel) in an initialized process group, e.g. gloo processes
+    launched by torchrun (train/vae_distributed.py). Each process trains on a shard of data_train (batch_size per
+    process) and validates a shard of data_valid; losses are averaged over processes. Checkpoints, models and plots
+    are saved by rank 0.
+    mmd_estimator: 'quadratic' (estimate_maximum_mean_discrepancy, [b, b] kernel matrices) or 'linear'
+    (estimate_maximum_mean_discrepancy_linear, O(b) for large batches) for the training divergence loss.
+    The validation divergence loss is always the quadratic estimate (comparable between runs).
     """
+    if mmd_estimator not in ('quadratic', 'linear'):
+        raise ValueError(f'mmd_estimator must be quadratic or linear: {mmd_estimator}')
+    estimate_train_divergence = estimate_maximum_mean_discrepancy_linear if mmd_estimator == 'linear' else \
+        estimate_maximum_mean_discrepancy
+    rank, world_size = get_rank_and_world_size(distributed)
     print('num_epochs: ', num_epochs, flush=True)
+    num_classes = vae_decoder.out_dimension
+    autocast = partial(torch.autocast, device_type=torch.device(device).type, dtype=torch.bfloat16,
+                       enabled=mixed_precision)
 
     # set optimizer
     optimizer_encoder = torch.optim.Adam(vae_encoder.parameters(), lr=lr_enc, weight_decay=weight_decay)
@@ -98,17 +170,127 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
     property_predictor_lr_scheduler = ExponentialLR(optimizer=optimizer_property_predictor, gamma=gamma)
 
     # train and valid data
-    num_batches_train = ceil(len(data_train) / batch_size)
-    num_batches_valid = ceil(len(data_valid) / batch_size)
+    use_data_loader = isinstance(data_train, Dataset)
+    train_batch_sampler = None
+    if distributed:
+        if length_bucketing:
+            raise ValueError('length_bucketing is not supported with distributed training')
+
+        # shards of the train data (reshuffled each epoch) and strided shards of the valid data
+        train_sampler = DistributedSampler(range(len(data_train)), num_replicas=world_size, rank=rank, shuffle=True)
+        train_batch_sampler = BatchSampler(train_sampler, batch_size=batch_size, drop_last=False)
+        valid_batch_idx_list = torch.arange(rank, len(data_valid), world_size).split(batch_size)
+    elif length_bucketing:
+        train_lengths = data_train.get_sequence_length(nop_idx) if use_data_loader else \
+            get_sequence_length(data_train, nop_idx)
+        train_batch_sampler = LengthBucketBatchSampler(train_lengths, batch_size=batch_size)
+
+    if use_data_loader:
+        loader_kwargs = dict(num_workers=num_workers, pin_memory=pin_memory, prefetch_factor=prefetch_factor)
+        train_loader = get_data_loader(data_train, batch_size, shuffle=True, batch_sampler=train_batch_sampler,
+                                       **loader_kwargs)
+        valid_batch_sampler = [batch_idx.tolist() for batch_idx in valid_batch_idx_list] if distributed else None
+        valid_loader = get_data_loader(data_valid, batch_size, shuffle=False, batch_sampler=valid_batch_sampler,
+                                       **loader_kwargs)
+        y_train, y_valid = torch.from_numpy(data_train.y), torch.from_numpy(data_valid.y)  # for the final plots
+
+    if distributed:
+        num_batches_train = len(train_batch_sampler)
+        num_batches_valid = len(valid_batch_idx_list)
+    else:
+        num_batches_train = ceil(len(data_train) / batch_size)
+        num_batches_valid = ceil(len(data_valid) / batch_size)
 
     data_train_reconstruction_loss_list_teacher_forcing, data_train_divergence_loss_list_teacher_forcing, data_train_property_loss_list_teacher_forcing = [], [], []
     data_valid_reconstruction_loss_list_no_teacher_forcing, data_valid_divergence_loss_list_no_teacher_forcing, data_valid_property_loss_list_no_teacher_forcing= [], [], []
 
     # early stopping
     early_stopping = EarlyStopping(tolerance=5, min_delta=1e-10)
-    
+
+    # resume
+    start_epoch = 0
+    best_valid_reconstruction_loss = float('inf')
+    training_config = {
+        'num_epochs': num_epochs, 'batch_size': batch_size, 'lr_property': lr_property, 'lr_enc': lr_enc,
+        'lr_dec': lr_dec, 'weight_decay': weight_decay, 'kld_alpha': kld_alpha, 'mmd_weight': mmd_weight,
+        'mmd_estimator': mmd_estimator, 'length_bucketing': length_bucketing, 'mixed_precision': mixed_precision,
+        'world_size': world_size, **(run_config or {})
+    }
+    checkpoint = None
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = load_checkpoint(checkpoint_path, map_location='cpu')
+        checkpoint_config = checkpoint.get('training_config', {})
+        mismatched_keys = sorted(key for key in set(checkpoint_config) | set(training_config)
+                                 if checkpoint_config.get(key) != training_config.get(key))
+        if mismatched_keys:
+            raise ValueError(f'checkpoint {checkpoint_path} is of a different run: ' + ', '.join(
+                f'{key} {checkpoint_config.get(key)} (resumed with {training_config.get(key)})'
+                for key in mismatched_keys))
+        if checkpoint['epoch'] >= num_epochs or checkpoint['early_stopping']['early_stop']:
+            warnings.warn(f'checkpoint {checkpoint_path} is of a finished run (epoch {checkpoint["epoch"]}) '
+                          f'and is not resumed: training from scratch')
+            checkpoint = None
+    if checkpoint is not None:
+        start_epoch = checkpoint['epoch']
+        best_valid_reconstruction_loss = checkpoint['best_valid_reconstruction_loss']
+        for module, key in [(vae_encoder, 'encoder'), (vae_decoder, 'decoder'),
+                            (property_predictor, 'property_predictor'),
+                            (optimizer_encoder, 'optimizer_encoder'), (optimizer_decoder, 'optimizer_decoder'),
+                            (optimizer_property_predictor, 'optimizer_property_predictor'),
+                            (encoder_lr_scheduler, 'encoder_lr_scheduler'),
+                            (decoder_lr_scheduler, 'decoder_lr_scheduler'),
+                            (property_predictor_lr_scheduler, 'property_predictor_lr_scheduler')]:
+            module.load_state_dict(checkpoint[key])
+        early_stopping.__dict__.update(checkpoint['early_stopping'])
+
+        data_train_reconstruction_loss_list_teacher_forcing.extend(checkpoint['train_reconstruction_loss'])
+        data_train_divergence_loss_list_teacher_forcing.extend(checkpoint['train_divergence_loss'])
+        data_train_property_loss_list_teacher_forcing.extend(checkpoint['train_property_loss'])
+        data_valid_reconstruction_loss_list_no_teacher_forcing.extend(checkpoint['valid_reconstruction_loss'])
+        data_valid_divergence_loss_list_no_teacher_forcing.extend(checkpoint['valid_divergence_loss'])
+        data_valid_property_loss_list_no_teacher_forcing.extend(checkpoint['valid_property_loss'])
+        rng_state = checkpoint['rng_state']
+        if distributed:  # RNG states of all processes
+            if len(rng_state) != world_size:
+                raise ValueError(f'checkpoint of {len(rng_state)} processes resumed with {world_size} processes')
+            rng_state = rng_state[rank]
+        set_rng_state(rng_state)
+        print(f'Resume training from epoch {start_epoch + 1}', flush=True)
+
+    def save_training_checkpoint(epoch):
+        # checkpoint (RNG states of all processes)
+        rng_state = all_gather_object(get_rng_state()) if distributed else get_rng_state()
+        if rank == 0:
+            save_checkpoint({
+                'epoch': epoch,
+                'encoder': vae_encoder.state_dict(),
+                'decoder': vae_decoder.state_dict(),
+                'property_predictor': property_predictor.state_dict(),
+                'optimizer_encoder': optimizer_encoder.state_dict(),
+                'optimizer_decoder': optimizer_decoder.state_dict(),
+                'optimizer_property_predictor': optimizer_property_predictor.state_dict(),
+                'encoder_lr_scheduler': encoder_lr_scheduler.state_dict(),
+                'decoder_lr_scheduler': decoder_lr_scheduler.state_dict(),
+                'property_predictor_lr_scheduler': property_predictor_lr_scheduler.state_dict(),
+                'early_stopping': vars(early_stopping).copy(),
+                'best_valid_reconstruction_loss': best_valid_reconstruction_loss,
+                'train_reconstruction_loss': data_train_reconstruction_loss_list_teacher_forcing,
+                'train_divergence_loss': data_train_divergence_loss_list_teacher_forcing,
+                'train_property_loss': data_train_property_loss_list_teacher_forcing,
+                'valid_reconstruction_loss': data_valid_reconstruction_loss_list_no_teacher_forcing,
+                'valid_divergence_loss': data_valid_divergence_loss_list_no_teacher_forcing,
+                'valid_property_loss': data_valid_property_loss_list_no_teacher_forcing,
+                'rng_state': rng_state,
+                'training_config': training_config,
+            }, checkpoint_path)
+
+    # gradients are all-reduced over processes in the backward pass (parameters are broadcast from rank 0)
+    training_module = VAETrainingModule(vae_encoder, vae_decoder, property_predictor)
+    if distributed:
+        training_module = DistributedDataParallel(training_module)
+
     # training
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         start = time.time()
         train_reconstruction_loss = torch.zeros(size=(1,), dtype=dtype).cpu()
         train_divergence_loss = torch.zeros(size=(1,), dtype=dtype).cpu()
@@ -120,105 +302,57 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
         vae_decoder.train()
         property_predictor.train()
 
-        # random permutation
-        rand_idx = torch.randperm(data_train.size()[0])
-        y_train_epoch = y_train.clone()[rand_idx]
+        # random permutation (or random batches of similar lengths)
+        if distributed:
+            train_sampler.set_epoch(epoch)
+        if use_data_loader:
+            train_batches = train_loader
+        else:
+            if distributed or length_bucketing:
+                train_batch_idx_list = [torch.tensor(batch_idx) for batch_idx in train_batch_sampler]
+            else:
+                train_batch_idx_list = torch.randperm(data_train.size()[0]).split(batch_size)
+            train_batches = ((data_train[batch_idx], y_train[batch_idx]) for batch_idx in train_batch_idx_list)
 
         # mini-batch training
         tqdm.write("Training ...")
-        pbar = tqdm(range(num_batches_train), total=num_batches_train, leave=True)
+        pbar = tqdm(range(num_batches_train), total=num_batches_train, leave=True, disable=rank != 0)
         with pbar as t:
-            for batch_iteration in t:
-                # manual batch iterations
-                start_idx = batch_iteration * batch_size
-                stop_idx = (batch_iteration + 1) * batch_size
-
-                if batch_iteration == num_batches_train - 1:
-                    stop_idx = data_train.shape[0]
-
-                data_train_batch = data_train[rand_idx[start_idx: stop_idx]]
-                y_train_batch = y_train_epoch[start_idx: stop_idx]
+            for batch_iteration, (data_train_batch, y_train_batch) in zip(t, train_batches):
+                data_train_batch = to_one_hot_batch(
+                    data_train_batch.to(device, non_blocking=True), num_classes=num_classes, dtype=dtype
+                )
+                y_train_batch = y_train_batch.to(device, non_blocking=True)
 
                 # find max length
-                length_tensor = torch.zeros_like(data_train_batch[:, 0, 0])
-                for idx in range(data_train_batch.shape[0]):
-                    boolean = (data_train_batch[idx, :, nop_idx] == 1.0).nonzero()
-                    if boolean.shape[0] != 0:
-                        length = (data_train_batch[idx, :, nop_idx] == 1.0).nonzero()[0][0].item()
-                    else:
-                        length = data_train_batch.shape[1]
-                    length_tensor[idx] = length
-                rnn_max_length = length_tensor.max()
-
-                # reshaping for efficient parallelization
-                inp_flat_one_hot = data_train_batch.transpose(dim0=1, dim1=2)  # convolution
-                latent_points, mus, log_vars = vae_encoder(inp_flat_one_hot)
+                rnn_max_length = int(get_sequence_length(data_train_batch, nop_idx).max().item())
 
-                criterion = nn.MSELoss(reduction='none').to(device)
-                predicted_train_property = property_predictor(latent_points)
+                with autocast():
+                    out_one_hot, latent_points, mus, log_vars, predicted_train_property = training_module(
+                        data_train_batch, rnn_max_length
+                    )
+
+                # losses in dtype (no-op without mixed precision)
+                latent_points, mus, log_vars = latent_points.to(dtype), mus.to(dtype), log_vars.to(dtype)
+                predicted_train_property = predicted_train_property.to(dtype)
 
                 # compute train loss
+                criterion = nn.MSELoss(reduction='none').to(device)
                 property_loss = criterion(input=predicted_train_property, target=y_train_batch)
                 property_loss = torch.sum(
                     torch.mean(property_loss, dim=0) * property_predictor.normalized_weights_tensor,
                     dim=0
                 )
 
-                # use latent vectors as hidden (not zero-initialized hidden)
-                hidden = vae_decoder.init_hidden(latent_points)
-                out_one_hot = torch.zeros_like(data_train_batch, dtype=dtype, device=device)
-                x_input = torch.zeros_like(data_train_batch[:, 0, :].unsqueeze(0), dtype=dtype, device=device)
-                nop_tensor = -torch.ones_like(data_train_batch[:, 0, 0], dtype=dtype, device=device)
-                asterisk_tensor = -torch.ones_like(data_train_batch[:, 0, 0], dtype=dtype, device=device)
-
-                # teacher forcing
-                for seq_index in range(int(rnn_max_length.item())):
-                    out_one_hot_line, hidden = vae_decoder(x=x_input, hidden=hidden)
-                    # find 'nop' idx
-                    boolean_tensor = out_one_hot_line[0].argmax(dim=-1) == nop_idx
-                    nonzero_tensor = boolean_tensor.nonzero()
-                    for nonzero_num in range(nonzero_tensor.shape[0]):
-                        nonzero_idx = nonzero_tensor[nonzero_num][0].item()
-                        # store
-                        if nop_tensor[nonzero_idx] < 0:
-                            nop_tensor[nonzero_idx] = seq_index
-
-                    # find 'asterisk' idx
-                    boolean_tensor = out_one_hot_line[0].argmax(dim=-1) == asterisk_idx
-                    nonzero_tensor = boolean_tensor.nonzero()
-                    for nonzero_num in range(nonzero_tensor.shape[0]):
-                        nonzero_idx = nonzero_tensor[nonzero_num][0].item()
-                        # store
-                        if asterisk_tensor[nonzero_idx] < 0:
-                            asterisk_tensor[nonzero_idx] = 0.0  # generated one asterisk
-
-                        elif asterisk_tensor[nonzero_idx] == 0:
-                            asterisk_tensor[nonzero_idx] = seq_index  # generated two asterisks other than the initiator
-
-                    out_one_hot[:, seq_index, :] = out_one_hot_line[0]
-                    x_input = data_train_batch[:, seq_index, :].unsqueeze(0)  # answer
-
-                # change value of asterisk tensor: 0 -> -1
-                asterisk_tensor[asterisk_tensor == 0.0] = -1.0
-
-                # update nop tensor
-                updated_nop_tensor = -torch.ones_like(data_train_batch[:, 0, 0], dtype=dtype, device=device)
-                for idx in range(asterisk_tensor.shape[0]):
-                    if nop_tensor[idx] == -1.0 and asterisk_tensor[idx] == -1.0:
-                        continue
-                    elif nop_tensor[idx] < 0 < asterisk_tensor[idx]:
-                        updated_nop_tensor[idx] = asterisk_tensor[idx]
-                    elif nop_tensor[idx] > 0 > asterisk_tensor[idx]:
-                        updated_nop_tensor[idx] = nop_tensor[idx]
-                    elif nop_tensor[idx] >= asterisk_tensor[idx]:
-                        updated_nop_tensor[idx] = asterisk_tensor[idx]
-                    else:
-                        updated_nop_tensor[idx] = nop_tensor[idx]
+                # first 'nop' or second 'asterisk' (other than the initiator) of the decoded sequence
+                updated_nop_tensor = get_nop_tensor(
+                    out_one_hot[:, :rnn_max_length].argmax(dim=-1), nop_idx, asterisk_idx, dtype
+                )
 
                 reconstruction_loss, _ = compute_elbo(
                     data_train_batch, out_one_hot, updated_nop_tensor, mus, log_vars, kld_alpha
                 )
-                divergence_loss = estimate_maximum_mean_discrepancy(posterior_z_samples=latent_points)
+                divergence_loss = estimate_train_divergence(posterior_z_samples=latent_points)
                 weighted_divergence_loss = mmd_weight * divergence_loss
 
                 total_train_loss = reconstruction_loss + weighted_divergence_loss + property_loss
@@ -246,6 +380,13 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
                      'property_loss': '%.2f' % float(property_loss)}
                 )
 
+        # average over processes (the same number of batches in each process)
+        if distributed:
+            train_reconstruction_loss, train_divergence_loss, train_property_loss = [
+                torch.tensor([loss / world_size], dtype=dtype) for loss in
+                all_reduce_sum([train_reconstruction_loss, train_divergence_loss, train_property_loss])
+            ]
+
         # append train loss
         data_train_reconstruction_loss_list_teacher_forcing.append((train_reconstruction_loss / num_batches_train))
         data_train_divergence_loss_list_teacher_forcing.append((train_divergence_loss / num_batches_train))
@@ -265,118 +406,79 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
             valid_divergence_loss = torch.zeros(size=(1,), dtype=dtype).cpu()
             valid_property_loss = torch.zeros(size=(1,), dtype=dtype).cpu()
 
-            y_valid_epoch = y_valid.clone()
+            if use_data_loader:
+                valid_batches = valid_loader
+            elif distributed:
+                valid_batches = ((data_valid[batch_idx], y_valid[batch_idx]) for batch_idx in valid_batch_idx_list)
+            else:
+                valid_batches = (
+                    (data_valid[start_idx: start_idx + batch_size], y_valid[start_idx: start_idx + batch_size])
+                    for start_idx in range(0, len(data_valid), batch_size)
+                )
 
             # mini-batch training
-            pbar = tqdm(range(num_batches_valid), total=num_batches_valid, leave=True)
+            pbar = tqdm(range(num_batches_valid), total=num_batches_valid, leave=True, disable=rank != 0)
             with pbar as t:
-                for batch_iteration in t:
-                    # manual batch iterations
-                    start_idx = batch_iteration * batch_size
-                    stop_idx = (batch_iteration + 1) * batch_size
+                for batch_iteration, (data_valid_batch, y_valid_batch) in zip(t, valid_batches):
+                    data_valid_batch = to_one_hot_batch(
+                        data_valid_batch.to(device, non_blocking=True), num_classes=num_classes, dtype=dtype
+                    )
+                    y_valid_batch = y_valid_batch.to(device, non_blocking=True)
 
-                    if batch_iteration == num_batches_train - 1:
-                        stop_idx = data_valid.shape[0]
+                    # find max length
+                    rnn_max_length = int(get_sequence_length(data_valid_batch, nop_idx).max().item())
 
-                    data_valid_batch = data_valid[start_idx: stop_idx]
-                    y_valid_batch = y_valid_epoch[start_idx: stop_idx]
+                    out_one_hot = torch.zeros_like(data_valid_batch, dtype=dtype, device=device)
+                    with autocast():
+                        # encode
+                        inp_flat_one_hot_valid = data_valid_batch.transpose(dim0=1, dim1=2)  # convolution
+                        latent_points, mus, log_vars = vae_encoder(inp_flat_one_hot_valid)
+                        predicted_valid_property = property_predictor(latent_points)
 
-                    # find max length
-                    length_tensor = torch.zeros_like(data_valid_batch[:, 0, 0])
-                    for idx in range(data_valid_batch.shape[0]):
-                        boolean = (data_valid_batch[idx, :, nop_idx] == 1.0).nonzero()
-                        if boolean.shape[0] != 0:
-                            length = (data_valid_batch[idx, :, nop_idx] == 1.0).nonzero()[0][0].item()
-                        else:
-                            length = data_valid_batch.shape[1]
-                        length_tensor[idx] = length
-                    rnn_max_length = length_tensor.max()
-
-                    # encode
-                    inp_flat_one_hot_valid = data_valid_batch.transpose(dim0=1, dim1=2)  # convolution
-                    latent_points, mus, log_vars = vae_encoder(inp_flat_one_hot_valid)
+                        # use latent vectors as hidden (not zero-initialized hidden)
+                        hidden = vae_decoder.init_hidden(latent_points)
+                        x_input = torch.zeros_like(data_valid_batch[:, 0, :].unsqueeze(0), dtype=dtype, device=device)
+
+                        # no teacher forcing
+                        for seq_index in range(rnn_max_length):
+                            out_one_hot_line, hidden = vae_decoder(x=x_input, hidden=hidden)
+                            out_one_hot[:, seq_index, :] = out_one_hot_line[0]
+
+                            # change input - no teacher forcing (one-hot)
+                            x_input = out_one_hot_line.argmax(dim=-1)
+                            x_input = f.one_hot(x_input, num_classes=data_valid_batch.shape[2]).to(torch.float)
+
+                    # losses in dtype (no-op without mixed precision)
+                    latent_points, mus, log_vars = latent_points.to(dtype), mus.to(dtype), log_vars.to(dtype)
+                    predicted_valid_property = predicted_valid_property.to(dtype)
 
                     # property prediction
                     criterion = nn.MSELoss(reduction='none').to(device)
-                    predicted_valid_property = property_predictor(latent_points)
                     property_loss = criterion(input=predicted_valid_property, target=y_valid_batch)
                     property_loss = torch.sum(
                         torch.mean(property_loss, dim=0) * property_predictor.normalized_weights_tensor,
                         dim=0
                     )
 
-                    # use latent vectors as hidden (not zero-initialized hidden)
-                    hidden = vae_decoder.init_hidden(latent_points)
-                    out_one_hot = torch.zeros_like(data_valid_batch, dtype=dtype, device=device)
-                    x_input = torch.zeros_like(data_valid_batch[:, 0, :].unsqueeze(0), dtype=dtype, device=device)
-                    nop_tensor = -torch.ones_like(data_valid_batch[:, 0, 0], dtype=dtype, device=device)
-                    asterisk_tensor = -torch.ones_like(data_valid_batch[:, 0, 0], dtype=dtype, device=device)
-
-                    # no teacher forcing
-                    for seq_index in range(int(rnn_max_length.item())):
-                        out_one_hot_line, hidden = vae_decoder(x=x_input, hidden=hidden)
-                        # find 'nop' idx
-                        boolean_tensor = out_one_hot_line[0].argmax(dim=-1) == nop_idx
-                        nonzero_tensor = boolean_tensor.nonzero()
-                        for nonzero_num in range(nonzero_tensor.shape[0]):
-                            nonzero_idx = nonzero_tensor[nonzero_num][0].item()
-                            # store
-                            if nop_tensor[nonzero_idx] < 0:
-                                nop_tensor[nonzero_idx] = seq_index
-
-                        # find 'asterisk' idx
-                        boolean_tensor = out_one_hot_line[0].argmax(dim=-1) == asterisk_idx
-                        nonzero_tensor = boolean_tensor.nonzero()
-                        for nonzero_num in range(nonzero_tensor.shape[0]):
-                            nonzero_idx = nonzero_tensor[nonzero_num][0].item()
-                            # store
-                            if asterisk_tensor[nonzero_idx] < 0:
-                                asterisk_tensor[nonzero_idx] = 0.0  # generated one asterisk
-
-                            elif asterisk_tensor[nonzero_idx] == 0:
-                                asterisk_tensor[nonzero_idx] = seq_index  # generated two asterisks other than the initiator
-
-                        out_one_hot[:, seq_index, :] = out_one_hot_line[0]
-
-                        # change input - no teacher forcing (one-hot)
-                        x_input = out_one_hot_line.argmax(dim=-1)
-                        x_input = f.one_hot(x_input, num_classes=data_valid_batch.shape[2]).to(torch.float)
-
                     # x_indices
                     x_indices = data_valid_batch.argmax(dim=-1)
                     x_hat_prob = f.softmax(out_one_hot, dim=-1)
                     x_hat_indices = x_hat_prob.argmax(dim=-1)
 
-                    # change value of asterisk tensor: 0 -> -1
-                    asterisk_tensor[asterisk_tensor == 0.0] = -1.0
-
-                    # update nop tensor
-                    updated_nop_tensor = -torch.ones_like(data_valid_batch[:, 0, 0], dtype=dtype, device=device)
-                    for idx in range(asterisk_tensor.shape[0]):
-                        if nop_tensor[idx] == -1.0 and asterisk_tensor[idx] == -1.0:
-                            continue
-                        elif nop_tensor[idx] < 0 < asterisk_tensor[idx]:
-                            updated_nop_tensor[idx] = asterisk_tensor[idx]
-                        elif nop_tensor[idx] > 0 > asterisk_tensor[idx]:
-                            updated_nop_tensor[idx] = nop_tensor[idx]
-                        elif nop_tensor[idx] >= asterisk_tensor[idx]:
-                            updated_nop_tensor[idx] = asterisk_tensor[idx]
-                        else:
-                            updated_nop_tensor[idx] = nop_tensor[idx]
+                    # first 'nop' or second 'asterisk' (other than the initiator) of the decoded sequence
+                    updated_nop_tensor = get_nop_tensor(
+                        out_one_hot[:, :rnn_max_length].argmax(dim=-1), nop_idx, asterisk_idx, dtype
+                    )
 
                     # modify x_hat_indices value to nop_idx after the nop appears
-                    max_length = x_hat_indices.shape[1]
-                    for idx, value in enumerate(updated_nop_tensor):
-                        if value >= 0.0:
-                            x_hat_indices[idx, int(value): max_length] = nop_idx
+                    step_tensor = torch.arange(x_hat_indices.shape[1], device=x_hat_indices.device)
+                    after_nop = (updated_nop_tensor >= 0.0).unsqueeze(1) & (step_tensor >= updated_nop_tensor.unsqueeze(1))
+                    x_hat_indices = x_hat_indices.masked_fill(after_nop, nop_idx)
 
                     # count right molecules
                     difference_tensor = torch.abs(x_indices - x_hat_indices)
                     difference_tensor = difference_tensor.sum(dim=-1)
-
-                    for idx in range(len(difference_tensor)):
-                        if difference_tensor[idx] == 0:
-                            valid_count_of_reconstruction_no_teacher_forcing += 1
+                    valid_count_of_reconstruction_no_teacher_forcing += int((difference_tensor == 0).sum().item())
 
                     reconstruction_loss, _ = compute_elbo(
                         data_valid_batch, out_one_hot, updated_nop_tensor, mus, log_vars, kld_alpha
@@ -395,12 +497,25 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
                          'property_loss': '%.2f' % float(property_loss)}
                     )
 
+            # sum over processes
+            num_batches_valid_total = num_batches_valid
+            if distributed:
+                valid_reconstruction_loss, valid_divergence_loss, valid_property_loss, \
+                    valid_count_of_reconstruction_no_teacher_forcing, num_batches_valid_total = all_reduce_sum([
+                        valid_reconstruction_loss, valid_divergence_loss, valid_property_loss,
+                        valid_count_of_reconstruction_no_teacher_forcing, num_batches_valid
+                    ])
+                valid_reconstruction_loss, valid_divergence_loss, valid_property_loss = [
+                    torch.tensor([loss], dtype=dtype) for loss in
+                    [valid_reconstruction_loss, valid_divergence_loss, valid_property_loss]
+                ]
+
             # append validation loss
-            data_valid_reconstruction_loss_list_no_teacher_forcing.append((valid_reconstruction_loss / num_batches_valid))
-            data_valid_divergence_loss_list_no_teacher_forcing.append((valid_divergence_loss / num_batches_valid))
-            data_valid_property_loss_list_no_teacher_forcing.append((valid_property_loss / num_batches_valid))
+            data_valid_reconstruction_loss_list_no_teacher_forcing.append((valid_reconstruction_loss / num_batches_valid_total))
+            data_valid_divergence_loss_list_no_teacher_forcing.append((valid_divergence_loss / num_batches_valid_total))
+            data_valid_property_loss_list_no_teacher_forcing.append((valid_property_loss / num_batches_valid_total))
             print('[VAE] Valid Reconstruction (no teacher forcing) Percent Rate is %.3f' %
-                  (100 * valid_count_of_reconstruction_no_teacher_forcing / data_valid.shape[0]), flush=True)
+                  (100 * valid_count_of_reconstruction_no_teacher_forcing / len(data_valid)), flush=True)
 
             # check Nan Loss
             return_loss = [
@@ -416,6 +531,18 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
             if flag:
                 return np.Inf, np.Inf, np.Inf
 
+            for callback in callbacks:
+                callback.on_epoch_end(epoch, *[float(loss) for loss in return_loss])
+
+            # save the best models
+            if rank == 0 and \
+                    float(data_valid_reconstruction_loss_list_no_teacher_forcing[-1]) < best_valid_reconstruction_loss:
+                best_valid_reconstruction_loss = float(data_valid_reconstruction_loss_list_no_teacher_forcing[-1])
+                save_checkpoint(vae_encoder.state_dict(), os.path.join(save_directory, 'best_encoder.pth'))
+                save_checkpoint(vae_decoder.state_dict(), os.path.join(save_directory, 'best_decoder.pth'))
+                save_checkpoint(property_predictor.state_dict(),
+                                os.path.join(save_directory, 'best_property_predictor.pth'))
+
             # early stopping
             early_stopping(validation_loss=data_valid_reconstruction_loss_list_no_teacher_forcing[-1])
 
@@ -451,10 +578,15 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
                 #     title='Property Loss'
                 # )
 
+                # mark the checkpoint as finished (not resumed)
+                if checkpoint_path is not None:
+                    save_training_checkpoint(epoch + 1)
+
                 # save encoder, decoder, and property network
-                torch.save(vae_encoder.state_dict(), os.path.join(save_directory, 'encoder.pth'))
-                torch.save(vae_decoder.state_dict(), os.path.join(save_directory, 'decoder.pth'))
-                torch.save(property_predictor.state_dict(), os.path.join(save_directory, 'property_predictor.pth'))
+                if rank == 0:
+                    torch.save(vae_encoder.state_dict(), os.path.join(save_directory, 'encoder.pth'))
+                    torch.save(vae_decoder.state_dict(), os.path.join(save_directory, 'decoder.pth'))
+                    torch.save(property_predictor.state_dict(), os.path.join(save_directory, 'property_predictor.pth'))
 
                 return data_valid_reconstruction_loss_list_no_teacher_forcing[-1], data_valid_divergence_loss_list_no_teacher_forcing[-1], data_valid_property_loss_list_no_teacher_forcing[-1]
 
@@ -473,6 +605,10 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
             print(optimizer_decoder, flush=True)
             print(optimizer_property_predictor, flush=True)
 
+        # checkpoint (the last epoch marks the checkpoint as finished)
+        if checkpoint_path is not None and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == num_epochs):
+            save_training_checkpoint(epoch + 1)
+
         end = time.time()
         print(f"Epoch {epoch + 1} took {(end - start) / 60.0:.3f} minutes took for training", flush=True)
 
@@ -492,6 +628,12 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
         if flag:
             return np.Inf, np.Inf, np.Inf
 
+        # plots and models are saved by rank 0
+        if rank != 0:
+            return data_valid_reconstruction_loss_list_no_teacher_forcing[-1], \
+                   data_valid_divergence_loss_list_no_teacher_forcing[-1], \
+                   data_valid_property_loss_list_no_teacher_forcing[-1]
+
         print("Plot property prediction ...", flush=True)
 
         # eval mode
@@ -500,14 +642,14 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
         property_predictor.eval()
 
         # train encode
-        inp_flat_one_hot = data_train.transpose(dim0=1, dim1=2)  # convolution
-        latent_points, mus, log_vars = vae_encoder(inp_flat_one_hot)
-        train_prediction = y_scaler.inverse_transform(property_predictor(latent_points).cpu().numpy())
+        train_prediction = y_scaler.inverse_transform(
+            predict_property(vae_encoder, property_predictor, data_train, batch_size, num_classes, dtype).cpu().numpy()
+        )
 
         # valid encode
-        inp_flat_one_hot = data_valid.transpose(dim0=1, dim1=2)  # convolution
-        latent_points, mus, log_vars = vae_encoder(inp_flat_one_hot)
-        valid_prediction = y_scaler.inverse_transform(property_predictor(latent_points).cpu().numpy())
+        valid_prediction = y_scaler.inverse_transform(
+            predict_property(vae_encoder, property_predictor, data_valid, batch_size, num_classes, dtype).cpu().numpy()
+        )
 
         # get r2 score & plot
         property_name = ['LogP', 'SC_score']
@@ -571,6 +713,67 @@ def train_model(vae_encoder, vae_decoder, property_predictor, nop_idx, asterisk_
            data_valid_property_loss_list_no_teacher_forcing[-1]
 
 
+def predict_property(vae_encoder, property_predictor, data, batch_size, num_classes, dtype):
+    """
+    Encode data batch by batch (one-hot vectors are only built per batch) and predict properties
+    data: tensor or vae.utils.dataset.SelfiesLabelDataset
+    """
+    device = next(vae_encoder.parameters()).device
+    if isinstance(data, Dataset):
+        batches = (data_batch for data_batch, _ in get_data_loader(data, batch_size, shuffle=False))
+    else:
+        batches = (data[start_idx: start_idx + batch_size] for start_idx in range(0, len(data), batch_size))
+
+    prediction_list = list()
+    for data_batch in batches:
+        data_batch = to_one_hot_batch(data_batch.to(device), num_classes=num_classes, dtype=dtype)
+        inp_flat_one_hot = data_batch.transpose(dim0=1, dim1=2)  # convolution
+        latent_points, mus, log_vars = vae_encoder(inp_flat_one_hot)
+        prediction_list.append(property_predictor(latent_points))
+
+    return torch.cat(prediction_list, dim=0)
+
+
+def first_step_index(mask):
+    """
+    Step of the first True along dim 1 of a boolean mask [b, l] (-1 if there is none)
+    """
+    if mask.shape[1] == 0:
+        return -torch.ones(mask.shape[0], dtype=torch.long, device=mask.device)
+    step_tensor = torch.arange(mask.shape[1], device=mask.device).expand_as(mask)
+    first_step = torch.where(mask, step_tensor, torch.full_like(step_tensor, mask.shape[1])).min(dim=1)[0]
+    return torch.where(first_step == mask.shape[1], torch.full_like(first_step, -1), first_step)
+
+
+def get_sequence_length(data_batch, nop_idx):
+    """
+    Number of steps before the first 'nop' of one-hot encoded [b, l, alphabet] or label encoded [b, l] sequences
+    (l if there is no 'nop')
+    """
+    is_nop = data_batch == nop_idx if data_batch.dim() == 2 else data_batch[:, :, nop_idx] == 1.0
+    first_nop = first_step_index(is_nop)
+    return torch.where(first_nop < 0, torch.full_like(first_nop, data_batch.shape[1]), first_nop)
+
+
+def get_nop_tensor(x_hat_indices, nop_idx, asterisk_idx, dtype):
+    """
+    Step where decoded sequences [b, l] (argmax indices) terminate (-1 if they don't):
+    the first 'nop' or the second 'asterisk' (the first asterisk after the initiator), whichever comes first.
+    A 'nop' at step 0 is ignored unless a second asterisk is decoded.
+    """
+    nop_tensor = first_step_index(x_hat_indices == nop_idx)
+
+    is_asterisk = x_hat_indices == asterisk_idx
+    asterisk_tensor = first_step_index(is_asterisk & (is_asterisk.cumsum(dim=1) == 2))
+
+    updated_nop_tensor = torch.where(
+        (nop_tensor >= 0) & (asterisk_tensor >= 0),
+        torch.minimum(nop_tensor, asterisk_tensor),
+        torch.where(nop_tensor < 0, asterisk_tensor, torch.where(nop_tensor > 0, nop_tensor, -torch.ones_like(nop_tensor)))
+    )
+    return updated_nop_tensor.to(dtype)
+
+
 def compute_elbo(x, x_hat, nop_tensor, mus, log_vars, kld_alpha):
     # get values
     batch_size = x.shape[0]
@@ -583,12 +786,10 @@ def compute_elbo(x, x_hat, nop_tensor, mus, log_vars, kld_alpha):
     recon_loss = criterion(inp, target)
     recon_loss = recon_loss.reshape(batch_size, max_length)  # reshape
 
-    # exclude error contribution from nop
-    err_boolean_tensor = torch.ones_like(recon_loss)
-
-    for idx, value in enumerate(nop_tensor):
-        if value >= 0.0:
-            err_boolean_tensor[idx, int(value + 1): max_length] = 0.0
+    # exclude error contribution from nop - keep steps up to (and including) the nop (all steps if nop is -1)
+    length_tensor = torch.where(nop_tensor >= 0.0, nop_tensor.long() + 1, torch.full_like(nop_tensor, max_length).long())
+    step_tensor = torch.arange(max_length, device=recon_loss.device)
+    err_boolean_tensor = (step_tensor.unsqueeze(0) < length_tensor.unsqueeze(1)).to(recon_loss.dtype)
 
     # multiply
     recon_loss = recon_loss * err_boolean_tensor
@@ -617,41 +818,3 @@ def plot_learning_curve(iteration_list,
     plt.savefig(os.path.join(save_directory, "%s_learning_curve.png" % title))
     plt.show()
     plt.close()
-
-
-def estimate_maximum_mean_discrepancy(posterior_z_samples: torch.Tensor):
-    # set dtype and device
-    dtype = posterior_z_samples.dtype
-    device = posterior_z_samples.device
-
-    # set dimension and number of samples
-    latent_dimension = posterior_z_samples.shape[1]
-    number_of_samples = posterior_z_samples.shape[0]
-
-    # get prior samples
-    prior_z_samples = torch.randn(size=(number_of_samples, latent_dimension), device=device, dtype=dtype)
-
-    # calculate Maximum Mean Discrepancy with inverse multi-quadratics kernel
-    # set value of c - refer to Sec.4 of Wasserstein paper
-    c = 2 * latent_dimension * (1.0**2)
-
-    # calculate pp term (p means prior)
-    pp = torch.mm(prior_z_samples, prior_z_samples.t())
-    pp_diag = pp.diag().unsqueeze(0).expand_as(pp)
-
-    # calculate qq term (q means posterior)
-    qq = torch.mm(posterior_z_samples, posterior_z_samples.t())
-    qq_diag = qq.diag().unsqueeze(0).expand_as(qq)
-
-    # calculate pq term (q means posterior)
-    pq = torch.mm(prior_z_samples, posterior_z_samples.t())
-
-    # calculate kernel
-    kernel_pp = torch.mean(c / (c + pp_diag + pp_diag.t() - 2 * pp))
-    kernel_qq = torch.mean(c / (c + qq_diag + qq_diag.t() - 2 * qq))
-    kernel_pq = torch.mean(c / (c + qq_diag + pp_diag.t() - 2 * pq))
-
-    # estimate mmd
-    mmd = kernel_pp + kernel_qq - 2*kernel_pq
-
-    return mmd
@@ -0,0 +1,97 @@
+import numpy as np
+import torch
+import torch.nn.functional as f
+
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
+
+
+def label_to_one_hot(labels, num_classes, dtype=torch.float32):
+    """
+    Expand label encoded SELFIES [b, l] to one-hot vectors [b, l, num_classes].
+    Labels are stored as uint8 / int16 (vae.preprocess.multiple_selfies_to_label) and expanded per batch.
+    """
+    return f.one_hot(labels.long(), num_classes=num_classes).to(dtype)
+
+
+def to_one_hot_batch(batch, num_classes, dtype=torch.float32):
+    """
+    Return a batch as one-hot vectors [b, l, num_classes].
+    Label encoded batches [b, l] are expanded and one-hot encoded batches are returned as they are.
+    """
+    if batch.dim() == 2:
+        return label_to_one_hot(batch, num_classes=num_classes, dtype=dtype)
+    return batch
+
+
+class SelfiesLabelDataset(Dataset):
+    """
+    Label encoded SELFIES [N, L] (e.g. the memory mapped selfies_labels.npy of vae.preprocess.save_label_encoding)
+    and properties, read from disk batch by batch. Items are whole batches: __getitem__ takes a list of indices
+    (use get_data_loader), so that a batch is gathered from the memory map in one read.
+    labels: array or path to a .npy file (memory mapped lazily in each worker process)
+    y: properties [len(indices), property_dim] aligned with indices
+    indices: rows of labels belonging to this dataset (all rows if None)
+    """
+    def __init__(self, labels, y, indices=None):
+        self.labels_path = labels if isinstance(labels, str) else None
+        self._labels = None if self.labels_path is not None else labels
+        self.indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices)
+        self.y = np.asarray(y, dtype=np.float32)
+        assert self.y.shape[0] == self.indices.shape[0], 'y must be aligned with indices'
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = np.load(self.labels_path, mmap_mode='r')
+        return self._labels
+
+    def __getstate__(self):
+        # don't send the memory map to worker processes - it is reopened from the path
+        state = self.__dict__.copy()
+        if self.labels_path is not None:
+            state['_labels'] = None
+        return state
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, batch_idx):
+        labels = self._read_rows(self.indices[batch_idx])
+
+        return torch.from_numpy(labels), torch.from_numpy(self.y[batch_idx])
+
+    def _read_rows(self, rows):
+        # read the memory map in ascending order of rows
+        order = np.argsort(rows, kind='stable')
+        labels = np.empty((rows.shape[0], self.labels.shape[1]), dtype=self.labels.dtype)
+        labels[order] = self.labels[rows[order]]
+        return labels
+
+    def get_sequence_length(self, nop_idx, chunk_size=100000):
+        """
+        Number of symbols before the first 'nop' of each SELFIES (L if there is no 'nop'), read in chunks
+        """
+        length_list = [np.zeros(0, dtype=np.int64)]
+        for start_idx in range(0, len(self), chunk_size):
+            is_nop = self._read_rows(self.indices[start_idx: start_idx + chunk_size]) == nop_idx
+            length_list.append(np.where(is_nop.any(axis=1), is_nop.argmax(axis=1), is_nop.shape[1]))
+
+        return torch.from_numpy(np.concatenate(length_list))
+
+
+def get_data_loader(dataset, batch_size, shuffle=True, batch_sampler=None, num_workers=0, pin_memory=False,
+                    prefetch_factor=2):
+    """
+    DataLoader of (labels [b, L], y [b, property_dim]) batches of a SelfiesLabelDataset.
+    Labels stay compact (uint8 / int16) until they are expanded to one-hot vectors on the device (to_one_hot_batch).
+    batch_sampler: sampler of index lists (e.g. vae.utils.sampler.LengthBucketBatchSampler)
+    """
+    if batch_sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=False)
+
+    worker_kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=True) if num_workers > 0 else dict()
+
+    # batch_size=None: the dataset returns whole batches for the index lists of batch_sampler
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=num_workers,
+                      pin_memory=pin_memory, **worker_kwargs)
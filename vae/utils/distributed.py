@@ -0,0 +1,28 @@
+import torch
+import torch.distributed as dist
+
+
+def get_rank_and_world_size(distributed):
+    if distributed:
+        if not dist.is_initialized():
+            raise RuntimeError('distributed training needs an initialized process group (torch.distributed)')
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def all_reduce_sum(values):
+    """
+    Sum of numbers (or one-element tensors) over all processes, returned as a list of floats
+    """
+    tensor = torch.tensor([float(value) for value in values], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def all_gather_object(obj):
+    """
+    List of obj of all processes (indexed by rank)
+    """
+    object_list = [None] * dist.get_world_size()
+    dist.all_gather_object(object_list, obj)
+    return object_list
@@ -1,5 +1,7 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import selfies as sf
 
 import torch
@@ -27,65 +29,98 @@ def is_correct_smiles(smiles):
         return False
 
 
-def reconstruct_molecules(type_of_encoding, encoding_alphabet, one_hot_encoded_vector):
-    # set parameters
-    total_valid = 0
-    valid_molecules_idx = []
-    valid_molecules = []
+def _check_smiles_chunk(smiles_chunk):
+    return [is_correct_smiles(smiles) for smiles in smiles_chunk]
 
-    molecules_num = one_hot_encoded_vector.shape[0]
-    reconstruct_one_hot = one_hot_encoded_vector.clone().detach()
 
-    for idx in range(molecules_num):
-        gathered_atoms = ''
-        one_hot_idx = reconstruct_one_hot[idx]
+def check_smiles_validity(smiles_list, n_jobs=1, chunk_size=1000):
+    """
+    RDKit validity of a list of SMILES (None -> False). Each unique SMILES is parsed once,
+    in a pool of n_jobs processes (None -> all CPUs, 1 -> in the calling process).
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    unique_smiles = list({smiles for smiles in smiles_list if smiles is not None})
+    chunks = [unique_smiles[i: i + chunk_size] for i in range(0, len(unique_smiles), chunk_size)]
+
+    if n_jobs <= 1 or len(chunks) <= 1:
+        chunk_validity = [_check_smiles_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(chunks))) as executor:
+            chunk_validity = list(executor.map(_check_smiles_chunk, chunks))
 
-        for value in one_hot_idx:
-            gathered_atoms += encoding_alphabet[value]
-        # selfies
-        if type_of_encoding == 1:
-            generated_molecule = gathered_atoms.replace('[nop]', '')
-        # smiles
-        else:
-            generated_molecule = None
-        # selfies to smiles
-        smiles_generated_molecule = sf.decoder(generated_molecule)
-        if is_correct_smiles(smiles_generated_molecule):
-            total_valid += 1
-            valid_molecules_idx.append(idx)
-            valid_molecules.append(smiles_generated_molecule)
+    validity = dict()
+    for chunk, chunk_valid in zip(chunks, chunk_validity):
+        validity.update(zip(chunk, chunk_valid))
+
+    return [smiles is not None and validity[smiles] for smiles in smiles_list]
+
+
+def indices_to_selfies(encoding_alphabet, x_indices, prefix=''):
+    """
+    Join symbols of label encodings x_indices [b, l] (tensor or array) into SELFIES strings.
+    Symbols are gathered from an object array of the alphabet with '[nop]' mapped to ''.
+    """
+    if torch.is_tensor(x_indices):
+        x_indices = x_indices.detach().cpu().numpy()
+
+    symbol_array = np.array([('' if symbol == '[nop]' else symbol) for symbol in encoding_alphabet], dtype=object)
+    gathered_symbols = symbol_array[np.asarray(x_indices)]
+
+    return [prefix + ''.join(row) for row in gathered_symbols.tolist()]
+
+
+def reconstruct_batch(encoding_alphabet, x_indices, prefix='', n_jobs=1, chunk_size=1000):
+    """
+    Reconstruct label encodings x_indices [b, l] to SMILES.
+    Returns a list of SMILES, None for a SELFIES that could not be decoded or an invalid molecule (RDKit).
+    """
+    selfies_list = indices_to_selfies(encoding_alphabet, x_indices, prefix=prefix)
+    smiles_list = sf.batch_decoder(selfies_list, n_jobs=n_jobs, chunk_size=chunk_size)
+    validity = check_smiles_validity(smiles_list, n_jobs=n_jobs, chunk_size=chunk_size)
 
-    return total_valid, valid_molecules_idx, valid_molecules
+    return [smiles if valid else None for smiles, valid in zip(smiles_list, validity)]
+
+
+def reconstruct_molecules(type_of_encoding, encoding_alphabet, one_hot_encoded_vector, n_jobs=1):
+    # selfies
+    if type_of_encoding == 1:
+        reconstructed_molecules = reconstruct_batch(encoding_alphabet, one_hot_encoded_vector, n_jobs=n_jobs)
+    # smiles
+    else:
+        reconstructed_molecules = [None] * one_hot_encoded_vector.shape[0]
+
+    valid_molecules_idx = [idx for idx, smiles in enumerate(reconstructed_molecules) if smiles is not None]
+    valid_molecules = [reconstructed_molecules[idx] for idx in valid_molecules_idx]
+
+    return len(valid_molecules), valid_molecules_idx, valid_molecules
 
 
 def one_point_latent_sampling(encoder, decoder, encoding_list, encoding_alphabet,
                               largest_molecule_len, molecule_idx, repeat_num, save_directory):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    encoding_list_func = encoding_list.copy()
-    trial_molecule_set = [encoding_list_func[molecule_idx] for _ in range(repeat_num)]
 
-    # data & torch tensor
-    data = multiple_selfies_to_hot(trial_molecule_set, largest_molecule_len, encoding_alphabet)
+    # data & torch tensor - the molecule is encoded once
+    data = multiple_selfies_to_hot([encoding_list[molecule_idx]], largest_molecule_len, encoding_alphabet)
     data_tensor = torch.tensor(data, dtype=torch.float).to(device)
 
     # eval
     encoder.eval()
     decoder.eval()
 
-    # encoding
-    inp_flat_one_hot = data_tensor.flatten(start_dim=1)
-    latent_points, mus, log_vars = encoder(inp_flat_one_hot)
-    latent_points = latent_points.unsqueeze(0)
+    with torch.no_grad():
+        # encoding
+        inp_flat_one_hot = data_tensor.flatten(start_dim=1)
+        _, mus, log_vars = encoder(inp_flat_one_hot)
 
-    # decoding
-    hidden = decoder.init_hidden(batch_size=repeat_num)
-    out_one_hot = torch.zeros_like(data_tensor, device=device)
-    for seq_index in range(data_tensor.shape[1]):
-        out_one_hot_line, hidden = decoder(latent_points, hidden)
-        out_one_hot[:, seq_index, :] = out_one_hot_line[0]
+        # repeat_num samples of the posterior
+        latent_points = encoder.reparameterize(mus.expand(repeat_num, -1), log_vars.expand(repeat_num, -1))
 
-    x_hat_prob = f.softmax(out_one_hot, dim=-1)
-    x_hat_indices = x_hat_prob.argmax(dim=-1)
+        # decoding
+        nop_idx = encoding_alphabet.index('[nop]')
+        asterisk_idx = encoding_alphabet.index('[*]') if '[*]' in encoding_alphabet else -1
+        x_hat_indices = decoder.generate(latent_points, largest_molecule_len, nop_idx, asterisk_idx)
 
     # generating molecules
     _, _, molecules = reconstruct_molecules(
@@ -0,0 +1,119 @@
+import copy
+import json
+from typing import Tuple
+
+import torch
+from torch import nn, Tensor
+from torch.nn import functional as f
+
+from vae.decoder.torch import update_stop_step, mask_after_stop
+
+METADATA_FILE = 'metadata.json'
+
+
+class VAEInference(nn.Module):
+    def __init__(self, encoder, decoder, nop_idx, asterisk_idx, max_length, example_input=None):
+        """
+        Inference graph of a trained VAE for TorchScript: the encoder (traced), the one-step decoder
+        and the lockstep generation loop of Decoder.generate (forward).
+        example_input: encoder input to trace with (default: zeros of the CNNEncoder input [2, alphabet, max_length])
+        The encoder and decoder are copied, so the training mode of the given modules is left as it is.
+        """
+        super(VAEInference, self).__init__()
+        encoder, decoder = copy.deepcopy(encoder).eval(), copy.deepcopy(decoder).eval()
+        if example_input is None:
+            example_input = torch.zeros(2, decoder.input_size, max_length, device=next(decoder.parameters()).device)
+
+        with torch.no_grad():
+            self.encoder = torch.jit.trace(encoder, example_input, check_trace=False)  # reparameterization samples
+        self.decode_RNN = decoder.decode_RNN
+        self.decode_FC = decoder.decode_FC
+
+        self.input_size = decoder.input_size
+        self.num_hidden_layers = decoder.num_layers * 2 if decoder.bidirectional else decoder.num_layers
+        self.nop_idx = nop_idx
+        self.asterisk_idx = asterisk_idx
+        self.max_length = max_length
+
+    @torch.jit.export
+    def encode(self, x) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Returns z, mu and log_var of the encoder input x
+        """
+        return self.encoder(x)
+
+    @torch.jit.export
+    def init_hidden(self, z):
+        return z.unsqueeze(0).repeat(self.num_hidden_layers, 1, 1)
+
+    @torch.jit.export
+    def decode_step(self, x, hidden) -> Tuple[Tensor, Tensor]:
+        """
+        One decoder step: x [1, b, alphabet], hidden [layers * directions, b, latent]
+        """
+        output, hidden = self.decode_RNN(x, hidden)
+        return self.decode_FC(output), hidden
+
+    def forward(self, z):
+        """
+        Labels [b, max_length] generated from latent vectors z [b, latent] (see Decoder.generate)
+        """
+        batch_size = z.shape[0]
+        hidden = self.init_hidden(z)
+        x_input = torch.zeros([1, batch_size, self.input_size], dtype=z.dtype, device=z.device)
+        labels = torch.full([batch_size, self.max_length], self.nop_idx, dtype=torch.long, device=z.device)
+
+        minus_one = -torch.ones([batch_size], dtype=torch.long, device=z.device)
+        nop_tensor = minus_one.clone()
+        asterisk_tensor = minus_one.clone()
+        asterisk_count = torch.zeros_like(minus_one)
+        stop_tensor = minus_one.clone()
+
+        for seq_index in range(self.max_length):
+            out_one_hot_line, hidden = self.decode_step(x_input, hidden)
+            x_hat_indices = out_one_hot_line[0].argmax(dim=-1)
+            nop_tensor, asterisk_count, asterisk_tensor, stop_tensor = update_stop_step(
+                x_hat_indices, seq_index, self.nop_idx, self.asterisk_idx, nop_tensor, asterisk_count, asterisk_tensor,
+                stop_tensor
+            )
+
+            # stop generation if all sequences stopped
+            if bool((stop_tensor >= 0).all()):
+                break
+
+            labels[:, seq_index] = x_hat_indices
+            x_input = f.one_hot(x_hat_indices, num_classes=self.input_size).to(z.dtype).unsqueeze(0)
+
+        return mask_after_stop(labels, stop_tensor, self.nop_idx)
+
+
+def export_vae(file_path, encoder, decoder, nop_idx, asterisk_idx, max_length, encoding_alphabet=None,
+               example_input=None):
+    """
+    Save the scripted VAEInference with its metadata (indices, max length and the alphabet) to file_path.
+    """
+    inference_module = torch.jit.script(
+        VAEInference(encoder, decoder, nop_idx, asterisk_idx, max_length, example_input=example_input).eval()
+    )
+    metadata = {
+        'nop_idx': nop_idx,
+        'asterisk_idx': asterisk_idx,
+        'max_length': max_length,
+        'encoding_alphabet': encoding_alphabet,
+    }
+    torch.jit.save(inference_module, file_path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+
+    return inference_module
+
+
+def load_vae(file_path, map_location=None):
+    """
+    Load an exported VAE (no module construction from parameter dicts). Returns the scripted module and metadata.
+        z, mu, log_var = module.encode(one_hot.transpose(1, 2))
+        labels = module(z)  # generation
+    """
+    extra_files = {METADATA_FILE: ''}
+    inference_module = torch.jit.load(file_path, map_location=map_location, _extra_files=extra_files)
+    inference_module.eval()
+
+    return inference_module, json.loads(extra_files[METADATA_FILE])
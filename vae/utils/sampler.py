@@ -0,0 +1,49 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yield batches of indices of SELFIES with similar lengths, so that the decoder is unrolled
+    only up to the max length of each bucket instead of the max length of a random batch.
+    Indices are shuffled, split into chunks of bucket_size_multiplier batches and sorted by length within a chunk.
+    The order of batches is shuffled again (some randomness is kept in the batch composition).
+    """
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=100, shuffle=True, drop_last=False,
+                 generator=None):
+        self.lengths = torch.as_tensor(lengths).cpu()
+        self.batch_size = batch_size
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __iter__(self):
+        num_samples = self.lengths.shape[0]
+        if self.shuffle:
+            indices = torch.randperm(num_samples, generator=self.generator)
+        else:
+            indices = torch.arange(num_samples)
+
+        # sort by length in each bucket
+        batch_list = []
+        for bucket in indices.split(self.batch_size * self.bucket_size_multiplier):
+            sorted_bucket = bucket[self.lengths[bucket].sort(stable=True)[1]]
+            batch_list.extend(sorted_bucket.split(self.batch_size))
+
+        if self.drop_last and batch_list and batch_list[-1].shape[0] < self.batch_size:
+            batch_list = batch_list[:-1]
+
+        if self.shuffle:
+            batch_order = torch.randperm(len(batch_list), generator=self.generator).tolist()
+        else:
+            batch_order = range(len(batch_list))
+
+        for batch_idx in batch_order:
+            yield batch_list[batch_idx].tolist()
+
+    def __len__(self):
+        # every bucket but the last is a multiple of batch_size
+        if self.drop_last:
+            return self.lengths.shape[0] // self.batch_size
+        return (self.lengths.shape[0] + self.batch_size - 1) // self.batch_size
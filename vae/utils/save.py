@@ -1,5 +1,9 @@
 import os
 import pickle
+import random
+
+import numpy as np
+import torch
 
 
 def save_model(model, model_name, save_directory):
@@ -14,6 +18,42 @@ def load_model(file_path):
     return model
 
 
+def save_checkpoint(state, file_path):
+    """
+    Save a checkpoint atomically: write to a temporary file and rename it over file_path,
+    so that a killed process leaves either the previous or the new checkpoint.
+    """
+    temp_file_path = file_path + '.tmp'
+    torch.save(state, temp_file_path)
+    os.replace(temp_file_path, file_path)
+
+
+def load_checkpoint(file_path, map_location=None):
+    return torch.load(file_path, map_location=map_location)
+
+
+def get_rng_state():
+    """
+    RNG states of torch (CPU and CUDA), numpy and random. Only plain types and tensors are stored.
+    """
+    np_state = np.random.get_state()
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+        'random': random.getstate(),
+    }
+
+
+def set_rng_state(rng_state):
+    torch.set_rng_state(rng_state['torch'])
+    if rng_state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+    np_state = rng_state['numpy']
+    np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+    random.setstate(rng_state['random'])
+
+
 class VAEParameters(object):
     def __init__(self, data_path: str, save_directory, nop_idx, asterisk_idx, latent_dimension, encoder_in_channels,
                  encoder_feature_dim, encoder_convolution_channel_dim: list, encoder_kernel_size: list,
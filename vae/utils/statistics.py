@@ -0,0 +1,151 @@
+import os
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+
+import sys
+sys.path.append('/home/sk77/PycharmProjects/publish/OMG')
+import selfies as sf
+
+
+class CorpusStatistics(object):
+    """
+    Streaming statistics of a SELFIES / SMILES corpus: symbol (character) counts and length histograms.
+    Statistics of shards can be merged, so the corpus never has to be held in memory (or joined) at once.
+    """
+    def __init__(self):
+        self.num_molecules = 0
+        self.selfies_symbol_counts = Counter()
+        self.selfies_length_histogram = Counter()  # symbol length -> number of molecules
+        self.smiles_char_counts = Counter()
+        self.smiles_length_histogram = Counter()
+
+    def update(self, selfies_iter, smiles_iter=None):
+        """
+        Add SELFIES strings (and optionally the SMILES strings they were translated from) one by one.
+        """
+        num_selfies = 0
+        for selfies in selfies_iter:
+            symbols = sf.tokenize_selfies(selfies)
+            self.selfies_symbol_counts.update(symbols)
+            self.selfies_length_histogram[len(symbols)] += 1
+            num_selfies += 1
+
+        if smiles_iter is not None:
+            for smiles in smiles_iter:
+                self.smiles_char_counts.update(smiles)
+                self.smiles_length_histogram[len(smiles)] += 1
+
+        self.num_molecules += num_selfies
+        return self
+
+    def merge(self, other):
+        """
+        Merge the statistics of another shard in place.
+        """
+        self.num_molecules += other.num_molecules
+        self.selfies_symbol_counts.update(other.selfies_symbol_counts)
+        self.selfies_length_histogram.update(other.selfies_length_histogram)
+        self.smiles_char_counts.update(other.smiles_char_counts)
+        self.smiles_length_histogram.update(other.smiles_length_histogram)
+        return self
+
+    @property
+    def largest_selfies_len(self):
+        return max(self.selfies_length_histogram, default=0)
+
+    @property
+    def largest_smiles_len(self):
+        return max(self.smiles_length_histogram, default=0)
+
+    def selfies_alphabet(self):
+        """
+        Sorted SELFIES alphabet with the padding symbol '[nop]' at index 0 (the dot '.' is excluded).
+        """
+        symbols = set(self.selfies_symbol_counts) - {'.', '[nop]'}
+        return ['[nop]'] + sorted(symbols)
+
+    def smiles_alphabet(self):
+        """
+        Sorted SMILES characters with the padding character ' ' appended.
+        """
+        return sorted(set(self.smiles_char_counts) - {' '}) + [' ']
+
+    def to_dict(self):
+        return {
+            'num_molecules': self.num_molecules,
+            'selfies_alphabet': self.selfies_alphabet(),
+            'largest_selfies_len': self.largest_selfies_len,
+            'selfies_symbol_counts': dict(self.selfies_symbol_counts),
+            'selfies_length_histogram': {str(k): v for k, v in sorted(self.selfies_length_histogram.items())},
+            'smiles_alphabet': self.smiles_alphabet(),
+            'largest_smiles_len': self.largest_smiles_len,
+            'smiles_char_counts': dict(self.smiles_char_counts),
+            'smiles_length_histogram': {str(k): v for k, v in sorted(self.smiles_length_histogram.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        statistics = cls()
+        statistics.num_molecules = dictionary['num_molecules']
+        statistics.selfies_symbol_counts = Counter(dictionary['selfies_symbol_counts'])
+        statistics.selfies_length_histogram = Counter(
+            {int(k): v for k, v in dictionary['selfies_length_histogram'].items()}
+        )
+        statistics.smiles_char_counts = Counter(dictionary['smiles_char_counts'])
+        statistics.smiles_length_histogram = Counter(
+            {int(k): v for k, v in dictionary['smiles_length_histogram'].items()}
+        )
+        return statistics
+
+    def save(self, file_path):
+        """
+        Save as a json vocabulary file (alphabets, largest lengths, counts and histograms).
+        """
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+
+def _shard_statistics(selfies_shard, smiles_shard):
+    return CorpusStatistics().update(selfies_shard, smiles_shard)
+
+
+def _iterate_shards(iterable, shard_size):
+    iterator = iter(iterable)
+    while True:
+        shard = list(islice(iterator, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+def compute_corpus_statistics(selfies_iter, smiles_iter=None, n_jobs=1, shard_size=100000):
+    """
+    Compute CorpusStatistics over shards of shard_size molecules and merge them.
+    n_jobs: number of processes (None -> all CPUs, 1 -> in the calling process)
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    selfies_shards = _iterate_shards(selfies_iter, shard_size)
+    if smiles_iter is None:
+        smiles_shards = repeat(None)
+    else:
+        smiles_shards = _iterate_shards(smiles_iter, shard_size)
+
+    statistics = CorpusStatistics()
+    if n_jobs <= 1:
+        for selfies_shard, smiles_shard in zip(selfies_shards, smiles_shards):
+            statistics.merge(_shard_statistics(selfies_shard, smiles_shard))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            for shard_statistics in executor.map(_shard_statistics, selfies_shards, smiles_shards):
+                statistics.merge(shard_statistics)
+
+    return statistics